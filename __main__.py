@@ -4,6 +4,7 @@ import argparse
 import asyncio
 from src.core.logging import get_logger
 from src.bot.shanghai import Shanghai
+from src.core.metrics import start_metrics_server
 
 logger = get_logger(__name__)
 
@@ -16,6 +17,25 @@ def parse_args():
     parser.add_argument('--prefix', type=str, help='The prefix to use for commands.', default='s!')
     parser.add_argument('--token', type=str, help='The token to use for authentication.')
     parser.add_argument('--hf_token', type=str, help='The token to use for HuggingFace authentication.')
+    parser.add_argument('--model_cache_dir', type=str, help='Directory for the memory-mappable copies of the converted model weights (default ~/.cache/shanghai/models).', default=None)
+    parser.add_argument('--memory_budget', type=float, help='Device memory budget in GiB; model components are moved to the CPU between stages to stay within it.', default=None)
+    parser.add_argument('--attention', type=str, help='UNet attention backend; auto picks one per request from the resolution.', choices=['auto', 'default', 'sliced', 'sdpa', 'chunked'], default='auto')
+    parser.add_argument('--latent_cache_dir', type=str, help='Directory to spill evicted init image latents to.', default=None)
+    parser.add_argument('--devices', type=str, nargs='+', help='Run one model replica per device in its own process, e.g. cuda:0 cuda:1.', default=None)
+    parser.add_argument('--node', action='store_true', help='Run as an inference node that serves jobs to bots instead of connecting to Discord.')
+    parser.add_argument('--listen', type=str, help='Address an inference node listens on.', default='127.0.0.1:5151')
+    parser.add_argument('--inference_url', type=str, help='Send jobs to the inference node at this address (e.g. tcp://10.0.0.2:5151) instead of loading the models locally.', default=None)
+    parser.add_argument('--image_format', type=str, help='Format results are uploaded in.', choices=['png', 'webp', 'jpeg'], default='png')
+    parser.add_argument('--image_workers', type=int, help='Processes used to resize and encode result images.', default=2)
+    parser.add_argument('--result_cache_dir', type=str, help='Directory results of requests with an explicit seed are kept in.', default=os.path.join(os.path.expanduser('~'), '.cache', 'shanghai', 'results'))
+    parser.add_argument('--result_cache_size', type=float, help='Disk space for cached results in GiB; 0 disables the cache.', default=1.0)
+    parser.add_argument('--user_quota', type=float, help='Jobs per minute each user may run, counted in 512x512 50 step txt2img equivalents; 0 turns the quota off.', default=6.0)
+    parser.add_argument('--user_burst', type=float, help='Jobs a user may run at once before --user_quota applies, in the same units.', default=10.0)
+    parser.add_argument('--guild_quota', type=float, help='Jobs per minute each server may run, in the same units; 0 turns the quota off.', default=30.0)
+    parser.add_argument('--guild_burst', type=float, help='Jobs a server may run at once before --guild_quota applies.', default=50.0)
+    parser.add_argument('--scheduler_slots', type=int, help='Jobs handed to the model queue at once; the rest wait in the fair scheduler (default 4 per device).', default=None)
+    parser.add_argument('--job_timeout', type=float, help='Seconds a job may take from the command before it is stopped between denoising steps; jobs always stop before the 15 minute Discord interaction window closes. 0 leaves only that limit.', default=600.0)
+    parser.add_argument('--metrics_port', type=int, help='Serve Prometheus metrics on this local port.', default=None)
 
     return parser.parse_args()
 
@@ -26,7 +46,23 @@ def main():
     shanghai = None
     args = parse_args()
 
-    os.environ['HF_TOKEN'] = args.hf_token
+    # only the process that loads the models needs the HuggingFace token
+    if args.hf_token:
+        os.environ['HF_TOKEN'] = args.hf_token
+    if args.model_cache_dir:
+        os.environ['MODEL_CACHE_DIR'] = args.model_cache_dir
+    if args.memory_budget:
+        os.environ['MEMORY_BUDGET'] = str(args.memory_budget)
+    os.environ['ATTENTION_BACKEND'] = args.attention
+    if args.latent_cache_dir:
+        os.environ['LATENT_CACHE_DIR'] = args.latent_cache_dir
+
+    if args.node:
+        from src.core.node import run_node
+        if args.metrics_port:
+            start_metrics_server(args.metrics_port)
+        run_node(args.listen, args.devices)
+        return
     
     try:
         shanghai = Shanghai(args)
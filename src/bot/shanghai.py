@@ -2,12 +2,15 @@ import os
 import discord
 from discord.ext import commands
 from src.core.logging import get_logger
+from src.core.metrics import start_metrics_server
 
 class Shanghai(commands.Bot):
     def __init__(self, args):
         super().__init__(command_prefix=args.prefix, intents=discord.Intents.all())
         self.args = args
         self.logger = get_logger(__name__)
+        if args.metrics_port:
+            self.metrics_server = start_metrics_server(args.metrics_port)
         self.load_extension('src.bot.stablecog')
 
     async def on_ready(self):
@@ -1,19 +1,117 @@
 import traceback
-import requests
 import asyncio
+import time
 import discord
 from discord.ext import commands
-from typing import Optional
+from typing import Awaitable, Callable, Optional
 from io import BytesIO
 from PIL import Image
-from pytorch_lightning import seed_everything
-
-from src.stablediffusion.text2image_diffusers import Text2Image
+from src.core.fetch import ImageFetcher
+from src.core.imageproc import ImagePostProcessor, image_grid
+from src.core.remote import InferenceClient
+from src.core.resultcache import ResultCache
+from src.core.scheduler import FairScheduler, JobRequest, Ticket
+from src.core.metrics import observe_stage
+from src.stablediffusion.cancellation import CancelToken, JobCancelled
+from src.stablediffusion.crop import crop_region, repaint_mask
+from src.stablediffusion.jobs import MODEL_REVISION, OUTPUT_VERSION
+from src.stablediffusion.presets import resolve_sampling
+from src.stablediffusion.preview import PreviewBuffer
 
 embed_color = discord.Colour.from_rgb(215, 195, 134)
 
+# Discord takes at most 10 attachments per message, and multi-image results also send a grid
+MAX_SAMPLES = 4
+MAX_ITER = 2
+
+# results go out as follow-ups, which Discord only accepts for 15 minutes after the command;
+# jobs stop early enough to leave time for the upload
+INTERACTION_LIFETIME = 15 * 60
+UPLOAD_MARGIN = 30
+
+# quality preset each command runs at unless the request picks one
+COMMAND_QUALITY = {'dream': 'balanced', 'translate': 'balanced', 'inpaint': 'balanced', 'refine': 'balanced', 'psychedelico': 'fast'}
+MAX_STEPS = 100
+
+def image_counts(n_iter: int, n_samples: int) -> tuple:
+    return max(1, min(n_iter, MAX_ITER)), max(1, min(n_samples, MAX_SAMPLES))
+
+def sampling(command: str, quality: Optional[str] = None, sampler: Optional[str] = None, steps: Optional[int] = None, guidance_cutoff: Optional[float] = None) -> tuple:
+    sampler, steps, guidance_cutoff = resolve_sampling(quality or COMMAND_QUALITY[command], sampler, steps, guidance_cutoff)
+    return sampler, min(steps, MAX_STEPS), guidance_cutoff
+
+def job_deadline(interaction: discord.Interaction, timeout: Optional[float] = None) -> float:
+    deadline = interaction.created_at.timestamp() + INTERACTION_LIFETIME - UPLOAD_MARGIN
+    if timeout:
+        deadline = min(deadline, time.time() + timeout)
+    return deadline
+
+def error_embed(title: str, e: Exception) -> discord.Embed:
+    if isinstance(e, JobCancelled):
+        return discord.Embed(title=str(e), color=embed_color)
+    return discord.Embed(title=title, description=f'{e}\n{traceback.print_exc()}', color=embed_color)
+
+async def encode_file(postprocessor: ImagePostProcessor, image: Image.Image, name: str, size: Optional[tuple] = None) -> discord.File:
+    data = await postprocessor.encode(image, size=size)
+    return image_file(postprocessor, data, name)
+
+def image_file(postprocessor: ImagePostProcessor, data: bytes, name: str) -> discord.File:
+    return discord.File(fp=BytesIO(data), filename=f'{name}.{postprocessor.extension()}')
+
+def decode_image(data: bytes) -> Image.Image:
+    image = Image.open(BytesIO(data))
+    image.load()
+    return image
+
+class CancelView(discord.ui.View):
+    # stops a queued or running job; only whoever asked for it may
+    def __init__(self, token: CancelToken, user: int):
+        super().__init__(timeout=None)
+        self.token = token
+        self.user = user
+
+    @discord.ui.button(label="Cancel", style=discord.ButtonStyle.secondary, emoji="✖️")
+    async def cancel_callback(self, button, interaction):
+        if interaction.user.id != self.user:
+            await interaction.response.send_message('Only whoever asked for this can cancel it.', ephemeral=True)
+            return
+        self.token.cancel()
+        button.disabled = True
+        await interaction.response.edit_message(view=self)
+
+async def show_queue_position(send, ticket: Ticket, view: Optional[discord.ui.View] = None, interval: float = 1.0):
+    # only jobs that actually have to wait get a notice, edited as they move up the line
+    message = None
+    shown = None
+    embed = discord.Embed(color=embed_color)
+    try:
+        while ticket.position > 0 and not ticket.future.done():
+            if ticket.position != shown:
+                shown = ticket.position
+                embed.title = f'Queued, position {shown}'
+                if message is None:
+                    message = await send(embed=embed, view=view, wait=True)
+                else:
+                    await message.edit(embed=embed)
+            await asyncio.sleep(interval)
+    except discord.HTTPException:
+        pass
+    finally:
+        if message is not None:
+            await message.delete()
+
+async def run_scheduled(scheduler: FairScheduler, request: JobRequest, send, method: str, *args, **kwargs):
+    ticket = scheduler.submit(request, method, *args, **kwargs)
+    token = kwargs.get('cancel')
+    view = CancelView(token, request.user) if token is not None else None
+    notice = asyncio.create_task(show_queue_position(send, ticket, view))
+    try:
+        return await scheduler.wait(ticket)
+    finally:
+        await asyncio.gather(notice, return_exceptions=True)
+
 class MyView(discord.ui.View): # Create a class called MyView that subclasses discord.ui.View
-    def __init__(self, ctx, query: str, image: BytesIO, text2image_model: Text2Image, height: Optional[int]=512, width: Optional[int]=512, guidance_scale: Optional[float] = 7.0, steps: Optional[int] = 50, seed: Optional[int] = -1):
+    def __init__(self, ctx, query: str, image: BytesIO, scheduler: FairScheduler, postprocessor: ImagePostProcessor, height: Optional[int]=512, width: Optional[int]=512, guidance_scale: Optional[float] = 7.0, steps: Optional[int] = 50, seed: Optional[int] = -1, sampler: Optional[str] = None, guidance_cutoff: Optional[float] = 1.0, guidance_threshold: Optional[float] = 0.0, job_timeout: Optional[float] = None):
         super().__init__(timeout=None)
         self.ctx = ctx;
         self.query = query
@@ -23,7 +121,19 @@ class MyView(discord.ui.View): # Create a class called MyView that subclasses di
         self.guidance_scale = guidance_scale
         self.steps = steps
         self.seed = seed
-        self.text2image_model = text2image_model
+        self.sampler = sampler
+        self.guidance_cutoff = guidance_cutoff
+        self.guidance_threshold = guidance_threshold
+        self.scheduler = scheduler
+        self.postprocessor = postprocessor
+        self.job_timeout = job_timeout
+        # follow-up jobs still queued or running, by the token that cancels them, with who asked
+        self.pending = {}
+
+    def cancel_token(self, user: int) -> CancelToken:
+        token = CancelToken(job_deadline(self.ctx.interaction, self.job_timeout))
+        self.pending[token] = user
+        return token
 
     @discord.ui.button(custom_id="upscale", label="Upscale", row=0, style=discord.ButtonStyle.secondary, emoji="⏫")
     async def upscale_callback(self, button, interaction):
@@ -33,15 +143,11 @@ class MyView(discord.ui.View): # Create a class called MyView that subclasses di
             embed.color = embed_color
             embed.set_footer(text=self.query)
 
-            LANCZOS = (Image.Resampling.LANCZOS if hasattr(Image, 'Resampling') else Image.LANCZOS)
-            res = self.image.resize((2048, 2048), resample=LANCZOS)
-
-            with BytesIO() as buffer:
-                res.save(buffer, 'PNG')
-                buffer.seek(0)
-                await self.ctx.send_followup(embed=embed, file=discord.File(fp=buffer, filename=f'{self.seed}-2048.png'))
+            file = await encode_file(self.postprocessor, self.image, f'{self.seed}-2048', size=(2048, 2048))
+            with observe_stage('discord_upload'):
+                await self.ctx.send_followup(embed=embed, file=file)
         except Exception as e:
-            embed = discord.Embed(title='Upscale failed', description=f'{e}\n{traceback.print_exc()}', color=embed_color)
+            embed = error_embed('Upscale failed', e)
             await self.ctx.send_followup(embed=embed)
 
         await interaction.response.send_message("Variation") # Send a message when the button is clicked
@@ -49,52 +155,114 @@ class MyView(discord.ui.View): # Create a class called MyView that subclasses di
     @discord.ui.button(custom_id="variation", label="Make Variations", row=0, style=discord.ButtonStyle.secondary, emoji="🎯")
     async def variation_callback(self, button, interaction):
         await interaction.response.defer()
+        token = self.cancel_token(interaction.user.id)
         try:
             embed = discord.Embed()
             embed.color = embed_color
             embed.set_footer(text=self.query)
 
-            samples, seed = self.text2image_model.translation(self.query, self.image, self.steps, 0.0, 1, 1, self.guidance_scale, denoising_strength=0.7, seed=-1, height=self.height, width=self.width)
+            request = JobRequest(interaction.user.id, interaction.guild_id, 'followup')
+            samples, (seed, *_) = await run_scheduled(self.scheduler, request, self.ctx.send_followup, 'translation', self.query, self.image, self.steps, 0.0, 1, 1, self.guidance_scale, denoising_strength=0.7, seed=-1, height=self.height, width=self.width, cancel=token, sampler=self.sampler, guidance_cutoff=self.guidance_cutoff, guidance_threshold=self.guidance_threshold)
 
-            with BytesIO() as buffer:
-                samples[0].save(buffer, 'PNG')
-                buffer.seek(0)
-                myView = MyView(self.ctx, self.query, samples[0], self.text2image_model, self.height, self.width, self.guidance_scale, self.steps, seed)
-                await self.ctx.send_followup(embed=embed, file=discord.File(fp=buffer, filename=f'{seed}.png'), view=myView)
+            file = await encode_file(self.postprocessor, samples[0], seed)
+            myView = MyView(self.ctx, self.query, samples[0], self.scheduler, self.postprocessor, self.height, self.width, self.guidance_scale, self.steps, seed, self.sampler, self.guidance_cutoff, self.guidance_threshold, self.job_timeout)
+            with observe_stage('discord_upload'):
+                await self.ctx.send_followup(embed=embed, file=file, view=myView)
         except Exception as e:
-            embed = discord.Embed(title='Make Variations failed', description=f'{e}\n{traceback.print_exc()}', color=embed_color)
+            embed = error_embed('Make Variations failed', e)
             await self.ctx.send_followup(embed=embed)
+        finally:
+            self.pending.pop(token, None)
 
     @discord.ui.button(custom_id="doover", label="New Generation", row=0, style=discord.ButtonStyle.secondary, emoji="🔃")
     async def doover_callback(self, button, interaction):
         await interaction.response.defer()
+        token = self.cancel_token(interaction.user.id)
         try:
             embed = discord.Embed()
             embed.color = embed_color
             embed.set_footer(text=self.query)
 
-            rng_seed = seed_everything(self.seed)
-            samples, seed = self.text2image_model.dream(self.query, self.steps, False, False, 0.0, 1, 1, self.guidance_scale, -1, self.height, self.width, False)
+            request = JobRequest(interaction.user.id, interaction.guild_id, 'followup')
+            samples, (seed, *_) = await run_scheduled(self.scheduler, request, self.ctx.send_followup, 'dream', self.query, self.steps, False, False, 0.0, 1, 1, self.guidance_scale, -1, self.height, self.width, False, cancel=token, sampler=self.sampler, guidance_cutoff=self.guidance_cutoff, guidance_threshold=self.guidance_threshold)
 
-            with BytesIO() as buffer:
-                samples[0].save(buffer, 'PNG')
-                buffer.seek(0)
-                myView = MyView(self.ctx, self.query, samples[0], self.text2image_model, self.height, self.width, self.guidance_scale, self.steps, seed)
-                await self.ctx.send_followup(embed=embed, file=discord.File(fp=buffer, filename=f'{seed}.png'), view=myView)
+            file = await encode_file(self.postprocessor, samples[0], seed)
+            myView = MyView(self.ctx, self.query, samples[0], self.scheduler, self.postprocessor, self.height, self.width, self.guidance_scale, self.steps, seed, self.sampler, self.guidance_cutoff, self.guidance_threshold, self.job_timeout)
+            with observe_stage('discord_upload'):
+                await self.ctx.send_followup(embed=embed, file=file, view=myView)
         except Exception as e:
-            embed = discord.Embed(title='New Generation failed', description=f'{e}\n{traceback.print_exc()}', color=embed_color)
+            embed = error_embed('New Generation failed', e)
             await self.ctx.send_followup(embed=embed)
+        finally:
+            self.pending.pop(token, None)
+
+    @discord.ui.button(custom_id="cancel", label="Cancel", row=0, style=discord.ButtonStyle.secondary, emoji="✖️")
+    async def cancel_callback(self, button, interaction):
+        # stops the variations and new generations this user started from here that haven't finished
+        tokens = [token for token, user in self.pending.items() if user == interaction.user.id]
+        for token in tokens:
+            token.cancel()
+        message = f'Cancelling {len(tokens)} job(s)' if tokens else 'Nothing of yours to cancel'
+        await interaction.response.send_message(message, ephemeral=True)
 
     async def on_error(self, error, item, interaction):
         await interaction.response.send_message(str(error))
 
 class StableCog(commands.Cog, name='Stable Diffusion', description='Create images from natural language.'):
     def __init__(self, bot):
-        self.text2image_model = Text2Image()
+        if bot.args.inference_url:
+            self.job_queue = InferenceClient.from_url(bot.args.inference_url)
+        else:
+            # only a bot that runs the models itself needs torch
+            from src.core.node import create_job_queue
+            self.job_queue = create_job_queue(bot.args.devices)
+        self.job_queue.start()
+        args = bot.args
+        slots = args.scheduler_slots or 4 * max(1, len(args.devices or ()))
+        self.scheduler = FairScheduler(self.job_queue, slots, args.user_quota / 60, args.user_burst, args.guild_quota / 60, args.guild_burst)
+        self.job_timeout = args.job_timeout
+        self.fetcher = ImageFetcher()
+        self.postprocessor = ImagePostProcessor(format=bot.args.image_format, workers=bot.args.image_workers)
+        self.result_cache = None
+        if bot.args.result_cache_size > 0:
+            self.result_cache = ResultCache(bot.args.result_cache_dir, int(bot.args.result_cache_size * 2**30), self.postprocessor.extension())
         self.bot = bot
 
+    def cog_unload(self):
+        self.job_queue.stop()
+        asyncio.ensure_future(self.fetcher.close())
+        self.postprocessor.close()
+
+    def cancel_token(self, ctx: discord.ApplicationContext) -> CancelToken:
+        return CancelToken(job_deadline(ctx.interaction, self.job_timeout))
+
+    async def schedule(self, ctx: discord.ApplicationContext, method: str, *args, **kwargs):
+        request = JobRequest(ctx.author.id, ctx.guild_id, 'prompt')
+        kwargs.setdefault('cancel', self.cancel_token(ctx))
+        return await run_scheduled(self.scheduler, request, ctx.send_followup, method, *args, **kwargs)
+
+    async def run_cached(self, params: dict, run: Callable[[], Awaitable[tuple]]) -> tuple:
+        # runs a job and encodes its image; with an explicit seed the result is deterministic, so
+        # it is served from the result cache and shared with identical requests in flight
+        result = {}
+
+        async def create() -> bytes:
+            samples, seeds = await run()
+            result['image'], result['seed'] = samples[0], seeds[0]
+            return await self.postprocessor.encode(samples[0])
+
+        seed = params['seed']
+        if self.result_cache is None or seed is None or seed < 0:
+            data = await create()
+        else:
+            key = await asyncio.to_thread(ResultCache.key, model=MODEL_REVISION, version=OUTPUT_VERSION, format=self.postprocessor.format, **params)
+            data = await self.result_cache.get_or_create(key, create)
+        if not result:
+            result['image'], result['seed'] = await asyncio.to_thread(decode_image, data), seed
+        return result['image'], result['seed'], data
+
     @commands.slash_command(description='Create a image from a natural language query.')
-    async def dream(self, ctx: discord.ApplicationContext, *, query: str, height: Optional[int]=512, width: Optional[int]=512, guidance_scale: Optional[float] = 7.0, steps: Optional[int] = 50, seed: Optional[int] = -1, progress: Optional[bool] = False):
+    async def dream(self, ctx: discord.ApplicationContext, *, query: str, height: Optional[int]=512, width: Optional[int]=512, guidance_scale: Optional[float] = 7.0, steps: Optional[int] = None, seed: Optional[int] = -1, progress: Optional[bool] = False, n_samples: Optional[int] = 1, n_iter: Optional[int] = 1, quality: Optional[str] = None, sampler: Optional[str] = None, guidance_cutoff: Optional[float] = None, guidance_threshold: Optional[float] = 0.0):
         print(f'Request -- {ctx.author.name}#{ctx.author.discriminator} -- Prompt: {query}')
         await ctx.defer()
         embed = discord.Embed()
@@ -103,38 +271,97 @@ class StableCog(commands.Cog, name='Stable Diffusion', description='Create image
         #await ctx.send_response(embed=embed)
 
         try:
-            if steps > 100:
-                steps = 100
-            samples, seed = self.text2image_model.dream(query, steps, False, False, 0.0, 1, 1, guidance_scale, seed, height, width, progress)
+            sampler, steps, guidance_cutoff = sampling('dream', quality, sampler, steps, guidance_cutoff)
+            n_iter, n_samples = image_counts(n_iter, n_samples)
+            if progress:
+                run = lambda: self.dream_with_previews(ctx, query, steps, guidance_scale, seed, height, width, n_iter, n_samples, sampler, guidance_cutoff, guidance_threshold)
+            else:
+                run = lambda: self.schedule(ctx, 'dream', query, steps, False, False, 0.0, n_iter, n_samples, guidance_scale, seed, height, width, False, sampler=sampler, guidance_cutoff=guidance_cutoff, guidance_threshold=guidance_threshold)
+            if n_iter * n_samples > 1:
+                samples, seeds = await run()
+                await self.send_images(ctx.send_followup, embed, samples, seeds)
+                return
 
-            with BytesIO() as buffer:
-                samples[0].save(buffer, 'PNG')
-                buffer.seek(0)
-                myView = MyView(ctx, query, samples[0], self.text2image_model, height, width, guidance_scale, steps, seed)
-                await ctx.send_followup(embed=embed, file=discord.File(fp=buffer, filename=f'{seed}.png'), view=myView)
+            params = dict(method='dream', prompt=query, seed=seed, steps=steps, sampler=sampler, guidance_cutoff=guidance_cutoff, guidance_threshold=guidance_threshold, guidance_scale=guidance_scale, height=height, width=width)
+            image, seed, data = await self.run_cached(params, run)
+
+            file = image_file(self.postprocessor, data, seed)
+            myView = MyView(ctx, query, image, self.scheduler, self.postprocessor, height, width, guidance_scale, steps, seed, sampler, guidance_cutoff, guidance_threshold, self.job_timeout)
+            with observe_stage('discord_upload'):
+                await ctx.send_followup(embed=embed, file=file, view=myView)
 
         except Exception as e:
-            embed = discord.Embed(title='txt2img failed', description=f'{e}\n{traceback.print_exc()}', color=embed_color)
+            embed = error_embed('txt2img failed', e)
             await ctx.send_response(embed=embed)
 
+    async def dream_with_previews(self, ctx: discord.ApplicationContext, query: str, steps: int, guidance_scale: float, seed: int, height: int, width: int, n_iter: int = 1, n_samples: int = 1, sampler: Optional[str] = None, guidance_cutoff: float = 1.0, guidance_threshold: float = 0.0):
+        preview = PreviewBuffer(mode='fast')
+        token = self.cancel_token(ctx)
+        embed = discord.Embed(title='Dreaming...', color=embed_color)
+        embed.set_footer(text=query)
+        message = await ctx.send_followup(embed=embed, view=CancelView(token, ctx.author.id), wait=True)
+        streamer = asyncio.create_task(self.stream_previews(message, embed, preview, steps, (width // 2, height // 2)))
+        try:
+            return await self.schedule(ctx, 'dream', query, steps, False, False, 0.0, n_iter, n_samples, guidance_scale, seed, height, width, True, preview=preview, cancel=token, sampler=sampler, guidance_cutoff=guidance_cutoff, guidance_threshold=guidance_threshold)
+        finally:
+            streamer.cancel()
+            await message.delete()
+
+    async def send_images(self, send, embed: discord.Embed, images: list, seeds: list):
+        # a grid to look at, plus every image under its own seed so any one can be redone alone
+        grid = await asyncio.to_thread(image_grid, images)
+        grid_name = f'grid-{seeds[0]}'
+        files = await asyncio.gather(
+            encode_file(self.postprocessor, grid, grid_name),
+            *[encode_file(self.postprocessor, image, seed) for image, seed in zip(images, seeds)]
+        )
+        embed.description = f'Seeds: {", ".join(str(seed) for seed in seeds)}'
+        embed.set_image(url=f'attachment://{grid_name}.{self.postprocessor.extension()}')
+        with observe_stage('discord_upload'):
+            await send(embed=embed, files=list(files))
+
+    async def stream_previews(self, message, embed: discord.Embed, preview: PreviewBuffer, steps: int, size: tuple, interval: float = 2.0):
+        # Discord allows roughly five edits per five seconds per message, so previews are
+        # pushed on a fixed schedule and skipped when nothing new was rendered
+        version = 0
+        while True:
+            await asyncio.sleep(interval)
+            latest = preview.latest()
+            if latest is None or preview.version == version:
+                continue
+            version = preview.version
+            step, image = latest
+            data = await self.postprocessor.encode(image, format='jpeg', size=size)
+            embed.title = f'Dreaming... step {step + 1}/{steps}'
+            embed.set_image(url='attachment://preview.jpg')
+            try:
+                await message.edit(embed=embed, file=discord.File(fp=BytesIO(data), filename='preview.jpg'), attachments=[])
+            except discord.HTTPException:
+                pass
+
     @commands.slash_command(description='Create an image from another image.')
-    async def translate(self, ctx: discord.ApplicationContext, *, query: str, image_url: str, denoising_strength: Optional[float]=0.7, height: Optional[int]=512, width: Optional[int]=512, guidance_scale: Optional[float] = 7.0, steps: Optional[int] = 50, seed: Optional[int] = -1):
+    async def translate(self, ctx: discord.ApplicationContext, *, query: str, image_url: str, denoising_strength: Optional[float]=0.7, height: Optional[int]=512, width: Optional[int]=512, guidance_scale: Optional[float] = 7.0, steps: Optional[int] = None, seed: Optional[int] = -1, n_samples: Optional[int] = 1, n_iter: Optional[int] = 1, quality: Optional[str] = None, sampler: Optional[str] = None, guidance_cutoff: Optional[float] = None, guidance_threshold: Optional[float] = 0.0):
         print(f'Request -- {ctx.author.name}#{ctx.author.discriminator} -- Prompt: {query}')
         await ctx.defer()
         embed = discord.Embed()
         embed.color = embed_color
         embed.set_footer(text=query)
         try:
-            if steps > 100:
-                steps = 100
-            image = Image.open(requests.get(image_url, stream=True).raw).convert('RGB')
-            samples, seed = self.text2image_model.translation(query, image, steps, 0.0, 1, 1, guidance_scale, denoising_strength=denoising_strength, seed=seed, height=height, width=width)
-            with BytesIO() as buffer:
-                samples[0].save(buffer, 'PNG')
-                buffer.seek(0)
-                await ctx.followup.send(embed=embed, file=discord.File(fp=buffer, filename=f'{seed}.png'))
+            sampler, steps, guidance_cutoff = sampling('translate', quality, sampler, steps, guidance_cutoff)
+            image = await self.fetcher.fetch_image(image_url, 'RGB')
+            n_iter, n_samples = image_counts(n_iter, n_samples)
+            if n_iter * n_samples > 1:
+                samples, seeds = await self.schedule(ctx, 'translation', query, image, steps, 0.0, n_iter, n_samples, guidance_scale, denoising_strength=denoising_strength, seed=seed, height=height, width=width, sampler=sampler, guidance_cutoff=guidance_cutoff, guidance_threshold=guidance_threshold)
+                await self.send_images(ctx.followup.send, embed, samples, seeds)
+                return
+
+            params = dict(method='translation', prompt=query, init_image=image, seed=seed, steps=steps, sampler=sampler, guidance_cutoff=guidance_cutoff, guidance_threshold=guidance_threshold, guidance_scale=guidance_scale, denoising_strength=denoising_strength, height=height, width=width)
+            _, seed, data = await self.run_cached(params, lambda: self.schedule(ctx, 'translation', query, image, steps, 0.0, 1, 1, guidance_scale, denoising_strength=denoising_strength, seed=seed, height=height, width=width, sampler=sampler, guidance_cutoff=guidance_cutoff, guidance_threshold=guidance_threshold))
+            file = image_file(self.postprocessor, data, seed)
+            with observe_stage('discord_upload'):
+                await ctx.followup.send(embed=embed, file=file)
         except Exception as e:
-            embed = discord.Embed(title='img2img failed', description=f'{e}\n{traceback.print_exc()}', color=embed_color)
+            embed = error_embed('img2img failed', e)
             await ctx.followup.send(embed=embed)
     
     @commands.message_command(name='Refine')
@@ -147,14 +374,16 @@ class StableCog(commands.Cog, name='Stable Diffusion', description='Create image
                 raise Exception('Not an AI generated image')
             query = message.embeds[0].footer.text
             embed.set_footer(text=query)
-            image = Image.open(requests.get(message.attachments[0].url, stream=True).raw).convert('RGB')
-            samples, seed = self.text2image_model.translation(query, image, 40, 0.0, 1, 1, 7.0, denoising_strength=0.4, seed=-1, height=image.height, width=image.width)
-            with BytesIO() as buffer:
-                samples[0].save(buffer, 'PNG')
-                buffer.seek(0)
-                await ctx.followup.send(embed=embed, file=discord.File(fp=buffer, filename=f'{seed}.png'))
+            image = await self.fetcher.fetch_image(message.attachments[0].url, 'RGB')
+            # the VAE and UNet need sizes divisible by 8
+            height, width = image.height - image.height % 8, image.width - image.width % 8
+            sampler, steps, guidance_cutoff = sampling('refine')
+            samples, (seed, *_) = await self.schedule(ctx, 'translation', query, image, steps, 0.0, 1, 1, 7.0, denoising_strength=0.4, seed=-1, height=height, width=width, sampler=sampler, guidance_cutoff=guidance_cutoff)
+            file = await encode_file(self.postprocessor, samples[0], seed)
+            with observe_stage('discord_upload'):
+                await ctx.followup.send(embed=embed, file=file)
         except Exception as e:
-            embed = discord.Embed(title='refinement failed', description=f'{e}\n{traceback.print_exc()}', color=embed_color)
+            embed = error_embed('refinement failed', e)
             await ctx.followup.send(embed=embed)
     
     @commands.message_command(name='Psychedelico')
@@ -165,53 +394,64 @@ class StableCog(commands.Cog, name='Stable Diffusion', description='Create image
         try:
             if not message.attachments:
                 raise Exception('Not an image')
-            image = Image.open(requests.get(message.attachments[0].url, stream=True).raw).convert('RGB')
-            samples, seed = self.text2image_model.translation('fractal rendered image in colorful psychedelic style. dmt lsd drugs. hallucinations bad trip.', image, 40, 0.0, 1, 1, 7.0, denoising_strength=0.75, seed=-1, height=512, width=512)
-            with BytesIO() as buffer:
-                samples[0].save(buffer, 'PNG')
-                buffer.seek(0)
-                await ctx.followup.send(file=discord.File(fp=buffer, filename=f'{seed}.png'))
+            image = await self.fetcher.fetch_image(message.attachments[0].url, 'RGB')
+            sampler, steps, guidance_cutoff = sampling('psychedelico')
+            samples, (seed, *_) = await self.schedule(ctx, 'translation', 'fractal rendered image in colorful psychedelic style. dmt lsd drugs. hallucinations bad trip.', image, steps, 0.0, 1, 1, 7.0, denoising_strength=0.75, seed=-1, height=512, width=512, sampler=sampler, guidance_cutoff=guidance_cutoff)
+            file = await encode_file(self.postprocessor, samples[0], seed)
+            with observe_stage('discord_upload'):
+                await ctx.followup.send(file=file)
         except Exception as e:
-            embed = discord.Embed(title='trip failed', description=f'{e}\n{traceback.print_exc()}', color=embed_color)
+            embed = error_embed('trip failed', e)
             await ctx.followup.send(embed=embed)
 
     
     @commands.slash_command(description='Fill empty gaps in an image.')
-    @commands.max_concurrency(5, per=commands.BucketType.default, wait=False)
-    async def inpaint(self, ctx: discord.ApplicationContext, *, query: str, image_url: str, mask_url: str, denoising_strength: Optional[float]=0.7, height: Optional[int]=512, width: Optional[int]=512, guidance_scale: Optional[float] = 7.0, steps: Optional[int] = 50, seed: Optional[int] = -1):
+    async def inpaint(self, ctx: discord.ApplicationContext, *, query: str, image_url: str, mask_url: str, denoising_strength: Optional[float]=0.7, height: Optional[int]=512, width: Optional[int]=512, guidance_scale: Optional[float] = 7.0, steps: Optional[int] = None, seed: Optional[int] = -1, n_samples: Optional[int] = 1, n_iter: Optional[int] = 1, quality: Optional[str] = None, sampler: Optional[str] = None, guidance_cutoff: Optional[float] = None, guidance_threshold: Optional[float] = 0.0, crop: Optional[bool] = True):
         await ctx.defer()
         embed = discord.Embed()
         embed.color = embed_color
         embed.set_footer(text=query)
         try:
-            image = Image.open(requests.get(image_url, stream=True).raw).convert('RGBA')
-            mask_image = Image.open(requests.get(mask_url, stream=True).raw).convert('RGBA')
-            samples, seed = self.text2image_model.inpaint(query, image, mask_image, steps, 0.0, 1, 1, guidance_scale, denoising_strength=denoising_strength, seed=seed, height=height, width=width)
+            sampler, steps, guidance_cutoff = sampling('inpaint', quality, sampler, steps, guidance_cutoff)
+            image, mask_image = await asyncio.gather(
+                self.fetcher.fetch_image(image_url, 'RGBA'),
+                self.fetcher.fetch_image(mask_url, 'RGBA')
+            )
+            if crop:
+                # found once, off the event loop; the queue prices the job by it and the job reuses it
+                region = await asyncio.to_thread(lambda: crop_region(repaint_mask(mask_image, image.size), (width, height)))
+                crop = region if region is not None else True
+            n_iter, n_samples = image_counts(n_iter, n_samples)
+            if n_iter * n_samples > 1:
+                samples, seeds = await self.schedule(ctx, 'inpaint', query, image, mask_image, steps, 0.0, n_iter, n_samples, guidance_scale, denoising_strength=denoising_strength, seed=seed, height=height, width=width, sampler=sampler, guidance_cutoff=guidance_cutoff, guidance_threshold=guidance_threshold, crop=crop)
+                await self.send_images(ctx.followup.send, embed, samples, seeds)
+                return
+
+            params = dict(method='inpaint', prompt=query, init_image=image, mask_image=mask_image, seed=seed, steps=steps, sampler=sampler, guidance_cutoff=guidance_cutoff, guidance_threshold=guidance_threshold, guidance_scale=guidance_scale, denoising_strength=denoising_strength, height=height, width=width, crop=crop)
+            _, seed, data = await self.run_cached(params, lambda: self.schedule(ctx, 'inpaint', query, image, mask_image, steps, 0.0, 1, 1, guidance_scale, denoising_strength=denoising_strength, seed=seed, height=height, width=width, sampler=sampler, guidance_cutoff=guidance_cutoff, guidance_threshold=guidance_threshold, crop=crop))
 
             embed.title = None
             embed.description = None
             embed.set_footer(text=query)
 
-            with BytesIO() as buffer:
-                samples[0].save(buffer, 'PNG')
-                buffer.seek(0)
-                await ctx.followup.send(embed=embed, file=discord.File(fp=buffer, filename=f'{seed}.png'))
+            file = image_file(self.postprocessor, data, seed)
+            with observe_stage('discord_upload'):
+                await ctx.followup.send(embed=embed, file=file)
         except Exception as e:
-            embed = discord.Embed(title='inpaint failed', description=f'{e}\n{traceback.print_exc()}', color=embed_color)
+            embed = error_embed('inpaint failed', e)
             await ctx.followup.send(embed=embed)
     
     @commands.slash_command(description='Test what an image looks like from the model\'s perspective')
     async def vae(self, ctx: discord.ApplicationContext, *, image_url: str, height: Optional[int]=512, width: Optional[int]=512):
         await ctx.defer()
         try:
-            image = Image.open(requests.get(image_url, stream=True).raw).convert('RGBA')
-            samples = self.text2image_model.vae_test(image, height, width)
-            with BytesIO() as buffer:
-                samples[0].save(buffer, 'PNG')
-                buffer.seek(0)
-                await ctx.followup.send(file=discord.File(fp=buffer, filename=f'decoded.png'))
+            image = await self.fetcher.fetch_image(image_url, 'RGBA')
+            samples = await self.schedule(ctx, 'vae_test', image, height, width)
+            file = await encode_file(self.postprocessor, samples[0], 'decoded')
+            with observe_stage('discord_upload'):
+                await ctx.followup.send(file=file)
         except Exception as e:
-            embed = discord.Embed(title='vae failed', description=f'{e}\n{traceback.print_exc()}', color=embed_color)
+            embed = error_embed('vae failed', e)
             await ctx.followup.send(embed=embed)
 
 def setup(bot):
@@ -0,0 +1,114 @@
+import asyncio
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from multiprocessing.shared_memory import SharedMemory
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+from src.core.logging import get_logger, log_queue, log_to_queue
+from src.core.metrics import observe_stage
+
+logger = get_logger(__name__)
+
+# Pillow format name, file extension and default save options for each output format; PNG
+# uses a fast zlib level since Discord re-serves the file anyway
+FORMATS = {
+    'png': ('PNG', 'png', {'compress_level': 1}),
+    'webp': ('WEBP', 'webp', {'lossless': True, 'method': 2}),
+    'jpeg': ('JPEG', 'jpg', {'quality': 80}),
+}
+
+
+def _process(name: str, shape: tuple, mode: str, size: Optional[tuple], fmt: str, options: dict) -> bytes:
+    shm = SharedMemory(name=name)
+    try:
+        pixels = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        image = Image.fromarray(pixels, mode)
+        if size is not None and size != image.size:
+            LANCZOS = (Image.Resampling.LANCZOS if hasattr(Image, 'Resampling') else Image.LANCZOS)
+            image = image.resize(size, resample=LANCZOS)
+        if fmt == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        with BytesIO() as buffer:
+            image.save(buffer, fmt, **options)
+            data = buffer.getvalue()
+        # views into the shared block must be gone before it can be closed
+        del image, pixels
+        return data
+    finally:
+        shm.close()
+
+
+def image_grid(images: list, columns: Optional[int] = None) -> Image.Image:
+    # tiles images of the same size into a roughly square grid, row by row
+    columns = columns or math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / columns)
+    width, height = images[0].size
+    grid = Image.new('RGB', (columns * width, rows * height))
+    for i, image in enumerate(images):
+        grid.paste(image, ((i % columns) * width, (i // columns) * height))
+    return grid
+
+
+class ImagePostProcessor:
+    """Resizes and encodes result images in a pool of worker processes.
+
+    Pixels are handed to the workers through shared memory instead of pickling PIL images; only
+    the (much smaller) encoded bytes come back.
+    """
+
+    def __init__(self, format: str = 'png', workers: int = 2):
+        if format not in FORMATS:
+            raise ValueError(f'Unknown image format {format}, expected one of {", ".join(FORMATS)}')
+        self.format = format
+        self.workers = workers
+        self._pool = None
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn keeps CUDA and the model weights out of the workers
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'), initializer=log_to_queue, initargs=(log_queue(),))
+        return self._pool
+
+    def extension(self, format: Optional[str] = None) -> str:
+        return FORMATS[format or self.format][1]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def encode(self, image: Image.Image, format: Optional[str] = None, size: Optional[tuple] = None, **options) -> bytes:
+        fmt, _, defaults = FORMATS[format or self.format]
+        options = {**defaults, **options}
+
+        if image.mode not in ('RGB', 'RGBA', 'L'):
+            image = image.convert('RGB')
+        pixels = np.asarray(image)
+
+        with observe_stage('png_encode' if fmt == 'PNG' else 'image_encode'):
+            shm = SharedMemory(create=True, size=max(pixels.nbytes, 1))
+            try:
+                shared = np.ndarray(pixels.shape, dtype=np.uint8, buffer=shm.buf)
+                shared[:] = pixels
+                del shared
+                return await self._submit(shm.name, pixels.shape, image.mode, size, fmt, options)
+            finally:
+                shm.close()
+                shm.unlink()
+
+    async def _submit(self, *args) -> bytes:
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.pool, _process, *args)
+        except BrokenProcessPool:
+            logger.error('Image worker pool died, restarting it')
+            self._pool = None
+            return await loop.run_in_executor(self.pool, _process, *args)
@@ -0,0 +1,235 @@
+import asyncio
+import queue
+import threading
+import time
+from collections import deque
+
+from src.core.logging import get_logger
+from src.core.metrics import CANCELLED_STEPS, JOB_RUN_SECONDS, JOB_WAIT_SECONDS, JOBS_IN_FLIGHT, JOBS_TOTAL, QUEUE_DEPTH, track_device_memory
+from src.stablediffusion.cancellation import JobCancelled, cancel_reason, cancel_tokens, release_device_memory
+from src.stablediffusion.jobs import JOB_METHODS
+
+logger = get_logger(__name__)
+
+
+class UnknownMethodError(Exception):
+    pass
+
+
+def check_method(method: str):
+    if method not in JOB_METHODS:
+        raise UnknownMethodError(f'Unknown job method {method!r}, expected one of {", ".join(JOB_METHODS)}')
+
+
+def _resolve(future, result, exception):
+    if future.done():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+
+class Job:
+    def __init__(self, method: str, args: tuple, kwargs: dict, loop: asyncio.AbstractEventLoop):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.loop = loop
+        self.future = loop.create_future()
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def wait_time(self) -> float:
+        end = self.started_at if self.started_at is not None else time.monotonic()
+        return end - self.enqueued_at
+
+    @property
+    def run_time(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        return end - self.started_at
+
+    def set_result(self, result):
+        self.finished_at = time.monotonic()
+        self.loop.call_soon_threadsafe(_resolve, self.future, result, None)
+
+    def set_exception(self, exception):
+        self.finished_at = time.monotonic()
+        self.loop.call_soon_threadsafe(_resolve, self.future, None, exception)
+
+
+class JobQueue:
+    """Runs model calls on a dedicated worker thread so the event loop never blocks on inference.
+
+    The worker thread builds the model with ``model_factory`` and owns it for its whole life;
+    handlers submit a method name plus arguments and await the returned future. With a
+    ``batcher``, compatible jobs arriving within its window are run together as one batch.
+    Cancelling ``run`` also cancels any ``CancelToken`` among the job's arguments, which stops it
+    at the next denoising step if it is already running.
+    """
+
+    def __init__(self, model_factory, batcher=None, history: int = 100):
+        self.model_factory = model_factory
+        self.batcher = batcher
+        self.model = None
+        self.wait_times = deque(maxlen=history)
+        self.batch_sizes = deque(maxlen=history)
+        self._jobs = queue.Queue()
+        self._deferred = deque()
+        self._in_flight = 0
+        self._thread = threading.Thread(target=self._run, name='inference-worker', daemon=True)
+
+    def start(self):
+        QUEUE_DEPTH.set_function(lambda: self.depth)
+        JOBS_IN_FLIGHT.set_function(lambda: self.in_flight)
+        self._thread.start()
+
+    def stop(self):
+        self._jobs.put(None)
+
+    @property
+    def depth(self) -> int:
+        return self._jobs.qsize() + len(self._deferred)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def average_wait(self) -> float:
+        if not self.wait_times:
+            return 0.0
+        return sum(self.wait_times) / len(self.wait_times)
+
+    def submit(self, method: str, *args, **kwargs) -> Job:
+        job = Job(method, args, kwargs, asyncio.get_running_loop())
+        self._jobs.put(job)
+        return job
+
+    async def run(self, method: str, *args, **kwargs):
+        job = self.submit(method, *args, **kwargs)
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            for token in cancel_tokens(kwargs):
+                token.cancel()
+            raise
+
+    def _load(self):
+        self.model = self.model_factory()
+
+    def _run(self):
+        load_error = None
+        try:
+            self._load()
+        except Exception as e:
+            logger.error(f'Failed to load model: {e}')
+            load_error = e
+
+        while True:
+            job = self._next_job()
+            if job is None:
+                break
+            if load_error is not None:
+                job.set_exception(load_error)
+                continue
+            if job.future.cancelled():
+                continue
+            reason = cancel_reason(job.kwargs)
+            if reason is not None:
+                self._start_jobs([job])
+                self._finish_jobs([job], None, JobCancelled(0, None, reason))
+                continue
+
+            key = self.batcher.key(job) if self.batcher is not None else None
+            if key is None:
+                self._execute([job])
+            else:
+                self._execute(self._collect_batch(job, key))
+
+    def _next_job(self):
+        if self._deferred:
+            return self._deferred.popleft()
+        return self._jobs.get()
+
+    def _collect_batch(self, job: Job, key):
+        batch = [job]
+        for other in list(self._deferred):
+            if len(batch) >= self.batcher.max_batch_size:
+                return batch
+            if other is not None and self.batcher.key(other) == key:
+                self._deferred.remove(other)
+                batch.append(other)
+
+        deadline = time.monotonic() + self.batcher.window
+        while len(batch) < self.batcher.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                other = self._jobs.get(timeout=remaining)
+            except queue.Empty:
+                break
+            # jobs that can't join this batch keep their place in line for the next round
+            if other is None or self.batcher.key(other) != key:
+                self._deferred.append(other)
+                if other is None:
+                    break
+            else:
+                batch.append(other)
+        return [job for job in batch if not job.future.cancelled()]
+
+    def _execute(self, jobs: list):
+        if not jobs:
+            return
+        self._start_jobs(jobs)
+        method = jobs[0].method
+        results, error = None, None
+        try:
+            check_method(method)
+            with track_device_memory(method):
+                if len(jobs) == 1:
+                    job = jobs[0]
+                    results = [getattr(self.model, job.method)(*job.args, **job.kwargs)]
+                else:
+                    results = self.batcher.run(self.model, jobs)
+        except JobCancelled as e:
+            release_device_memory(e)
+            error = e
+        except Exception as e:
+            error = e
+        self._finish_jobs(jobs, results, error)
+
+    def _start_jobs(self, jobs: list):
+        started_at = time.monotonic()
+        for job in jobs:
+            job.started_at = started_at
+            self.wait_times.append(job.wait_time)
+            JOB_WAIT_SECONDS.observe(job.wait_time, method=job.method)
+        self.batch_sizes.append(len(jobs))
+        self._in_flight += len(jobs)
+
+    def _finish_jobs(self, jobs: list, results, error: Exception = None):
+        method = jobs[0].method
+        if error is None:
+            outcome = 'success'
+            for job, result in zip(jobs, results):
+                job.set_result(result)
+        else:
+            if isinstance(error, JobCancelled):
+                outcome = 'cancelled'
+                logger.info(f'Job {method} x{len(jobs)}: {error}')
+                CANCELLED_STEPS.inc(error.steps_saved * len(jobs), reason=error.reason)
+            else:
+                outcome = 'error'
+                logger.error(f'Job {method} failed: {error}')
+            for job in jobs:
+                job.set_exception(error)
+        self._in_flight -= len(jobs)
+        JOB_RUN_SECONDS.observe(jobs[0].run_time, method=method)
+        JOBS_TOTAL.inc(len(jobs), method=method, outcome=outcome)
+        logger.info(f'Job {method} x{len(jobs)} waited {max(job.wait_time for job in jobs):.2f}s, ran {jobs[0].run_time:.2f}s (queue depth {self.depth})')
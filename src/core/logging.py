@@ -1,10 +1,43 @@
+import atexit
 import logging
+import multiprocessing
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-logging.basicConfig(level=logging.INFO,
-                    format='[%(asctime)s] %(levelname)s: %(message)s',
-                    datefmt='%Y-%m-%d %H:%M:%S',
-                    filename='log.txt',
-                    filemode='w')
+_listener = None
+
+
+class _Forward(logging.Handler):
+    # hands records from child processes to the parent's own loggers
+    def emit(self, record):
+        logging.getLogger(record.name).handle(record)
+
+
+def log_queue():
+    """The queue spawned child processes log through, see ``log_to_queue``. Only the main process
+    writes log.txt, since one rotating file can't be shared between processes."""
+    global _listener
+    if _listener is None:
+        _listener = QueueListener(multiprocessing.get_context('spawn').Queue(), _Forward())
+        _listener.start()
+        atexit.register(_listener.stop)
+    return _listener.queue
+
+
+def log_to_queue(queue):
+    # run first thing in a child process
+    root = logging.getLogger()
+    root.handlers[:] = [QueueHandler(queue)]
+    root.setLevel(logging.INFO)
+
+
+# a spawned child already carries its own name while it imports this, but parent_process() is
+# only set once its target runs
+if multiprocessing.current_process().name == 'MainProcess':
+    # the log is appended to across restarts, so it is rotated rather than left to grow forever
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname)s: %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        handlers=[RotatingFileHandler('log.txt', maxBytes=10 * 1024 * 1024, backupCount=5)])
 
 def get_logger(name):
-    return logging.getLogger(name)
\ No newline at end of file
+    return logging.getLogger(name)
@@ -0,0 +1,241 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional, Sequence
+
+from src.core.logging import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[tuple] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(ABC):
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labels):
+            raise ValueError(f'{self.name} expects labels {self.labels}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self) -> list:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}'] + self.samples()
+
+    @abstractmethod
+    def samples(self) -> list:
+        pass
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self):
+        with self._lock:
+            return [f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}' for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+        self._functions = {}
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function: Callable[[], float], **labels):
+        # evaluated at scrape time, for values that live elsewhere such as queue depth
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = function
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, function in functions.items():
+            try:
+                values[key] = function()
+            except Exception as e:
+                logger.error(f'Gauge {self.name} failed: {e}')
+        return [f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}' for key, value in values.items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._counts = {}
+        self._sums = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._sums[key] = self._sums.get(key, 0.0) + value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        counts = self._counts.get(self._key(labels))
+        return counts[-1] if counts else 0
+
+    def samples(self):
+        lines = []
+        with self._lock:
+            for key, counts in self._counts.items():
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, ("le", _format_value(bound)))} {count}')
+                lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {_format_value(self._sums[key])}')
+                lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {counts[-1]}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: Metric) -> Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labels=()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()) -> Gauge:
+        return self._register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram('shanghai_stage_seconds', 'Time spent in each stage of a request.', ['stage'])
+DENOISE_STEP_SECONDS = registry.histogram('shanghai_denoise_step_seconds', 'Time per denoising step (UNet plus scheduler).', ['mode'], buckets=(0.01, 0.025, 0.05, 0.1, 0.2, 0.4, 0.8, 1.6, 3.2))
+JOB_WAIT_SECONDS = registry.histogram('shanghai_job_wait_seconds', 'Time jobs spend queued before a worker picks them up.', ['method'])
+JOB_RUN_SECONDS = registry.histogram('shanghai_job_run_seconds', 'Time jobs spend running on a worker.', ['method'])
+JOB_PEAK_MEMORY_BYTES = registry.histogram('shanghai_job_peak_memory_bytes', 'Peak device memory allocated while a job ran.', ['method'], buckets=tuple(2**30 * n for n in (0.5, 1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 48, 80)))
+QUEUE_DEPTH = registry.gauge('shanghai_queue_depth', 'Jobs waiting for a worker.')
+JOBS_IN_FLIGHT = registry.gauge('shanghai_jobs_in_flight', 'Jobs currently running on a worker.')
+COMPONENT_STARTUP_SECONDS = registry.gauge('shanghai_component_startup_seconds', 'Cold-start time of each model component, split into loading and warmup.', ['component', 'phase'])
+OFFLOAD_SECONDS = registry.histogram('shanghai_offload_seconds', 'Time stages waited for offloaded weights to come back to the device.', ['component'], buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+OFFLOAD_BYTES = registry.counter('shanghai_offload_bytes_total', 'Bytes of weights copied back to the device after being offloaded.', ['component'])
+SCHEDULER_DEPTH = registry.gauge('shanghai_scheduler_depth', 'Jobs waiting in the fair scheduler for a slot in the queue.')
+SCHEDULER_WAIT_SECONDS = registry.histogram('shanghai_scheduler_wait_seconds', 'Time jobs wait in the fair scheduler before they are handed to the queue.', ['priority'])
+JOBS_REJECTED = registry.counter('shanghai_jobs_rejected_total', 'Jobs refused because a user or guild quota was used up.', ['scope'])
+RESULT_CACHE_REQUESTS = registry.counter('shanghai_result_cache_requests_total', 'Cacheable requests, by whether they were served from disk, shared a run already in flight or missed.', ['outcome'])
+JOBS_TOTAL = registry.counter('shanghai_jobs_total', 'Jobs finished, by method and outcome.', ['method', 'outcome'])
+CANCELLED_STEPS = registry.counter('shanghai_cancelled_steps_total', 'Denoising steps not run because their job was cancelled or ran out of time.', ['reason'])
+GUIDANCE_SKIPPED_STEPS = registry.counter('shanghai_guidance_skipped_steps_total', 'Denoising steps that ran the UNet without guidance, on the conditional half only.', ['mode'])
+
+
+def observe_stage(stage: str):
+    return STAGE_SECONDS.time(stage=stage)
+
+
+@contextmanager
+def track_device_memory(method: str):
+    try:
+        import torch
+        cuda = torch.cuda.is_available()
+    except ImportError:
+        cuda = False
+
+    if cuda:
+        torch.cuda.reset_peak_memory_stats()
+    try:
+        yield
+    finally:
+        if cuda:
+            JOB_PEAK_MEMORY_BYTES.observe(torch.cuda.max_memory_allocated(), method=method)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = registry
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True)
+    thread.start()
+    logger.info(f'Serving metrics on http://{host}:{port}/metrics')
+    return server
@@ -0,0 +1,39 @@
+import asyncio
+from functools import partial
+from typing import Optional
+
+from src.core.jobqueue import JobQueue
+from src.core.logging import get_logger
+from src.core.remote import DEFAULT_PORT, InferenceNode
+from src.core.protocol import parse_address
+from src.core.workerpool import WorkerPool
+from src.stablediffusion.batching import DreamBatcher
+from src.stablediffusion.text2image_diffusers import Text2Image
+
+logger = get_logger(__name__)
+
+
+def create_job_queue(devices: Optional[list] = None) -> JobQueue:
+    model_factory = partial(Text2Image, warmup=True)
+    if devices:
+        return WorkerPool(model_factory, devices, batcher=DreamBatcher())
+    return JobQueue(model_factory, batcher=DreamBatcher())
+
+
+async def serve(listen: str, devices: Optional[list] = None):
+    job_queue = create_job_queue(devices)
+    job_queue.start()
+    host, port = parse_address(listen, DEFAULT_PORT)
+    server = await InferenceNode(job_queue).listen(host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        job_queue.stop()
+
+
+def run_node(listen: str, devices: Optional[list] = None):
+    try:
+        asyncio.run(serve(listen, devices))
+    except KeyboardInterrupt:
+        logger.info('Keyboard interrupt received. Stopping inference node.')
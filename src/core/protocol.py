@@ -0,0 +1,177 @@
+import asyncio
+import json
+import struct
+from abc import ABC, abstractmethod
+from io import BytesIO
+from typing import Optional
+
+from PIL import Image
+
+# a frame is a 4 byte big-endian length and a JSON header, followed by the binary blobs the
+# header refers to, each again prefixed with its length
+LENGTH = struct.Struct('>I')
+MAX_HEADER_BYTES = 1024 * 1024
+MAX_BLOB_BYTES = 64 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class ConnectionClosed(Exception):
+    pass
+
+
+def pack(value, blobs: list):
+    """Turns a job argument or result into JSON-safe data; images go into ``blobs`` as PNG bytes."""
+    if isinstance(value, Image.Image):
+        with BytesIO() as buffer:
+            value.save(buffer, 'PNG', compress_level=1)
+            blobs.append(buffer.getvalue())
+        return {'__image__': len(blobs) - 1}
+    if isinstance(value, tuple):
+        return {'__tuple__': [pack(item, blobs) for item in value]}
+    if isinstance(value, list):
+        return [pack(item, blobs) for item in value]
+    if isinstance(value, dict):
+        return {str(key): pack(item, blobs) for key, item in value.items()}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    raise ProtocolError(f'Cannot send a {type(value).__name__} to an inference node')
+
+
+def unpack(value, blobs: list):
+    if isinstance(value, list):
+        return [unpack(item, blobs) for item in value]
+    if isinstance(value, dict):
+        if '__image__' in value:
+            image = Image.open(BytesIO(blobs[value['__image__']]))
+            image.load()
+            return image
+        if '__tuple__' in value:
+            return tuple(unpack(item, blobs) for item in value['__tuple__'])
+        return {key: unpack(item, blobs) for key, item in value.items()}
+    return value
+
+
+def encode_frame(message: dict, blobs: list = ()) -> bytes:
+    header = json.dumps({**message, 'blobs': len(blobs)}).encode('utf-8')
+    parts = [LENGTH.pack(len(header)), header]
+    for blob in blobs:
+        parts.append(LENGTH.pack(len(blob)))
+        parts.append(blob)
+    return b''.join(parts)
+
+
+class Connection(ABC):
+    """One end of a job protocol connection. Subclasses move whole frames; ``send`` and
+    ``receive`` deal in ``(message, blobs)``."""
+
+    async def send(self, message: dict, blobs: list = ()):
+        await self.write_frame(encode_frame(message, blobs))
+
+    async def receive(self) -> tuple:
+        return await self.read_frame()
+
+    @abstractmethod
+    async def write_frame(self, frame: bytes):
+        pass
+
+    @abstractmethod
+    async def read_frame(self) -> tuple:
+        pass
+
+    async def close(self):
+        pass
+
+
+class StreamConnection(Connection):
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def open(cls, host: str, port: int) -> 'StreamConnection':
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def write_frame(self, frame: bytes):
+        if self.writer.is_closing():
+            raise ConnectionClosed('Connection is closed')
+        # one write per frame keeps frames from interleaving between concurrent senders
+        self.writer.write(frame)
+        try:
+            await self.writer.drain()
+        except (ConnectionError, OSError) as e:
+            raise ConnectionClosed(str(e))
+
+    async def _read_length(self, limit: int) -> int:
+        length, = LENGTH.unpack(await self.reader.readexactly(LENGTH.size))
+        if length > limit:
+            raise ProtocolError(f'Frame part of {length} bytes is over the {limit} byte limit')
+        return length
+
+    async def read_frame(self) -> tuple:
+        try:
+            header = json.loads(await self.reader.readexactly(await self._read_length(MAX_HEADER_BYTES)))
+            blobs = []
+            for _ in range(header.pop('blobs', 0)):
+                blobs.append(await self.reader.readexactly(await self._read_length(MAX_BLOB_BYTES)))
+            return header, blobs
+        except (asyncio.IncompleteReadError, ConnectionError, OSError) as e:
+            raise ConnectionClosed(str(e) or 'Connection closed')
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+
+class LocalConnection(Connection):
+    """In-process stand-in for a socket. Frames are still fully encoded and decoded, so the
+    protocol is exercised end to end without any networking."""
+
+    def __init__(self, inbox: asyncio.Queue, outbox: asyncio.Queue):
+        self.inbox = inbox
+        self.outbox = outbox
+        self.closed = False
+
+    @classmethod
+    def pair(cls) -> tuple:
+        a, b = asyncio.Queue(), asyncio.Queue()
+        return cls(a, b), cls(b, a)
+
+    async def write_frame(self, frame: bytes):
+        if self.closed:
+            raise ConnectionClosed('Connection is closed')
+        await self.outbox.put(frame)
+
+    async def read_frame(self) -> tuple:
+        frame = await self.inbox.get()
+        if frame is None:
+            self.closed = True
+            raise ConnectionClosed('Connection closed')
+        reader = asyncio.StreamReader()
+        reader.feed_data(frame)
+        reader.feed_eof()
+        return await StreamConnection(reader, None).read_frame()
+
+    async def close(self):
+        if not self.closed:
+            self.closed = True
+            await self.outbox.put(None)
+
+
+def parse_address(address: str, default_port: Optional[int] = None) -> tuple:
+    if '://' in address:
+        scheme, address = address.split('://', 1)
+        if scheme != 'tcp':
+            raise ValueError(f'Unsupported inference transport {scheme}')
+    host, _, port = address.rpartition(':')
+    if not host:
+        if default_port is None:
+            raise ValueError(f'No port in {address}')
+        return address, default_port
+    return host, int(port)
@@ -0,0 +1,233 @@
+import asyncio
+import itertools
+from typing import Awaitable, Callable
+
+from src.core.jobqueue import JobQueue, check_method
+from src.core.logging import get_logger
+from src.core.metrics import JOBS_IN_FLIGHT
+from src.core.protocol import Connection, ConnectionClosed, StreamConnection, pack, parse_address, unpack
+from src.stablediffusion.cancellation import CancelToken, JobCancelled, cancel_tokens
+from src.stablediffusion.preview import PreviewBuffer
+
+logger = get_logger(__name__)
+
+DEFAULT_PORT = 5151
+
+
+class RemoteJobError(Exception):
+    pass
+
+
+def _pack_job(job_id: int, method: str, args: tuple, kwargs: dict) -> tuple:
+    blobs = []
+    previews = {}
+    cancels = {}
+    packed_kwargs = {}
+    for name, value in kwargs.items():
+        if isinstance(value, PreviewBuffer):
+            previews[name] = {'mode': value.mode, 'every': value.every, 'max_frames': value.max_frames}
+        elif isinstance(value, CancelToken):
+            cancels[name] = {'deadline': value.deadline}
+        else:
+            packed_kwargs[name] = pack(value, blobs)
+    message = {'type': 'job', 'id': job_id, 'method': method, 'args': pack(list(args), blobs), 'kwargs': packed_kwargs, 'previews': previews, 'cancels': cancels}
+    return message, blobs
+
+
+class InferenceClient:
+    """Sends jobs to an inference node and awaits the results, with the same ``run`` interface
+    as ``JobQueue``.
+
+    ``connect`` opens a new ``Connection``; it is called lazily and again after the connection
+    drops, at which point every job still waiting fails with ``RemoteJobError``. Cancelling a
+    ``CancelToken`` passed to ``run`` stops the job on the node, which then fails with ``JobCancelled``.
+    """
+
+    def __init__(self, connect: Callable[[], Awaitable[Connection]]):
+        self.connect = connect
+        self._connection = None
+        self._reader = None
+        self._connecting = asyncio.Lock()
+        self._pending = {}
+        self._ids = itertools.count()
+
+    @classmethod
+    def from_url(cls, url: str) -> 'InferenceClient':
+        host, port = parse_address(url, DEFAULT_PORT)
+        return cls(lambda: StreamConnection.open(host, port))
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._pending)
+
+    def start(self):
+        JOBS_IN_FLIGHT.set_function(lambda: self.in_flight)
+
+    def stop(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        if self._connection is not None:
+            asyncio.ensure_future(self._connection.close())
+            self._connection = None
+
+    async def _connected(self) -> Connection:
+        async with self._connecting:
+            if self._connection is None:
+                try:
+                    self._connection = await self.connect()
+                except (ConnectionError, OSError) as e:
+                    raise RemoteJobError(f'Could not reach the inference node: {e}')
+                self._reader = asyncio.create_task(self._read(self._connection))
+            return self._connection
+
+    async def run(self, method: str, *args, **kwargs):
+        connection = await self._connected()
+        job_id = next(self._ids)
+        message, blobs = await asyncio.to_thread(_pack_job, job_id, method, args, kwargs)
+        previews = {name: value for name, value in kwargs.items() if isinstance(value, PreviewBuffer)}
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending[job_id] = (future, previews)
+        try:
+            await connection.send(message, blobs)
+            for token in cancel_tokens(kwargs):
+                token.add_callback(lambda: loop.call_soon_threadsafe(asyncio.ensure_future, self._cancel(connection, job_id)))
+            return await future
+        except ConnectionClosed as e:
+            raise RemoteJobError(f'Lost the connection to the inference node: {e}')
+        except asyncio.CancelledError:
+            await self._cancel(connection, job_id)
+            raise
+        finally:
+            self._pending.pop(job_id, None)
+
+    async def _cancel(self, connection: Connection, job_id: int):
+        try:
+            await connection.send({'type': 'cancel', 'id': job_id})
+        except ConnectionClosed:
+            pass
+
+    async def _read(self, connection: Connection):
+        try:
+            while True:
+                message, blobs = await connection.receive()
+                pending = self._pending.get(message.get('id'))
+                if pending is None:
+                    continue
+                future, previews = pending
+                kind = message['type']
+                if kind == 'preview':
+                    preview = previews.get(message['name'])
+                    if preview is not None:
+                        preview.push(message['step'], unpack(message['image'], blobs))
+                elif future.done():
+                    continue
+                elif kind == 'result':
+                    future.set_result(await asyncio.to_thread(unpack, message['value'], blobs))
+                elif kind == 'error' and 'cancelled' in message:
+                    future.set_exception(JobCancelled(*message['cancelled']))
+                elif kind == 'error':
+                    future.set_exception(RemoteJobError(f'{message["kind"]}: {message["error"]}'))
+        except ConnectionClosed as e:
+            error = RemoteJobError(f'Lost the connection to the inference node: {e}')
+        except Exception as e:
+            logger.error(f'Inference client reader failed: {e}')
+            error = RemoteJobError(f'Inference protocol error: {e}')
+        finally:
+            if self._connection is connection:
+                self._connection = None
+
+        await connection.close()
+        for future, _ in list(self._pending.values()):
+            if not future.done():
+                future.set_exception(error)
+
+
+class _StreamPreview(PreviewBuffer):
+    # pushes from the inference thread are forwarded to the client as they happen
+    def __init__(self, connection: Connection, job_id: int, name: str, loop: asyncio.AbstractEventLoop, mode: str, every: int, max_frames: int):
+        super().__init__(mode, every, max_frames)
+        self.connection = connection
+        self.job_id = job_id
+        self.name = name
+        self.loop = loop
+
+    def push(self, step, image):
+        super().push(step, image)
+        blobs = []
+        message = {'type': 'preview', 'id': self.job_id, 'name': self.name, 'step': step, 'image': pack(image, blobs)}
+        asyncio.run_coroutine_threadsafe(self._send(message, blobs), self.loop)
+
+    async def _send(self, message, blobs):
+        try:
+            await self.connection.send(message, blobs)
+        except ConnectionClosed:
+            pass
+
+
+class InferenceNode:
+    """Serves jobs from ``InferenceClient`` connections on a local ``JobQueue`` (or ``WorkerPool``)."""
+
+    def __init__(self, job_queue: JobQueue):
+        self.job_queue = job_queue
+
+    async def serve(self, connection: Connection):
+        # job id -> (task, cancel tokens)
+        jobs = {}
+        try:
+            while True:
+                message, blobs = await connection.receive()
+                if message.get('type') == 'job':
+                    job_id = message['id']
+                    tokens = {name: CancelToken(**options) for name, options in message.get('cancels', {}).items()}
+                    task = asyncio.create_task(self._run_job(connection, message, blobs, tokens))
+                    jobs[job_id] = (task, tokens)
+                    task.add_done_callback(lambda _, job_id=job_id: jobs.pop(job_id, None))
+                elif message.get('type') == 'cancel' and message.get('id') in jobs:
+                    task, tokens = jobs[message['id']]
+                    # with a token the job stops at its next step and reports how far it got
+                    if tokens:
+                        for token in tokens.values():
+                            token.cancel()
+                    else:
+                        task.cancel()
+        except ConnectionClosed:
+            pass
+        finally:
+            for task, _ in list(jobs.values()):
+                task.cancel()
+            await connection.close()
+
+    async def _run_job(self, connection: Connection, message: dict, blobs: list, tokens: dict):
+        job_id = message['id']
+        try:
+            # the node does no authentication, so only model methods meant for jobs may be called
+            check_method(message['method'])
+            args = await asyncio.to_thread(unpack, message['args'], blobs)
+            kwargs = await asyncio.to_thread(unpack, message['kwargs'], blobs)
+            loop = asyncio.get_running_loop()
+            for name, options in message.get('previews', {}).items():
+                kwargs[name] = _StreamPreview(connection, job_id, name, loop, **options)
+            kwargs.update(tokens)
+
+            result = await self.job_queue.run(message['method'], *args, **kwargs)
+            result_blobs = []
+            value = await asyncio.to_thread(pack, result, result_blobs)
+            await connection.send({'type': 'result', 'id': job_id, 'value': value}, result_blobs)
+        except asyncio.CancelledError:
+            raise
+        except ConnectionClosed:
+            pass
+        except Exception as e:
+            reply = {'type': 'error', 'id': job_id, 'kind': type(e).__name__, 'error': str(e)}
+            if isinstance(e, JobCancelled):
+                reply['cancelled'] = list(e.args)
+            try:
+                await connection.send(reply)
+            except ConnectionClosed:
+                pass
+
+    async def listen(self, host: str, port: int) -> asyncio.AbstractServer:
+        server = await asyncio.start_server(lambda reader, writer: self.serve(StreamConnection(reader, writer)), host, port)
+        logger.info(f'Inference node listening on {host}:{port}')
+        return server
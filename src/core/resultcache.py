@@ -0,0 +1,163 @@
+import asyncio
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from PIL import Image
+
+from src.core.logging import get_logger
+from src.core.metrics import RESULT_CACHE_REQUESTS
+from src.stablediffusion.cancellation import JobCancelled
+
+logger = get_logger(__name__)
+
+
+class ResultCache:
+    """Content-addressed store of encoded result images on local disk.
+
+    Only deterministic requests (an explicit seed) belong here: the key covers everything that
+    decides the output, so a hit is byte for byte what the request would have produced. Files are
+    evicted least-recently-used once they take up more than ``max_bytes``. Identical requests that
+    arrive while the first one is still running wait for its result instead of running again, and
+    run it themselves if the first one is cancelled.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 1024 * 1024 * 1024, extension: str = 'png'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.extension = extension
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+        # reads and writes run in threads off the event loop
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        # files from earlier runs, least recently used first
+        files = []
+        for name in os.listdir(directory):
+            if not name.endswith(f'.{extension}'):
+                continue
+            try:
+                stat = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, name[:-len(extension) - 1], stat.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self.bytes += size
+        self._evict()
+
+    @staticmethod
+    def key(**params) -> str:
+        digest = hashlib.sha256()
+        for name, value in sorted(params.items()):
+            digest.update(f'{name}='.encode())
+            if isinstance(value, Image.Image):
+                digest.update(f'{value.mode}:{value.width}x{value.height}:'.encode())
+                digest.update(value.tobytes())
+            else:
+                digest.update(repr(value).encode())
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'shared': self.shared, 'entries': len(self._entries), 'bytes': self.bytes}
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.{self.extension}')
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            path = self._path(key)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                # the modification time orders entries for eviction after a restart
+                os.utime(path)
+            except OSError:
+                self._forget(key)
+                return None
+            self._entries.move_to_end(key)
+            return data
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        partial = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(partial, 'wb') as f:
+                f.write(data)
+            os.replace(partial, path)
+        except OSError as e:
+            logger.warning(f'Could not store result {key}: {e}')
+            return
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = len(data)
+            self.bytes += len(data)
+            self._evict()
+
+    def _forget(self, key: str):
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self.bytes -= size
+
+    def _evict(self):
+        while self.bytes > self.max_bytes:
+            key, size = self._entries.popitem(last=False)
+            self.bytes -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    async def get_or_create(self, key: str, create: Callable[[], Awaitable[bytes]]) -> bytes:
+        while key in self._pending:
+            pending = self._pending[key]
+            try:
+                data = await asyncio.shield(pending)
+                self.shared += 1
+                RESULT_CACHE_REQUESTS.inc(outcome='shared')
+                return data
+            except asyncio.CancelledError:
+                # only carry on if it was the request doing the work that got cancelled
+                if not pending.cancelled():
+                    raise
+
+        # registered before looking at the disk, so a request arriving meanwhile waits for this one
+        pending = asyncio.get_running_loop().create_future()
+        self._pending[key] = pending
+        try:
+            data = await asyncio.to_thread(self.get, key)
+            hit = data is not None
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+                data = await create()
+            RESULT_CACHE_REQUESTS.inc(outcome='hit' if hit else 'miss')
+        except (asyncio.CancelledError, JobCancelled):
+            # waiting requests were not cancelled themselves, so one of them takes over
+            pending.cancel()
+            raise
+        except Exception as e:
+            pending.set_exception(e)
+            # marks the error as retrieved for when no other request was waiting
+            pending.exception()
+            raise
+        else:
+            pending.set_result(data)
+            if not hit:
+                await asyncio.to_thread(self.put, key, data)
+            return data
+        finally:
+            self._pending.pop(key, None)
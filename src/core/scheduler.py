@@ -0,0 +1,274 @@
+import asyncio
+import heapq
+import inspect
+import itertools
+import time
+from typing import Optional
+
+from src.core.logging import get_logger
+from src.core.metrics import JOBS_REJECTED, SCHEDULER_DEPTH, SCHEDULER_WAIT_SECONDS
+from src.stablediffusion.cancellation import JobCancelled, cancel_reason, cancel_tokens
+from src.stablediffusion import jobs
+
+logger = get_logger(__name__)
+
+# lanes are served strictly in this order; within a lane jobs are ordered fairly between users
+PRIORITIES = {'followup': 0, 'prompt': 1}
+
+# relative cost of one step per latent pixel in each mode; img2img and inpaint also pay for the
+# VAE encode, and the VAE test runs no steps at all
+MODE_WEIGHTS = {'dream': 1.0, 'translation': 1.05, 'inpaint': 1.1, 'vae_test': 2.0}
+
+# a 512x512 txt2img job at 50 steps costs 1
+REFERENCE_COST = 50 * 64 * 64
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, scope: str, retry_after: float):
+        super().__init__(f'The {scope} quota is used up, try again in {retry_after:.0f}s')
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+def job_cost(method: str, args: tuple, kwargs: dict) -> float:
+    """Cost of a job as UNet steps x latent pixels x mode weight, with a 512x512 50 step txt2img as 1."""
+    bound = inspect.signature(getattr(jobs, method)).bind(*args, **kwargs)
+    bound.apply_defaults()
+    arguments = bound.arguments
+    steps = arguments.get('ddim_steps', 1)
+    # img2img only runs the last denoising_strength of the schedule
+    if 'denoising_strength' in arguments:
+        steps *= arguments['denoising_strength']
+    # steps past the guidance cutoff run the UNet on half the batch
+    if 'guidance_cutoff' in arguments:
+        steps *= (1 + arguments['guidance_cutoff']) / 2
+    height, width = arguments['height'], arguments['width']
+    if isinstance(arguments.get('crop'), (tuple, list)):
+        # only the box around the mask is denoised; the region is found before the job is submitted
+        width, height = arguments['crop'][1]
+    pixels = (height // 8) * (width // 8)
+    images = arguments.get('n_iter', 1) * arguments.get('n_samples', 1)
+    return MODE_WEIGHTS.get(method, 1.0) * steps * pixels * images / REFERENCE_COST
+
+
+class TokenBucket:
+    """Holds up to ``capacity`` tokens, refilled at ``rate`` per second. A job may take more
+    tokens than are left as long as the bucket is full, so expensive jobs are slowed down
+    rather than refused outright."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost: float) -> float:
+        self._refill()
+        needed = min(cost, self.capacity) - self.tokens
+        return max(0.0, needed / self.rate)
+
+    def take(self, cost: float):
+        self._refill()
+        self.tokens -= cost
+
+    def refund(self, cost: float):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + cost)
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class JobRequest:
+    """Who a job is for: quotas apply per user and per guild (``None`` in direct messages), and a
+    user with twice the ``weight`` gets twice the share of a busy queue."""
+
+    def __init__(self, user: int, guild: Optional[int] = None, priority: str = 'prompt', weight: float = 1.0):
+        if priority not in PRIORITIES:
+            raise ValueError(f'Unknown priority {priority}, expected one of {", ".join(PRIORITIES)}')
+        self.user = user
+        self.guild = guild
+        self.priority = priority
+        self.weight = weight
+
+
+class Ticket:
+    def __init__(self, request: JobRequest, method: str, args: tuple, kwargs: dict, cost: float, finish: float, sequence: int):
+        self.request = request
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.cost = cost
+        self.finish = finish
+        self.sequence = sequence
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        # 1-based place in line while queued, 0 once handed to the queue or cancelled
+        self.position = 0
+        self.task = None
+
+    @property
+    def order(self) -> tuple:
+        return (PRIORITIES[self.request.priority], self.finish, self.sequence)
+
+    def __lt__(self, other: 'Ticket') -> bool:
+        return self.order < other.order
+
+
+class FairScheduler:
+    """Admits jobs under per-user and per-guild quotas and orders them fairly in front of a
+    ``JobQueue``, ``WorkerPool`` or ``InferenceClient``.
+
+    Every job gets a cost from ``job_cost`` that is taken from its user's and guild's token
+    buckets. Queued jobs are ordered by priority lane, then by weighted fair queuing between users:
+    each job's virtual finish time is its user's previous finish time (or the current virtual
+    time, if later) plus its cost over the user's weight, so a user with many or large jobs queued does not hold up
+    everyone else. At most ``slots`` jobs are handed to the queue at once, which leaves it room to
+    batch them while keeping the order decided here. Jobs whose ``CancelToken`` is cancelled or
+    past its deadline before they are handed on leave the queue with ``JobCancelled`` and get their
+    cost refunded.
+    """
+
+    def __init__(self, job_queue, slots: int = 2, user_rate: float = 0.1, user_burst: float = 10.0, guild_rate: float = 0.5, guild_burst: float = 50.0):
+        self.job_queue = job_queue
+        self.slots = slots
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.guild_rate = guild_rate
+        self.guild_burst = guild_burst
+        self.running = 0
+        self._queue = []
+        self._virtual_time = 0.0
+        self._finish = {}
+        self._buckets = {}
+        self._sequence = itertools.count()
+        # the queue behind holds at most slots jobs, the rest wait here
+        SCHEDULER_DEPTH.set_function(lambda: self.depth)
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def _bucket(self, scope: str, key) -> TokenBucket:
+        bucket = self._buckets.get((scope, key))
+        if bucket is None:
+            if len(self._buckets) > 4096:
+                # full buckets behave exactly like new ones
+                self._buckets = {k: b for k, b in self._buckets.items() if not b.full}
+            if scope == 'user':
+                bucket = TokenBucket(self.user_rate, self.user_burst)
+            else:
+                bucket = TokenBucket(self.guild_rate, self.guild_burst)
+            self._buckets[(scope, key)] = bucket
+        return bucket
+
+    def _buckets_for(self, request: JobRequest) -> list:
+        # a rate of 0 turns that quota off
+        buckets = []
+        if self.user_rate > 0:
+            buckets.append(('user', self._bucket('user', request.user)))
+        if self.guild_rate > 0 and request.guild is not None:
+            buckets.append(('guild', self._bucket('guild', request.guild)))
+        return buckets
+
+    def submit(self, request: JobRequest, method: str, *args, **kwargs) -> Ticket:
+        cost = job_cost(method, args, kwargs)
+        buckets = self._buckets_for(request)
+        for scope, bucket in buckets:
+            retry_after = bucket.wait_time(cost)
+            if retry_after > 0:
+                JOBS_REJECTED.inc(scope=scope)
+                logger.info(f'Refused {method} costing {cost:.2f} for user {request.user}: {scope} quota, retry in {retry_after:.0f}s')
+                raise QuotaExceeded(scope, retry_after)
+        for _, bucket in buckets:
+            bucket.take(cost)
+
+        start = max(self._virtual_time, self._finish.get(request.user, 0.0))
+        ticket = Ticket(request, method, args, kwargs, cost, start + cost / request.weight, next(self._sequence))
+        self._finish[request.user] = ticket.finish
+        heapq.heappush(self._queue, ticket)
+        for token in cancel_tokens(kwargs):
+            token.add_callback(lambda ticket=ticket: self._drop(ticket, 'cancel'))
+        self._dispatch()
+        return ticket
+
+    async def wait(self, ticket: Ticket):
+        try:
+            return await asyncio.shield(ticket.future)
+        except asyncio.CancelledError:
+            self.cancel(ticket)
+            raise
+
+    async def run(self, request: JobRequest, method: str, *args, **kwargs):
+        return await self.wait(self.submit(request, method, *args, **kwargs))
+
+    def cancel(self, ticket: Ticket):
+        if ticket.task is not None:
+            ticket.task.cancel()
+        elif self._remove(ticket):
+            ticket.future.cancel()
+            self._update_positions()
+
+    def _drop(self, ticket: Ticket, reason: str):
+        # a running job sees its token itself and stops at the next step
+        if self._remove(ticket):
+            ticket.future.set_exception(JobCancelled(0, None, reason))
+            self._update_positions()
+
+    def _remove(self, ticket: Ticket) -> bool:
+        if ticket not in self._queue:
+            return False
+        self._queue.remove(ticket)
+        heapq.heapify(self._queue)
+        self._refund(ticket)
+        return True
+
+    def _refund(self, ticket: Ticket):
+        # nothing ran, so the quota is given back
+        for _, bucket in self._buckets_for(ticket.request):
+            bucket.refund(ticket.cost)
+        ticket.position = 0
+
+    def _dispatch(self):
+        while self._queue and self.running < self.slots:
+            ticket = heapq.heappop(self._queue)
+            reason = cancel_reason(ticket.kwargs)
+            if reason is not None:
+                self._refund(ticket)
+                ticket.future.set_exception(JobCancelled(0, None, reason))
+                continue
+            self._virtual_time = max(self._virtual_time, ticket.finish - ticket.cost / ticket.request.weight)
+            self.running += 1
+            SCHEDULER_WAIT_SECONDS.observe(time.monotonic() - ticket.enqueued_at, priority=ticket.request.priority)
+            ticket.position = 0
+            ticket.task = asyncio.create_task(self._execute(ticket))
+
+        if len(self._finish) > 4096:
+            # users whose last job is behind the virtual time start from it anyway
+            self._finish = {user: finish for user, finish in self._finish.items() if finish > self._virtual_time}
+        self._update_positions()
+
+    def _update_positions(self):
+        for position, ticket in enumerate(sorted(self._queue), start=1):
+            ticket.position = position
+
+    async def _execute(self, ticket: Ticket):
+        try:
+            result = await self.job_queue.run(ticket.method, *ticket.args, **ticket.kwargs)
+            if not ticket.future.done():
+                ticket.future.set_result(result)
+        except asyncio.CancelledError:
+            ticket.future.cancel()
+        except Exception as e:
+            if not ticket.future.done():
+                ticket.future.set_exception(e)
+        finally:
+            self.running -= 1
+            self._dispatch()
@@ -0,0 +1,346 @@
+import itertools
+import multiprocessing
+import pickle
+import queue
+import threading
+from types import SimpleNamespace
+from typing import Optional
+
+from src.core.jobqueue import JobQueue, check_method
+from src.core.logging import get_logger, log_queue, log_to_queue
+from src.core.metrics import JOB_PEAK_MEMORY_BYTES
+from src.stablediffusion.cancellation import CancelToken, JobCancelled, release_device_memory
+from src.stablediffusion.preview import PreviewBuffer
+
+logger = get_logger(__name__)
+
+
+class WorkerCrashedError(Exception):
+    pass
+
+
+class _PreviewRequest:
+    # stands in for a PreviewBuffer on the way to a worker, which can't pickle its lock
+    def __init__(self, tag: tuple, preview: PreviewBuffer):
+        self.tag = tag
+        self.mode = preview.mode
+        self.every = preview.every
+        self.max_frames = preview.max_frames
+
+
+class _RelayPreview(PreviewBuffer):
+    def __init__(self, request: _PreviewRequest, responses):
+        super().__init__(request.mode, request.every, request.max_frames)
+        self.tag = request.tag
+        self.responses = responses
+
+    def push(self, step, image):
+        super().push(step, image)
+        self.responses.put(('preview', self.tag, (step, image)))
+
+
+class _CancelRequest:
+    # stands in for a CancelToken on the way to a worker; cancels follow on the worker's cancel queue
+    def __init__(self, tag: tuple, token: CancelToken):
+        self.tag = tag
+        self.deadline = token.deadline
+
+
+class _Tokens:
+    """The cancel tokens of the jobs a worker runs, by tag. A cancel can arrive before its job
+    does, in which case the token is cancelled as soon as it is created."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._early = set()
+        # batches reach a worker in order, so cancels for this one or earlier are stale
+        self._finished = -1
+
+    def create(self, tag: tuple, deadline: Optional[float]) -> CancelToken:
+        with self._lock:
+            token = self._tokens[tag] = CancelToken(deadline)
+            if tag in self._early:
+                self._early.discard(tag)
+                token.cancel()
+        return token
+
+    def cancel(self, tag: tuple):
+        with self._lock:
+            token = self._tokens.get(tag)
+            if token is None:
+                if tag[0] > self._finished:
+                    self._early.add(tag)
+                return
+        token.cancel()
+
+    def release(self, batch_id: int, size: int):
+        with self._lock:
+            for index in range(size):
+                self._tokens.pop((batch_id, index), None)
+            self._finished = max(self._finished, batch_id)
+
+
+def _worker_kwargs(kwargs: dict, responses, tokens: _Tokens) -> dict:
+    unpacked = {}
+    for name, value in kwargs.items():
+        if isinstance(value, _PreviewRequest):
+            value = _RelayPreview(value, responses)
+        elif isinstance(value, _CancelRequest):
+            value = tokens.create(value.tag, value.deadline)
+        unpacked[name] = value
+    return unpacked
+
+
+def _listen_for_cancels(cancels, tokens: _Tokens):
+    while True:
+        tag = cancels.get()
+        if tag is None:
+            break
+        tokens.cancel(tag)
+
+
+def _picklable(error: Exception) -> Exception:
+    try:
+        pickle.dumps(error)
+        return error
+    except Exception:
+        return RuntimeError(f'{type(error).__name__}: {error}')
+
+
+def _worker_main(worker_id: int, device: str, model_factory, batcher, requests, cancels, responses, logs):
+    log_to_queue(logs)
+    import torch
+
+    try:
+        if device.startswith('cuda'):
+            torch.cuda.set_device(torch.device(device))
+        model = model_factory(device=device)
+    except Exception as e:
+        responses.put(('load_error', worker_id, _picklable(e)))
+        return
+    responses.put(('ready', worker_id, None))
+
+    # cancels arrive while the main thread is busy running the job they are for
+    tokens = _Tokens()
+    threading.Thread(target=_listen_for_cancels, args=(cancels, tokens), name='cancel-listener', daemon=True).start()
+
+    cuda = device.startswith('cuda')
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        batch_id, payload = request
+
+        jobs = []
+        for method, args, kwargs in payload:
+            jobs.append(SimpleNamespace(method=method, args=args, kwargs=_worker_kwargs(kwargs, responses, tokens)))
+
+        results, error, peak = None, None, None
+        if cuda:
+            torch.cuda.reset_peak_memory_stats()
+        try:
+            check_method(jobs[0].method)
+            if len(jobs) == 1:
+                job = jobs[0]
+                results = [getattr(model, job.method)(*job.args, **job.kwargs)]
+            else:
+                results = batcher.run(model, jobs)
+        except JobCancelled as e:
+            release_device_memory(e)
+            error = e
+        except Exception as e:
+            error = _picklable(e)
+        tokens.release(batch_id, len(jobs))
+        if cuda:
+            peak = torch.cuda.max_memory_allocated()
+        responses.put(('done', batch_id, (worker_id, results, error, peak)))
+
+
+class _Worker:
+    def __init__(self, worker_id: int, device: str):
+        self.id = worker_id
+        self.device = device
+        self.process = None
+        self.requests = None
+        self.cancels = None
+        self.pending = {}
+        self.completed = 0
+        self.crashes = 0
+        self.ready = False
+        self.load_error = None
+
+    @property
+    def load(self) -> int:
+        return sum(len(jobs) for jobs in self.pending.values())
+
+
+class WorkerPool(JobQueue):
+    """Runs one model replica per device, each in its own process, behind the ``JobQueue`` interface.
+
+    Jobs are queued and batched exactly as in ``JobQueue``; each batch then goes to the least
+    loaded worker that has room for it. Workers that die are restarted and the jobs they were
+    running fail with ``WorkerCrashedError``. Devices may repeat, e.g. ``['cpu', 'cpu']``.
+    """
+
+    def __init__(self, model_factory, devices: list, batcher=None, history: int = 100, max_pending: int = 1, max_crashes: int = 3):
+        super().__init__(model_factory, batcher, history)
+        self.devices = list(devices)
+        self.max_pending = max_pending
+        self.max_crashes = max_crashes
+        self.workers = [_Worker(i, device) for i, device in enumerate(self.devices)]
+        self._context = multiprocessing.get_context('spawn')
+        self._responses = self._context.Queue()
+        self._capacity = threading.Condition()
+        self._batch_ids = itertools.count()
+        self._previews = {}
+        self._stopping = False
+        self._supervisor = threading.Thread(target=self._supervise, name='worker-supervisor', daemon=True)
+
+    def start(self):
+        for worker in self.workers:
+            self._spawn(worker)
+        self._supervisor.start()
+        super().start()
+
+    def stop(self):
+        super().stop()
+        with self._capacity:
+            self._stopping = True
+            self._capacity.notify_all()
+        for worker in self.workers:
+            if worker.process is None or not worker.process.is_alive():
+                continue
+            # a worker still loading has nothing to finish and might take a while to read the queue
+            if worker.ready:
+                worker.requests.put(None)
+            else:
+                worker.process.terminate()
+
+    def _spawn(self, worker: _Worker):
+        worker.requests = self._context.Queue()
+        worker.cancels = self._context.Queue()
+        worker.ready = False
+        worker.process = self._context.Process(
+            target=_worker_main,
+            args=(worker.id, worker.device, self.model_factory, self.batcher, worker.requests, worker.cancels, self._responses, log_queue()),
+            name=f'inference-worker-{worker.id}',
+            daemon=True,
+        )
+        worker.process.start()
+        logger.info(f'Started worker {worker.id} on {worker.device} (pid {worker.process.pid})')
+
+    def _load(self):
+        # replicas load in their own processes; the dispatcher only needs one of them to succeed
+        with self._capacity:
+            while not any(worker.ready for worker in self.workers):
+                if all(worker.load_error is not None for worker in self.workers):
+                    raise self.workers[0].load_error
+                self._capacity.wait()
+
+    def _usable(self) -> list:
+        return [worker for worker in self.workers if worker.load_error is None]
+
+    def _execute(self, jobs: list):
+        if not jobs:
+            return
+        with self._capacity:
+            while True:
+                if self._stopping:
+                    for job in jobs:
+                        job.set_exception(WorkerCrashedError('The worker pool is shutting down'))
+                    return
+                usable = self._usable()
+                if not usable:
+                    self._start_jobs(jobs)
+                    self._finish_jobs(jobs, None, self.workers[0].load_error)
+                    return
+                available = [worker for worker in usable if worker.ready and len(worker.pending) < self.max_pending]
+                if available:
+                    break
+                self._capacity.wait()
+
+            worker = min(available, key=lambda worker: (worker.load, worker.completed))
+            batch_id = next(self._batch_ids)
+            payload = []
+            for index, job in enumerate(jobs):
+                kwargs = dict(job.kwargs)
+                tag = (batch_id, index)
+                for name, value in kwargs.items():
+                    if isinstance(value, PreviewBuffer):
+                        self._previews[tag] = value
+                        kwargs[name] = _PreviewRequest(tag, value)
+                    elif isinstance(value, CancelToken):
+                        kwargs[name] = _CancelRequest(tag, value)
+                        # read worker.cancels only on cancel: a restarted worker gets a new queue
+                        value.add_callback(lambda worker=worker, tag=tag: worker.cancels.put(tag))
+                payload.append((job.method, job.args, kwargs))
+            self._start_jobs(jobs)
+            worker.pending[batch_id] = jobs
+        worker.requests.put((batch_id, payload))
+
+    def _supervise(self):
+        while True:
+            try:
+                kind, key, value = self._responses.get(timeout=1.0)
+            except queue.Empty:
+                kind = None
+            except (EOFError, OSError):
+                break
+
+            with self._capacity:
+                if kind == 'ready':
+                    self.workers[key].ready = True
+                    logger.info(f'Worker {key} on {self.workers[key].device} is ready')
+                elif kind == 'load_error':
+                    worker = self.workers[key]
+                    worker.load_error = value
+                    logger.error(f'Worker {key} failed to load the model on {worker.device}: {value}')
+                elif kind == 'preview':
+                    preview = self._previews.get(key)
+                    if preview is not None:
+                        preview.push(*value)
+                elif kind == 'done':
+                    worker_id, results, error, peak = value
+                    worker = self.workers[worker_id]
+                    jobs = worker.pending.pop(key)
+                    worker.completed += 1
+                    worker.crashes = 0
+                    self._release(key, jobs)
+                    if peak is not None:
+                        JOB_PEAK_MEMORY_BYTES.observe(peak, method=jobs[0].method)
+                    self._finish_jobs(jobs, results, error)
+
+                self._check_workers()
+                self._capacity.notify_all()
+                if self._stopping and not any(worker.pending for worker in self.workers):
+                    break
+
+    def _release(self, batch_id: int, jobs: list):
+        for index in range(len(jobs)):
+            self._previews.pop((batch_id, index), None)
+
+    def _check_workers(self):
+        for worker in self.workers:
+            if worker.process is None or worker.process.is_alive() or worker.load_error is not None:
+                continue
+            exit_code = worker.process.exitcode
+            for batch_id, jobs in worker.pending.items():
+                self._release(batch_id, jobs)
+                self._finish_jobs(jobs, None, WorkerCrashedError(f'Worker {worker.id} on {worker.device} exited with code {exit_code}'))
+            worker.pending = {}
+            if self._stopping:
+                worker.process = None
+                continue
+
+            worker.crashes += 1
+            if worker.crashes > self.max_crashes:
+                worker.load_error = WorkerCrashedError(f'Worker {worker.id} on {worker.device} crashed {worker.crashes} times in a row')
+                logger.error(f'{worker.load_error}, giving up on it')
+                continue
+            logger.error(f'Worker {worker.id} on {worker.device} exited with code {exit_code}, restarting it')
+            self._spawn(worker)
+
+    @property
+    def in_flight(self) -> int:
+        return sum(worker.load for worker in self.workers)
@@ -0,0 +1,111 @@
+import torch
+import torch.nn.functional as F
+from diffusers.models.attention import CrossAttention
+
+from src.core.logging import get_logger
+
+logger = get_logger(__name__)
+
+BACKENDS = ('default', 'sliced', 'sdpa', 'chunked')
+HAS_SDPA = hasattr(F, 'scaled_dot_product_attention')
+
+# latent tokens (64x64 is a 512x512 image) up to which the plain attention is used, and up to
+# which sliced attention is preferred over chunking the queries
+DEFAULT_MAX_TOKENS = 64 * 64
+SLICED_MAX_TOKENS = 128 * 128
+
+# the score matrix one slice or chunk may materialise
+MAX_SCORE_BYTES = 256 * 1024 * 1024
+
+
+class AttentionSettings:
+    """Attention backend shared by all ``CrossAttention`` layers of one UNet.
+
+    ``backend='auto'`` picks one per request from the latent resolution; any other value from
+    ``BACKENDS`` forces that backend.
+    """
+
+    def __init__(self, backend: str = 'auto', max_score_bytes: int = MAX_SCORE_BYTES):
+        if backend != 'auto' and backend not in BACKENDS:
+            raise ValueError(f'Unknown attention backend {backend}, expected auto or one of {", ".join(BACKENDS)}')
+        if backend == 'sdpa' and not HAS_SDPA:
+            logger.warning('This version of PyTorch has no scaled_dot_product_attention, using sliced attention')
+            backend = 'sliced'
+        self.requested = backend
+        self.backend = 'default' if backend == 'auto' else backend
+        self.max_score_bytes = max_score_bytes
+
+    def select(self, height: int, width: int, device: torch.device) -> str:
+        if self.requested == 'auto':
+            self.backend = select_backend(height, width, device)
+        return self.backend
+
+
+def select_backend(height: int, width: int, device: torch.device) -> str:
+    tokens = (height // 8) * (width // 8)
+    if tokens <= DEFAULT_MAX_TOKENS:
+        return 'default'
+    if HAS_SDPA and device.type == 'cuda':
+        return 'sdpa'
+    if tokens <= SLICED_MAX_TOKENS:
+        return 'sliced'
+    return 'chunked'
+
+
+def _attend(q, k, v, scale):
+    attn = torch.baddbmm(
+        torch.empty(q.shape[0], q.shape[1], k.shape[1], dtype=q.dtype, device=q.device), q, k.transpose(1, 2), beta=0, alpha=scale
+    ).softmax(dim=-1)
+    return torch.bmm(attn, v)
+
+
+def sliced_attention(q, k, v, scale: float, max_score_bytes: int = MAX_SCORE_BYTES):
+    # one slice of (batch * heads) rows at a time
+    rows = max(1, max_score_bytes // (q.shape[1] * k.shape[1] * q.element_size()))
+    out = q.new_empty(q.shape[0], q.shape[1], v.shape[2])
+    for start in range(0, q.shape[0], rows):
+        end = start + rows
+        out[start:end] = _attend(q[start:end], k[start:end], v[start:end], scale)
+    return out
+
+
+def chunked_attention(q, k, v, scale: float, max_score_bytes: int = MAX_SCORE_BYTES):
+    # every head at once but only a chunk of the queries, so memory stays bounded at any resolution
+    chunk = max(1, max_score_bytes // (q.shape[0] * k.shape[1] * q.element_size()))
+    out = q.new_empty(q.shape[0], q.shape[1], v.shape[2])
+    for start in range(0, q.shape[1], chunk):
+        end = start + chunk
+        out[:, start:end] = _attend(q[:, start:end], k, v, scale)
+    return out
+
+
+def _forward(self, x, context=None, mask=None):
+    backend = self.attention_settings.backend
+    if backend == 'default' or mask is not None:
+        return CrossAttention.forward(self, x, context, mask)
+
+    context = x if context is None else context
+    q, k, v = self.to_q(x), self.to_k(context), self.to_v(context)
+
+    if backend == 'sdpa':
+        batch_size, sequence_length, dim = q.shape
+        q, k, v = (t.view(batch_size, -1, self.heads, dim // self.heads).transpose(1, 2) for t in (q, k, v))
+        out = F.scaled_dot_product_attention(q, k, v)
+        return self.to_out(out.transpose(1, 2).reshape(batch_size, sequence_length, dim))
+
+    q, k, v = (self.reshape_heads_to_batch_dim(t) for t in (q, k, v))
+    attend = sliced_attention if backend == 'sliced' else chunked_attention
+    out = attend(q, k, v, self.scale, self.attention_settings.max_score_bytes)
+    return self.to_out(self.reshape_batch_dim_to_heads(out))
+
+
+def install_attention(unet: torch.nn.Module, settings: AttentionSettings) -> int:
+    """Routes every ``CrossAttention`` layer of ``unet`` through ``settings``. Returns the number of layers."""
+    layers = 0
+    for module in unet.modules():
+        if isinstance(module, CrossAttention):
+            module.attention_settings = settings
+            module.forward = _forward.__get__(module)
+            layers += 1
+    unet.attention_settings = settings
+    return layers
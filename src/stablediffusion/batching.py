@@ -0,0 +1,55 @@
+import inspect
+
+from src.stablediffusion.cancellation import CancelGroup
+from src.stablediffusion.text2image_diffusers import DEFAULT_SAMPLERS, Text2Image
+
+
+class DreamBatcher:
+    """Groups concurrent single-image ``dream`` jobs that share a denoising schedule into one UNet batch.
+
+    Jobs are compatible when their height, width, step count, eta, sampler and guidance cutoff
+    match; prompts, guidance scales and seeds may differ per sample. A batch stops early only once
+    every job in it was cancelled.
+    """
+
+    method = 'dream'
+
+    def __init__(self, window: float = 0.05, max_batch_size: int = 4):
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._signature = inspect.signature(Text2Image.dream)
+
+    def _bind(self, job):
+        bound = self._signature.bind(None, *job.args, **job.kwargs)
+        bound.apply_defaults()
+        return bound.arguments
+
+    def key(self, job):
+        if job.method != self.method:
+            return None
+        try:
+            args = self._bind(job)
+        except TypeError:
+            # runs alone, where the call itself fails with this error
+            return None
+        if args['progress'] or args['n_iter'] * args['n_samples'] != 1:
+            return None
+        return (args['height'], args['width'], args['ddim_steps'], args['ddim_eta'], args['sampler'] or DEFAULT_SAMPLERS['dream'], args['guidance_cutoff'], args['guidance_threshold'])
+
+    def run(self, model: Text2Image, jobs: list):
+        requests = [self._bind(job) for job in jobs]
+        first = requests[0]
+        results = model.dream_batch(
+            [args['prompt'] for args in requests],
+            first['ddim_steps'],
+            first['ddim_eta'],
+            [args['cfg_scale'] for args in requests],
+            [args['seed'] for args in requests],
+            first['height'],
+            first['width'],
+            cancel=CancelGroup([args['cancel'] for args in requests]),
+            sampler=first['sampler'],
+            guidance_cutoff=first['guidance_cutoff'],
+            guidance_threshold=first['guidance_threshold'],
+        )
+        return [([image], [seed]) for image, seed in results]
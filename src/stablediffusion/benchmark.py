@@ -0,0 +1,244 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from io import BytesIO
+
+import numpy as np
+import torch
+from diffusers import AutoencoderKL, UNet2DConditionModel
+from PIL import Image
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+from src.stablediffusion.attention import BACKENDS
+from src.stablediffusion.denoise import decode_latents, guidance_weights, step_kwargs
+from src.stablediffusion.schedulers import SAMPLERS, job_scheduler
+from src.stablediffusion.text2image_diffusers import Text2Image
+
+PROMPT = 'a lighthouse on a cliff at sunset, oil painting'
+
+
+def tiny_tokenizer(max_length: int = 77) -> CLIPTokenizer:
+    # a byte-level vocabulary with no merges: every character is its own token, which keeps
+    # the tokenizer real without downloading the CLIP vocabulary
+    directory = tempfile.mkdtemp(prefix='tiny-clip-')
+    characters = list(bytes_to_unicode().values())
+    vocab = characters + [character + '</w>' for character in characters] + ['<|startoftext|>', '<|endoftext|>']
+    vocab_file = os.path.join(directory, 'vocab.json')
+    merges_file = os.path.join(directory, 'merges.txt')
+    with open(vocab_file, 'w', encoding='utf-8') as f:
+        json.dump({token: i for i, token in enumerate(vocab)}, f)
+    with open(merges_file, 'w', encoding='utf-8') as f:
+        f.write('#version: 0.2\n')
+    return CLIPTokenizer(vocab_file, merges_file, model_max_length=max_length)
+
+
+def tiny_components(seed: int = 0) -> dict:
+    torch.manual_seed(seed)
+    tokenizer = tiny_tokenizer()
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        vocab_size=len(tokenizer.encoder),
+        hidden_size=32,
+        intermediate_size=64,
+        num_attention_heads=4,
+        num_hidden_layers=2,
+        max_position_embeddings=tokenizer.model_max_length,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    ))
+    unet = UNet2DConditionModel(
+        sample_size=8,
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        down_block_types=('DownBlock2D', 'CrossAttnDownBlock2D'),
+        up_block_types=('CrossAttnUpBlock2D', 'UpBlock2D'),
+        cross_attention_dim=32,
+        attention_head_dim=8,
+    )
+    vae = AutoencoderKL(
+        block_out_channels=(32, 32, 32, 32),
+        down_block_types=('DownEncoderBlock2D',) * 4,
+        up_block_types=('UpDecoderBlock2D',) * 4,
+        latent_channels=4,
+    )
+    return {'vae': vae, 'unet': unet, 'tokenizer': tokenizer, 'text_encoder': text_encoder, 'text_encoder_name': 'tiny'}
+
+
+class StageTimer:
+    def __init__(self, device: torch.device):
+        self.device = device
+        self.samples = {}
+
+    def sync(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    @contextmanager
+    def time(self, stage: str):
+        self.sync()
+        start = time.perf_counter()
+        yield
+        self.sync()
+        self.samples.setdefault(stage, []).append((time.perf_counter() - start) * 1000)
+
+
+@torch.no_grad()
+def time_stages(model: Text2Image, timer: StageTimer, batch_size: int, height: int, width: int, steps: int):
+    prompts = [PROMPT] * batch_size
+    device = model.device
+    model.plan('txt2img', batch_size, height, width)
+
+    with timer.time('tokenize'):
+        input_ids = model.embedding_cache.tokenize(prompts + [''] * batch_size)
+    with timer.time('text_encode'):
+        text_embeddings = model.text_encoder(input_ids.to(device))[0]
+
+    images = torch.rand((batch_size, 3, height, width), device=device, dtype=model.dtype) * 2 - 1
+    with timer.time('vae_encode'):
+        model.vae.encode(images).sample()
+
+    scheduler, _ = job_scheduler(model.scheduler_for('pndm'), steps)
+    do_classifier_free_guidance, guidance_scale = guidance_weights([7.5] * batch_size, batch_size, device)
+    extra_step_kwargs = step_kwargs(scheduler, 0.0)
+    latents = torch.randn((batch_size, model.unet.in_channels, height // 8, width // 8), device=device, dtype=model.dtype)
+    for t in scheduler.timesteps:
+        with timer.time('unet_step'):
+            noise_pred = model.unet(torch.cat([latents] * 2), t, encoder_hidden_states=text_embeddings)['sample']
+        noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+        noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+        with timer.time('scheduler_step'):
+            latents = scheduler.step(noise_pred, t, latents, **extra_step_kwargs)['prev_sample']
+
+    with timer.time('vae_decode'):
+        decoded = decode_latents(model.vae, latents)
+    with timer.time('to_pil'):
+        pil_images = model.dream_pipe.numpy_to_pil(decoded)
+    with timer.time('png_encode'):
+        for image in pil_images:
+            with BytesIO() as buffer:
+                image.save(buffer, 'PNG')
+
+
+@torch.no_grad()
+def time_modes(model: Text2Image, timer: StageTimer, batch_size: int, height: int, width: int, steps: int, sampler: str = None):
+    prompts = [PROMPT] * batch_size
+    init_image = Image.fromarray(np.random.RandomState(0).randint(0, 255, (height, width, 3), dtype=np.uint8))
+    mask = Image.new('L', (width, height), 255)
+    mask.paste(0, (width // 4, height // 4, 3 * width // 4, 3 * height // 4))
+
+    with timer.time('txt2img'):
+        model.dream_batch(prompts, steps, 0.0, [7.5] * batch_size, list(range(batch_size)), height, width, sampler=sampler)
+
+    init_latent_dist = model.encode_init_image(init_image, width, height)
+    with timer.time('img2img'):
+        model.pipe('translation', sampler)(prompts, init_latent_dist, 0.75, steps, 7.5)
+    with timer.time('inpaint'):
+        model.pipe('inpaint', sampler)(prompts, init_latent_dist, mask, 0.75, steps, 7.5)
+
+
+def run(model: Text2Image, batch_sizes: list, resolutions: list, steps: int, repeats: int, warmup: int = 1, sampler: str = None) -> list:
+    results = []
+    for resolution in resolutions:
+        for batch_size in batch_sizes:
+            for _ in range(warmup):
+                time_stages(model, StageTimer(model.device), batch_size, resolution, resolution, steps)
+                time_modes(model, StageTimer(model.device), batch_size, resolution, resolution, steps, sampler)
+
+            timer = StageTimer(model.device)
+            for _ in range(repeats):
+                time_stages(model, timer, batch_size, resolution, resolution, steps)
+                time_modes(model, timer, batch_size, resolution, resolution, steps, sampler)
+
+            for stage, samples in timer.samples.items():
+                results.append({
+                    'stage': stage,
+                    'batch_size': batch_size,
+                    'height': resolution,
+                    'width': resolution,
+                    'steps': steps,
+                    'runs': len(samples),
+                    'mean_ms': statistics.mean(samples),
+                    'median_ms': statistics.median(samples),
+                    'min_ms': min(samples),
+                })
+    return results
+
+
+def result_key(result: dict):
+    return (result['stage'], result['batch_size'], result['height'], result['width'], result['steps'])
+
+
+def compare(results: list, baseline: list, threshold: float) -> list:
+    previous = {result_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(result_key(result))
+        if before is None or before['median_ms'] <= 0:
+            continue
+        ratio = result['median_ms'] / before['median_ms']
+        if ratio > 1 + threshold:
+            regressions.append({**result, 'baseline_median_ms': before['median_ms'], 'ratio': ratio})
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the Stable Diffusion pipelines stage by stage on tiny random-weight models.',
+        usage='python -m src.stablediffusion.benchmark [arguments]'
+    )
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--resolutions', type=int, nargs='+', default=[64, 128])
+    parser.add_argument('--steps', type=int, default=4)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--gpu', action='store_true', help='Run on CUDA in fp16 instead of the CPU.')
+    parser.add_argument('--attention', type=str, choices=('auto',) + BACKENDS, default='auto', help='UNet attention backend; auto picks one per resolution.')
+    parser.add_argument('--sampler', type=str, choices=tuple(SAMPLERS), default=None, help='Sampler for the end to end modes (default: each mode\'s own).')
+    parser.add_argument('--output', type=str, help='Write results as JSON to this file instead of stdout.')
+    parser.add_argument('--baseline', type=str, help='Compare against a previous JSON result file.')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative slowdown that counts as a regression.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    components = tiny_components()
+    model = Text2Image(use_gpu=args.gpu, components=components, attention=args.attention)
+
+    results = run(model, args.batch_sizes, args.resolutions, args.steps, args.repeats, sampler=args.sampler)
+    report = {
+        'meta': {
+            'torch': torch.__version__,
+            'python': platform.python_version(),
+            'device': str(model.device),
+            'dtype': str(model.dtype),
+            'threads': torch.get_num_threads(),
+            'attention': args.attention,
+            'sampler': args.sampler,
+        },
+        'results': results,
+    }
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        report['regressions'] = compare(results, baseline, args.threshold)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if report.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
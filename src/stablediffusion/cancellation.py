@@ -0,0 +1,107 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Optional
+
+
+class JobCancelled(Exception):
+    def __init__(self, steps_done: int, steps_total: Optional[int], reason: str = 'cancel'):
+        super().__init__(steps_done, steps_total, reason)
+        self.steps_done = steps_done
+        self.steps_total = steps_total
+        self.reason = reason
+
+    @property
+    def steps_saved(self) -> int:
+        if self.steps_total is None:
+            return 0
+        return self.steps_total - self.steps_done
+
+    def __str__(self) -> str:
+        what = 'Cancelled' if self.reason == 'cancel' else 'Ran out of time'
+        if self.steps_total is None:
+            return f'{what} before it started'
+        return f'{what} after {self.steps_done} of {self.steps_total} steps, {self.steps_saved} steps saved'
+
+
+class _Cancellable(ABC):
+    @abstractmethod
+    def reason(self) -> Optional[str]:
+        pass
+
+    def check(self, steps_done: int, steps_total: Optional[int]):
+        reason = self.reason()
+        if reason is not None:
+            raise JobCancelled(steps_done, steps_total, reason)
+
+
+class CancelToken(_Cancellable):
+    """Asks a running job to stop. Pipelines check it between UNet steps and raise
+    ``JobCancelled`` once it was cancelled or its ``deadline`` (a ``time.time()`` timestamp, so
+    it means the same in worker processes and on inference nodes) has passed."""
+
+    def __init__(self, deadline: Optional[float] = None):
+        self.deadline = deadline
+        self._cancelled = threading.Event()
+        self._callbacks = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        if self._cancelled.is_set():
+            return
+        self._cancelled.set()
+        for callback in self._callbacks:
+            callback()
+
+    def add_callback(self, callback: Callable[[], None]):
+        # called once on cancel, e.g. to pass the cancel on to another process
+        self._callbacks.append(callback)
+        if self.cancelled:
+            callback()
+
+    def reason(self) -> Optional[str]:
+        if self.cancelled:
+            return 'cancel'
+        if self.deadline is not None and time.time() > self.deadline:
+            return 'deadline'
+        return None
+
+
+class CancelGroup(_Cancellable):
+    """The tokens of a batch of jobs: the batch only stops once every job in it has."""
+
+    def __init__(self, tokens: list):
+        self.tokens = tokens
+
+    def reason(self) -> Optional[str]:
+        if not self.tokens or any(token is None for token in self.tokens):
+            return None
+        reasons = [token.reason() for token in self.tokens]
+        if not all(reasons):
+            return None
+        return 'cancel' if 'cancel' in reasons else 'deadline'
+
+
+def cancel_tokens(kwargs: dict) -> list:
+    return [value for value in kwargs.values() if isinstance(value, CancelToken)]
+
+
+def cancel_reason(kwargs: dict) -> Optional[str]:
+    # why a job with these arguments should not start, if it shouldn't
+    for token in cancel_tokens(kwargs):
+        reason = token.reason()
+        if reason is not None:
+            return reason
+    return None
+
+
+def release_device_memory(error: JobCancelled):
+    # the traceback holds the frames of the aborted loop and with them its latents and UNet
+    # activations; dropping it lets the caching allocator hand the memory back
+    error.__traceback__ = None
+    import torch
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
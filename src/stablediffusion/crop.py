@@ -0,0 +1,70 @@
+from typing import Tuple
+
+import PIL
+from PIL import Image, ImageFilter
+
+# context kept around the masked area, and the smallest crop SD works well at
+CROP_PADDING = 32
+CROP_MIN_SIZE = 256
+CROP_FEATHER = 8
+
+
+def _span(start: int, end: int, length: int, limit: int) -> Tuple[int, int]:
+    # grows [start, end) to length around its centre, shifted to stay within [0, limit)
+    length = min(max(end - start, length), limit)
+    start = min(max((start + end - length) // 2, 0), limit - length)
+    return start, start + length
+
+
+def repaint_mask(mask: Image.Image, size: Tuple[int, int]) -> Image.Image:
+    # 255 where the mask asks for new content, at the image's size
+    mask = mask.convert("L")
+    if mask.size != size:
+        mask = mask.resize(size, resample=PIL.Image.LANCZOS)
+    return mask.point(lambda value: 255 if value < 128 else 0)
+
+
+def crop_region(repaint: Image.Image, model_size: Tuple[int, int], padding: int = CROP_PADDING, minimum: int = CROP_MIN_SIZE):
+    """Box around the area to repaint, padded for context, and the size it is denoised at.
+
+    Crops that fit the model resolution are denoised at their own size, larger ones are scaled
+    down to fit it with the box grown to the same aspect ratio. Returns ``None`` when there is
+    nothing to repaint.
+    """
+    bounds = repaint.getbbox()
+    if bounds is None:
+        return None
+    left, top, right, bottom = bounds
+    width, height = repaint.size
+    model_width, model_height = model_size
+    # the UNet downsamples the latents three times, so sizes are multiples of 64 pixels
+    crop_width = -(-max(right - left + 2 * padding, min(minimum, model_width)) // 64) * 64
+    crop_height = -(-max(bottom - top + 2 * padding, min(minimum, model_height)) // 64) * 64
+
+    scale = min(1.0, model_width / crop_width, model_height / crop_height)
+    size = (max(64, int(crop_width * scale) // 64 * 64), max(64, int(crop_height * scale) // 64 * 64))
+    # rounding changed the aspect ratio, so the box grows to match it and is scaled undistorted
+    scale = min(size[0] / crop_width, size[1] / crop_height)
+    crop_width, crop_height = round(size[0] / scale), round(size[1] / scale)
+
+    left, right = _span(left - padding, right + padding, crop_width, width)
+    top, bottom = _span(top - padding, bottom + padding, crop_height, height)
+    return (left, top, right, bottom), size
+
+
+def feather_paste(original: Image.Image, result: Image.Image, repaint: Image.Image, box: Tuple[int, int, int, int], feather: int = CROP_FEATHER) -> Image.Image:
+    """Blends a denoised crop back into the full-resolution original.
+
+    The blend ramps up just outside the repainted area, where the crop was pinned to the original,
+    so nothing of the original shows through inside it.
+    """
+    size = (box[2] - box[0], box[3] - box[1])
+    original = original.convert("RGB")
+    if result.size != size:
+        result = result.resize(size, resample=PIL.Image.LANCZOS)
+    alpha = repaint.crop(box)
+    if feather > 0:
+        alpha = alpha.filter(ImageFilter.MaxFilter(2 * feather + 1)).filter(ImageFilter.GaussianBlur(feather / 2))
+    blended = Image.composite(result, original.crop(box), alpha)
+    original.paste(blended, box[:2])
+    return original
@@ -0,0 +1,202 @@
+import inspect
+import math
+import time
+from typing import Callable, List, Optional, Sequence, Union
+
+import torch
+from tqdm.auto import tqdm
+
+from src.core.metrics import DENOISE_STEP_SECONDS, GUIDANCE_SKIPPED_STEPS, STAGE_SECONDS, observe_stage
+from src.stablediffusion.cancellation import CancelToken
+from src.stablediffusion.embeddings import TextEmbeddingCache
+from src.stablediffusion.offload import resident
+from src.stablediffusion.schedulers import uses_sigmas
+from src.stablediffusion.tiling import vae_decode
+
+# hook called after every scheduler step as hook(step_index, timestep, latents); it may modify
+# latents in place or return a replacement tensor
+StepHook = Callable[[int, torch.Tensor, torch.FloatTensor], Optional[torch.FloatTensor]]
+
+
+def guidance_weights(guidance_scale: Union[float, List[float]], batch_size: int, device: torch.device):
+    # here `guidance_scale` is defined analog to the guidance weight `w` of equation (2)
+    # of the Imagen paper: https://arxiv.org/pdf/2205.11487.pdf . `guidance_scale = 1`
+    # corresponds to doing no classifier free guidance. A list gives every sample in the
+    # batch its own guidance weight.
+    if isinstance(guidance_scale, (list, tuple)):
+        if len(guidance_scale) != batch_size:
+            raise ValueError(f"Got {len(guidance_scale)} guidance scales for a batch of {batch_size} prompts.")
+        do_classifier_free_guidance = any(scale > 1.0 for scale in guidance_scale)
+        return do_classifier_free_guidance, torch.tensor(guidance_scale, device=device).view(-1, 1, 1, 1)
+    return guidance_scale > 1.0, guidance_scale
+
+
+def encode_prompt(embedding_cache: TextEmbeddingCache, prompt: Union[str, List[str]], batch_size: int, do_classifier_free_guidance: bool):
+    with observe_stage('text_encode'):
+        text_embeddings = embedding_cache.encode(prompt)
+        if do_classifier_free_guidance:
+            # For classifier free guidance, we need to do two forward passes.
+            # Here we concatenate the unconditional and text embeddings into a single batch
+            # to avoid doing two forward passes
+            uncond_embeddings = embedding_cache.unconditional(batch_size)
+            text_embeddings = torch.cat([uncond_embeddings, text_embeddings])
+    return text_embeddings
+
+
+def step_kwargs(scheduler, eta: float) -> dict:
+    # eta (η) is only used with the DDIMScheduler, it will be ignored for other schedulers.
+    # eta corresponds to η in DDIM paper: https://arxiv.org/abs/2010.02502
+    # and should be between [0, 1]
+    accepts_eta = "eta" in set(inspect.signature(scheduler.step).parameters.keys())
+    return {"eta": eta} if accepts_eta else {}
+
+
+# a generator for the whole batch, or one per sample
+Generators = Union[torch.Generator, List[torch.Generator], None]
+
+
+def sample_noise(shape: tuple, generator: Generators, device: torch.device) -> torch.FloatTensor:
+    # with one generator per sample, each sample is drawn on the CPU from its own generator so a
+    # seed gives the same noise whether it ran alone or inside a batch
+    if isinstance(generator, (list, tuple)):
+        if len(generator) != shape[0]:
+            raise ValueError(f"Got {len(generator)} generators for a batch of {shape[0]}.")
+        noise = torch.cat([torch.randn((1, *shape[1:]), generator=sample_generator) for sample_generator in generator])
+        return noise.to(device)
+    return torch.randn(shape, generator=generator, device=device)
+
+
+def sample_init_latents(init_latent_dist, batch_size: int, generator: Generators = None) -> torch.FloatTensor:
+    # draws the init latents from the VAE posterior, separately per sample given a list of generators
+    if isinstance(generator, (list, tuple)):
+        mean = init_latent_dist.mean
+        noise = sample_noise((batch_size, *mean.shape[1:]), generator, mean.device)
+        init_latents = mean + init_latent_dist.std * noise.to(mean.dtype)
+    else:
+        init_latents = torch.cat([init_latent_dist.sample()] * batch_size)
+    return 0.18215 * init_latents
+
+
+def noise_init_latents(scheduler, init_latents: torch.FloatTensor, strength: float, num_inference_steps: int, offset: int, generator: Generators = None):
+    # get the original timestep using init_timestep
+    init_timestep = int(num_inference_steps * strength) + offset
+    init_timestep = min(init_timestep, num_inference_steps)
+    t_start = max(num_inference_steps - init_timestep + offset, 0)
+
+    # add noise to latents using the timesteps
+    noise = sample_noise(init_latents.shape, generator, init_latents.device)
+    if uses_sigmas(scheduler):
+        latents = init_latents + noise * float(scheduler.sigmas[t_start])
+    else:
+        timesteps = int(scheduler.timesteps[-init_timestep])
+        timesteps = torch.tensor([timesteps] * init_latents.shape[0], dtype=torch.long, device=init_latents.device)
+        latents = scheduler.add_noise(init_latents, noise, timesteps)
+
+    return latents, noise, t_start
+
+
+def renoise(scheduler, original: torch.FloatTensor, noise: torch.FloatTensor, step_index: int) -> torch.FloatTensor:
+    # the original latents at the noise level of the latents after step step_index; DDPM-style
+    # schedulers noise to the step's own timestep, as diffusers' inpainting pipeline does
+    if uses_sigmas(scheduler):
+        return original + noise * float(scheduler.sigmas[step_index + 1])
+    return scheduler.add_noise(original, noise, scheduler.timesteps[step_index])
+
+
+def denoise(
+    unet,
+    scheduler,
+    latents: torch.FloatTensor,
+    text_embeddings: torch.FloatTensor,
+    guidance_scale: Union[float, torch.Tensor],
+    do_classifier_free_guidance: bool,
+    extra_step_kwargs: dict,
+    start_index: int = 0,
+    hooks: Sequence[StepHook] = (),
+    mode: str = 'txt2img',
+    cancel: Optional[CancelToken] = None,
+    guidance_cutoff: float = 1.0,
+    guidance_threshold: float = 0.0,
+) -> torch.FloatTensor:
+    """Runs the scheduler's timesteps from ``start_index`` on and returns the final latents.
+
+    The UNet input is written into one preallocated buffer each step and guidance is applied in
+    place on the UNet output, so the loop itself does not allocate beyond what the UNet and
+    scheduler do. ``cancel`` is checked before every UNet step and raises ``JobCancelled``.
+
+    Guidance matters most for the composition laid down in early steps. It stops after the first
+    ``guidance_cutoff`` of the steps, or once the guidance delta of every sample is smaller than
+    ``guidance_threshold`` times its unconditional prediction; later steps run the UNet on the
+    conditional half only.
+    """
+    batch_size = latents.shape[0]
+    copies = 2 if do_classifier_free_guidance else 1
+    # the text embeddings come unconditional half first
+    cond_embeddings = text_embeddings[batch_size:] if do_classifier_free_guidance else text_embeddings
+    model_input = torch.empty((copies * batch_size, *latents.shape[1:]), dtype=latents.dtype, device=latents.device)
+    sigma_scaled = uses_sigmas(scheduler)
+    # CUDA kernels run asynchronously, so step timings are only meaningful after a sync
+    synchronize = torch.cuda.synchronize if latents.device.type == 'cuda' else None
+
+    total_steps = len(scheduler.timesteps) - start_index
+    guided = do_classifier_free_guidance
+    guided_steps = math.ceil(guidance_cutoff * total_steps)
+
+    denoise_start = time.perf_counter()
+    for i, t in tqdm(enumerate(scheduler.timesteps[start_index:])):
+        if cancel is not None:
+            cancel.check(i, total_steps)
+        step_index = start_index + i
+        step_start = time.perf_counter()
+        if guided and i >= guided_steps:
+            guided = False
+        if do_classifier_free_guidance and not guided:
+            GUIDANCE_SKIPPED_STEPS.inc(mode=mode)
+
+        # expand the latents if we are doing classifier free guidance
+        step_copies = copies if guided else 1
+        step_input = model_input[:step_copies * batch_size]
+        for copy in range(step_copies):
+            step_input[copy * batch_size:(copy + 1) * batch_size].copy_(latents)
+        if sigma_scaled:
+            sigma = scheduler.sigmas[step_index]
+            step_input.div_(float((sigma**2 + 1) ** 0.5))
+
+        # predict the noise residual
+        embeddings = text_embeddings if guided else cond_embeddings
+        noise_pred = resident(unet)(step_input, t, encoder_hidden_states=embeddings)["sample"]
+
+        # perform guidance, reusing the text half of the output as the result
+        if guided:
+            noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+            delta = noise_pred_text.sub_(noise_pred_uncond)
+            if guidance_threshold > 0:
+                relative = delta.flatten(1).norm(dim=1) / noise_pred_uncond.flatten(1).norm(dim=1)
+                guided = relative.max().item() >= guidance_threshold
+            noise_pred = delta.mul_(guidance_scale).add_(noise_pred_uncond)
+
+        # compute the previous noisy sample x_t -> x_t-1
+        if sigma_scaled:
+            latents = scheduler.step(noise_pred, step_index, latents, **extra_step_kwargs)["prev_sample"]
+        else:
+            latents = scheduler.step(noise_pred, t, latents, **extra_step_kwargs)["prev_sample"]
+
+        for hook in hooks:
+            result = hook(step_index, t, latents)
+            if result is not None:
+                latents = result
+
+        if synchronize is not None:
+            synchronize()
+        DENOISE_STEP_SECONDS.observe(time.perf_counter() - step_start, mode=mode)
+
+    STAGE_SECONDS.observe(time.perf_counter() - denoise_start, stage='denoise')
+    return latents
+
+
+def decode_latents(vae, latents: torch.FloatTensor):
+    # scale and decode the image latents with vae
+    with observe_stage('decode'):
+        image = vae_decode(vae, 1 / 0.18215 * latents)
+        image = (image / 2 + 0.5).clamp(0, 1)
+        return image.cpu().permute(0, 2, 3, 1).numpy()
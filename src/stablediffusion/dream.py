@@ -1,26 +1,33 @@
-import inspect
 import warnings
 from typing import List, Optional, Union
 
 import torch
 
-from tqdm.auto import tqdm
 from transformers import CLIPFeatureExtractor, CLIPTextModel, CLIPTokenizer
 
 from diffusers import AutoencoderKL, UNet2DConditionModel, DiffusionPipeline, DDIMScheduler, LMSDiscreteScheduler, PNDMScheduler
 
-
-from PIL import Image
+from src.stablediffusion.cancellation import CancelToken
+from src.stablediffusion.embeddings import TextEmbeddingCache
+from src.stablediffusion.offload import execution_device
+from src.stablediffusion.denoise import Generators, decode_latents, denoise, encode_prompt, guidance_weights, sample_noise, step_kwargs
+from src.stablediffusion.latent_preview import preview_hook
+from src.stablediffusion.preview import PreviewBuffer
+from src.stablediffusion.schedulers import job_scheduler, uses_sigmas
 
 
 class StableDiffusionPipeline(DiffusionPipeline):
+    # constructor arguments that are not pipeline modules
+    ignore_for_config = ["embedding_cache"]
+
     def __init__(
         self,
         vae: AutoencoderKL,
         text_encoder: CLIPTextModel,
         tokenizer: CLIPTokenizer,
         unet: UNet2DConditionModel,
-        scheduler: Union[DDIMScheduler, PNDMScheduler, LMSDiscreteScheduler]
+        scheduler: Union[DDIMScheduler, PNDMScheduler, LMSDiscreteScheduler],
+        embedding_cache: Optional[TextEmbeddingCache] = None,
     ):
         super().__init__()
         scheduler = scheduler.set_format("pt")
@@ -31,6 +38,14 @@ class StableDiffusionPipeline(DiffusionPipeline):
             unet=unet,
             scheduler=scheduler,
         )
+        if embedding_cache is None:
+            embedding_cache = TextEmbeddingCache(tokenizer, text_encoder)
+        self.embedding_cache = embedding_cache
+
+    @property
+    def device(self) -> torch.device:
+        # with a memory budget the weights may sit on the CPU between stages
+        return execution_device(self.unet)
 
     @torch.no_grad()
     def __call__(
@@ -39,11 +54,15 @@ class StableDiffusionPipeline(DiffusionPipeline):
         height: Optional[int] = 512,
         width: Optional[int] = 512,
         num_inference_steps: Optional[int] = 50,
-        guidance_scale: Optional[float] = 7.5,
+        guidance_scale: Optional[Union[float, List[float]]] = 7.5,
         eta: Optional[float] = 0.0,
-        generator: Optional[torch.Generator] = None,
+        generator: Generators = None,
+        latents: Optional[torch.FloatTensor] = None,
         output_type: Optional[str] = "pil",
-        progress: Optional[bool] = False,
+        preview: Optional[PreviewBuffer] = None,
+        cancel: Optional[CancelToken] = None,
+        guidance_cutoff: Optional[float] = 1.0,
+        guidance_threshold: Optional[float] = 0.0,
         **kwargs,
     ):
         if "torch_device" in kwargs:
@@ -68,105 +87,45 @@ class StableDiffusionPipeline(DiffusionPipeline):
         if height % 8 != 0 or width % 8 != 0:
             raise ValueError(f"`height` and `width` have to be divisible by 8 but are {height} and {width}.")
 
-        # get prompt text embeddings
-        text_input = self.tokenizer(
-            prompt,
-            padding="max_length",
-            max_length=self.tokenizer.model_max_length,
-            truncation=True,
-            return_tensors="pt",
-        )
-        text_embeddings = self.text_encoder(text_input.input_ids.to(self.device))[0]
-
-        # here `guidance_scale` is defined analog to the guidance weight `w` of equation (2)
-        # of the Imagen paper: https://arxiv.org/pdf/2205.11487.pdf . `guidance_scale = 1`
-        # corresponds to doing no classifier free guidance.
-        do_classifier_free_guidance = guidance_scale > 1.0
-        # get unconditional embeddings for classifier free guidance
-        if do_classifier_free_guidance:
-            max_length = text_input.input_ids.shape[-1]
-            uncond_input = self.tokenizer(
-                [""] * batch_size, padding="max_length", max_length=max_length, return_tensors="pt"
-            )
-            uncond_embeddings = self.text_encoder(uncond_input.input_ids.to(self.device))[0]
+        do_classifier_free_guidance, guidance_scale = guidance_weights(guidance_scale, batch_size, self.device)
 
-            # For classifier free guidance, we need to do two forward passes.
-            # Here we concatenate the unconditional and text embeddings into a single batch
-            # to avoid doing two forward passes
-            text_embeddings = torch.cat([uncond_embeddings, text_embeddings])
+        # get prompt text embeddings, with the unconditional ones in front for guidance
+        text_embeddings = encode_prompt(self.embedding_cache, prompt, batch_size, do_classifier_free_guidance)
 
         # get the intial random noise
-        latents = torch.randn(
-            (batch_size, self.unet.in_channels, height // 8, width // 8),
-            generator=generator,
-            device=self.device,
+        latents_shape = (batch_size, self.unet.in_channels, height // 8, width // 8)
+        if latents is None:
+            latents = sample_noise(latents_shape, generator, self.device)
+        elif latents.shape != latents_shape:
+            raise ValueError(f"Unexpected latents shape, got {latents.shape}, expected {latents_shape}")
+        latents = latents.to(self.device)
+
+        # every call gets its own scheduler so concurrent jobs do not share timestep state
+        scheduler, _ = job_scheduler(self.scheduler, num_inference_steps)
+
+        # sigma-parameterised samplers start from noise scaled to the largest sigma
+        if uses_sigmas(scheduler):
+            latents = latents * scheduler.sigmas[0]
+
+        hooks = []
+        if preview is not None:
+            hooks.append(preview_hook(self.vae, preview))
+
+        latents = denoise(
+            self.unet,
+            scheduler,
+            latents,
+            text_embeddings,
+            guidance_scale,
+            do_classifier_free_guidance,
+            step_kwargs(scheduler, eta),
+            hooks=hooks,
+            cancel=cancel,
+            guidance_cutoff=guidance_cutoff,
+            guidance_threshold=guidance_threshold,
         )
 
-        # set timesteps
-        accepts_offset = "offset" in set(inspect.signature(self.scheduler.set_timesteps).parameters.keys())
-        extra_set_kwargs = {}
-        if accepts_offset:
-            extra_set_kwargs["offset"] = 1
-
-        self.scheduler.set_timesteps(num_inference_steps, **extra_set_kwargs)
-
-        # if we use LMSDiscreteScheduler, let's make sure latents are mulitplied by sigmas
-        if isinstance(self.scheduler, LMSDiscreteScheduler):
-            latents = latents * self.scheduler.sigmas[0]
-
-        # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
-        # eta (η) is only used with the DDIMScheduler, it will be ignored for other schedulers.
-        # eta corresponds to η in DDIM paper: https://arxiv.org/abs/2010.02502
-        # and should be between [0, 1]
-        accepts_eta = "eta" in set(inspect.signature(self.scheduler.step).parameters.keys())
-        extra_step_kwargs = {}
-        if accepts_eta:
-            extra_step_kwargs["eta"] = eta
-        
-        images = []
-
-        for i, t in tqdm(enumerate(self.scheduler.timesteps)):
-            # expand the latents if we are doing classifier free guidance
-            latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
-            if isinstance(self.scheduler, LMSDiscreteScheduler):
-                sigma = self.scheduler.sigmas[i]
-                latent_model_input = latent_model_input / ((sigma**2 + 1) ** 0.5)
-
-            # predict the noise residual
-            noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=text_embeddings)["sample"]
-
-            # perform guidance
-            if do_classifier_free_guidance:
-                noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
-
-            # compute the previous noisy sample x_t -> x_t-1
-            if isinstance(self.scheduler, LMSDiscreteScheduler):
-                latents = self.scheduler.step(noise_pred, i, latents, **extra_step_kwargs)["prev_sample"]
-            else:
-                latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs)["prev_sample"]
-            
-            if progress:
-                latent_image = self.vae.decode(1 / 0.18215 * latents)
-                latent_image = (latent_image / 2 + 0.5).clamp(0, 1)
-                latent_image = latent_image.cpu().permute(0, 2, 3, 1).numpy()
-
-                if latent_image.ndim == 3:
-                    latent_image = latent_image[None, ...]
-                latent_image = (latent_image * 255).round().astype('uint8')
-                latent_image = [Image.fromarray(image) for image in latent_image]
-                images.append(latent_image[0])
-
-
-        if progress:
-            images[0].save(f'output.gif', save_all=True, append_images=images[1:], optimize=False, loop=0, duration=125)
-
-        # scale and decode the image latents with vae
-        latents = 1 / 0.18215 * latents
-        image = self.vae.decode(latents)
-
-        image = (image / 2 + 0.5).clamp(0, 1)
-        image = image.cpu().permute(0, 2, 3, 1).numpy()
+        image = decode_latents(self.vae, latents)
 
         if output_type == "pil":
             image = self.numpy_to_pil(image)
@@ -0,0 +1,93 @@
+from collections import OrderedDict
+from typing import List, Union
+
+import torch
+from transformers import CLIPTextModel, CLIPTokenizer
+
+from src.stablediffusion.offload import execution_device, resident
+
+
+class TextEmbeddingCache:
+    """LRU cache of CLIP text embeddings keyed by model and token ids, bounded by memory size.
+
+    The unconditional (empty prompt) embedding never changes for a given model, so it is
+    computed once and kept outside the LRU.
+    """
+
+    def __init__(self, tokenizer: CLIPTokenizer, text_encoder: CLIPTextModel, model_name: str = '', max_bytes: int = 64 * 1024 * 1024):
+        self.tokenizer = tokenizer
+        self.text_encoder = text_encoder
+        self.model_name = model_name
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._uncond = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'bytes': self.bytes}
+
+    def tokenize(self, prompts: List[str]) -> torch.LongTensor:
+        return self.tokenizer(
+            prompts,
+            padding="max_length",
+            max_length=self.tokenizer.model_max_length,
+            truncation=True,
+            return_tensors="pt",
+        ).input_ids
+
+    @torch.no_grad()
+    def encode(self, prompt: Union[str, List[str]]) -> torch.FloatTensor:
+        prompts = [prompt] if isinstance(prompt, str) else prompt
+        input_ids = self.tokenize(prompts)
+
+        keys = [(self.model_name, tuple(ids.tolist())) for ids in input_ids]
+        embeddings = [self._get(key) for key in keys]
+
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            text_encoder = resident(self.text_encoder)
+            encoded = text_encoder(input_ids[missing].to(execution_device(text_encoder)))[0]
+            for i, embedding in zip(missing, encoded):
+                embeddings[i] = embedding[None].clone()
+                self._put(keys[i], embeddings[i])
+
+        return torch.cat(embeddings)
+
+    @torch.no_grad()
+    def unconditional(self, batch_size: int) -> torch.FloatTensor:
+        if self._uncond is None:
+            uncond_input = self.tokenizer(
+                [""], padding="max_length", max_length=self.tokenizer.model_max_length, return_tensors="pt"
+            )
+            text_encoder = resident(self.text_encoder)
+            self._uncond = text_encoder(uncond_input.input_ids.to(execution_device(text_encoder)))[0]
+        return self._uncond.expand(batch_size, -1, -1)
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+        self._uncond = None
+
+    def _get(self, key):
+        embedding = self._entries.get(key)
+        if embedding is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return embedding
+
+    def _put(self, key, embedding: torch.FloatTensor):
+        size = embedding.numel() * embedding.element_size()
+        if size > self.max_bytes:
+            return
+        self._entries[key] = embedding
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= evicted.numel() * evicted.element_size()
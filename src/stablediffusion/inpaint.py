@@ -1,35 +1,27 @@
-import inspect
 from typing import List, Optional, Union
 
-import numpy as np
 import torch
 
 import PIL
 from diffusers import AutoencoderKL, DDIMScheduler, DiffusionPipeline, PNDMScheduler, UNet2DConditionModel
-from tqdm.auto import tqdm
+from diffusers.models.vae import DiagonalGaussianDistribution
 from transformers import CLIPTextModel, CLIPTokenizer
 
+from src.stablediffusion.denoise import Generators, decode_latents, denoise, encode_prompt, guidance_weights, noise_init_latents, renoise, sample_init_latents, step_kwargs
+from src.stablediffusion.cancellation import CancelToken
+from src.stablediffusion.embeddings import TextEmbeddingCache
+from src.stablediffusion.offload import execution_device
+from src.stablediffusion.preprocessing import mask_tensor
+from src.stablediffusion.latent_preview import preview_hook
+from src.stablediffusion.preview import PreviewBuffer
+from src.stablediffusion.schedulers import job_scheduler
+from src.stablediffusion.tiling import vae_encode
 
-def preprocess(image):
-    w, h = image.size
-    w, h = map(lambda x: x - x % 32, (w, h))  # resize to integer multiple of 32
-    image = image.resize((w, h), resample=PIL.Image.LANCZOS)
-    image = np.array(image).astype(np.float32) / 255.0
-    image = image[None].transpose(0, 3, 1, 2)
-    image = torch.from_numpy(image)
-    return 2.0 * image - 1.0
-
-def preprocess_mask(mask):
-    mask=mask.convert("L")
-    w, h = mask.size
-    mask = mask.resize((int(w / 8), int(h / 8)), resample=PIL.Image.LANCZOS)
-    mask = np.array(mask).astype(np.float32) / 255.0
-    mask = np.tile(mask,(4,1,1))
-    mask = mask[None].transpose(0, 1, 2, 3)#what does this step do?
-    mask = torch.from_numpy(mask).bool()
-    return (mask).long()
 
 class StableDiffusionInpaintingPipeline(DiffusionPipeline):
+    # constructor arguments that are not pipeline modules
+    ignore_for_config = ["embedding_cache"]
+
     def __init__(
         self,
         vae: AutoencoderKL,
@@ -37,6 +29,7 @@ class StableDiffusionInpaintingPipeline(DiffusionPipeline):
         tokenizer: CLIPTokenizer,
         unet: UNet2DConditionModel,
         scheduler: Union[DDIMScheduler, PNDMScheduler],
+        embedding_cache: Optional[TextEmbeddingCache] = None,
     ):
         super().__init__()
         scheduler = scheduler.set_format("pt")
@@ -47,19 +40,31 @@ class StableDiffusionInpaintingPipeline(DiffusionPipeline):
             unet=unet,
             scheduler=scheduler,
         )
+        if embedding_cache is None:
+            embedding_cache = TextEmbeddingCache(tokenizer, text_encoder)
+        self.embedding_cache = embedding_cache
+
+    @property
+    def device(self) -> torch.device:
+        # with a memory budget the weights may sit on the CPU between stages
+        return execution_device(self.unet)
 
     @torch.no_grad()
     def __call__(
         self,
         prompt: Union[str, List[str]],
-        init_image: torch.FloatTensor,
-        mask_image: torch.FloatTensor,
+        init_image: Union[torch.FloatTensor, DiagonalGaussianDistribution],
+        mask_image: Union[PIL.Image.Image, List[PIL.Image.Image]],
         strength: float = 0.8,
         num_inference_steps: Optional[int] = 50,
-        guidance_scale: Optional[float] = 7.5,
+        guidance_scale: Optional[Union[float, List[float]]] = 7.5,
         eta: Optional[float] = 0.0,
-        generator: Optional[torch.Generator] = None,
+        generator: Generators = None,
         output_type: Optional[str] = "pil",
+        preview: Optional[PreviewBuffer] = None,
+        cancel: Optional[CancelToken] = None,
+        guidance_cutoff: Optional[float] = 1.0,
+        guidance_threshold: Optional[float] = 0.0,
     ):
 
         if isinstance(prompt, str):
@@ -72,101 +77,53 @@ class StableDiffusionInpaintingPipeline(DiffusionPipeline):
         if strength < 0 or strength > 1:
             raise ValueError(f"The value of strength should in [0.0, 1.0] but is {strength}")
 
-        # set timesteps
-        accepts_offset = "offset" in set(inspect.signature(self.scheduler.set_timesteps).parameters.keys())
-        extra_set_kwargs = {}
-        offset = 0
-        if accepts_offset:
-            offset = 1
-            extra_set_kwargs["offset"] = 1
-
-        self.scheduler.set_timesteps(num_inference_steps, **extra_set_kwargs)
+        # every call gets its own scheduler so concurrent jobs do not share timestep state
+        scheduler, offset = job_scheduler(self.scheduler, num_inference_steps)
 
         # encode the init image into latents and scale the latents
-        init_latents = self.vae.encode(init_image.to(self.device)).sample()
-        init_latents = 0.18215 * init_latents
+        if isinstance(init_image, DiagonalGaussianDistribution):
+            init_latent_dist = init_image
+        else:
+            init_latent_dist = vae_encode(self.vae, init_image.to(self.device))
+        init_latents = sample_init_latents(init_latent_dist, batch_size, generator)
         init_latents_orig = init_latents
 
-        # prepare init_latents noise to latents
-        init_latents = torch.cat([init_latents] * batch_size)
-
         # preprocess mask
-        mask = preprocess_mask(mask_image).to(self.device)
-        mask = torch.cat([mask] * batch_size)
-
-        # get the original timestep using init_timestep
-        init_timestep = int(num_inference_steps * strength) + offset
-        init_timestep = min(init_timestep, num_inference_steps)
-        timesteps = self.scheduler.timesteps[-init_timestep]
-        timesteps = torch.tensor([timesteps] * batch_size, dtype=torch.long, device=self.device)
-
-        # add noise to latents using the timesteps
-        noise = torch.randn(init_latents.shape, generator=generator, device=self.device)
-        init_latents = self.scheduler.add_noise(init_latents, noise, timesteps)
-
-        # get prompt text embeddings
-        text_input = self.tokenizer(
-            prompt,
-            padding="max_length",
-            max_length=self.tokenizer.model_max_length,
-            truncation=True,
-            return_tensors="pt",
+        mask = mask_tensor(mask_image, self.device, init_latents.shape[-2:]).to(init_latents.dtype)
+
+        latents, noise, t_start = noise_init_latents(scheduler, init_latents, strength, num_inference_steps, offset, generator)
+
+        # keep the unmasked area pinned to the original, noised to the current timestep
+        def masking_hook(step, timestep, latents):
+            init_latents_proper = renoise(scheduler, init_latents_orig, noise, step)
+            return latents.lerp_(init_latents_proper.to(latents.dtype), mask.to(latents.dtype))
+
+        hooks = [masking_hook]
+        if preview is not None:
+            hooks.append(preview_hook(self.vae, preview))
+
+        do_classifier_free_guidance, guidance_scale = guidance_weights(guidance_scale, batch_size, self.device)
+
+        # get prompt text embeddings, with the unconditional ones in front for guidance
+        text_embeddings = encode_prompt(self.embedding_cache, prompt, batch_size, do_classifier_free_guidance)
+
+        latents = denoise(
+            self.unet,
+            scheduler,
+            latents,
+            text_embeddings,
+            guidance_scale,
+            do_classifier_free_guidance,
+            step_kwargs(scheduler, eta),
+            start_index=t_start,
+            hooks=hooks,
+            mode="inpaint",
+            cancel=cancel,
+            guidance_cutoff=guidance_cutoff,
+            guidance_threshold=guidance_threshold,
         )
-        text_embeddings = self.text_encoder(text_input.input_ids.to(self.device))[0]
-
-        # here `guidance_scale` is defined analog to the guidance weight `w` of equation (2)
-        # of the Imagen paper: https://arxiv.org/pdf/2205.11487.pdf . `guidance_scale = 1`
-        # corresponds to doing no classifier free guidance.
-        do_classifier_free_guidance = guidance_scale > 1.0
-        # get unconditional embeddings for classifier free guidance
-        if do_classifier_free_guidance:
-            max_length = text_input.input_ids.shape[-1]
-            uncond_input = self.tokenizer(
-                [""] * batch_size, padding="max_length", max_length=max_length, return_tensors="pt"
-            )
-            uncond_embeddings = self.text_encoder(uncond_input.input_ids.to(self.device))[0]
-
-            # For classifier free guidance, we need to do two forward passes.
-            # Here we concatenate the unconditional and text embeddings into a single batch
-            # to avoid doing two forward passes
-            text_embeddings = torch.cat([uncond_embeddings, text_embeddings])
-
-        # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
-        # eta (η) is only used with the DDIMScheduler, it will be ignored for other schedulers.
-        # eta corresponds to η in DDIM paper: https://arxiv.org/abs/2010.02502
-        # and should be between [0, 1]
-        accepts_eta = "eta" in set(inspect.signature(self.scheduler.step).parameters.keys())
-        extra_step_kwargs = {}
-        if accepts_eta:
-            extra_step_kwargs["eta"] = eta
-
-        latents = init_latents
-        t_start = max(num_inference_steps - init_timestep + offset, 0)
-        for i, t in tqdm(enumerate(self.scheduler.timesteps[t_start:])):
-            # expand the latents if we are doing classifier free guidance
-            latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
-
-            # predict the noise residual
-            noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=text_embeddings)["sample"]
-
-            # perform guidance
-            if do_classifier_free_guidance:
-                noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
-
-            # compute the previous noisy sample x_t -> x_t-1
-            latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs)["prev_sample"]
-
-            #masking
-            init_latents_proper = self.scheduler.add_noise(init_latents_orig, noise, t)
-            latents = ( init_latents_proper * mask ) + ( latents * (1-mask) )
-
-        # scale and decode the image latents with vae
-        latents = 1 / 0.18215 * latents
-        image = self.vae.decode(latents)
-
-        image = (image / 2 + 0.5).clamp(0, 1)
-        image = image.cpu().permute(0, 2, 3, 1).numpy()
+
+        image = decode_latents(self.vae, latents)
 
         if output_type == "pil":
             image = self.numpy_to_pil(image)
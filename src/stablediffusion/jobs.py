@@ -0,0 +1,33 @@
+"""The ``Text2Image`` methods jobs may call, as signatures that can be imported without torch.
+
+The bot checks, prices and caches jobs with these, while the model that runs them may live in
+another process or on an inference node.
+"""
+from typing import Union
+
+from src.stablediffusion.cancellation import CancelToken
+from src.stablediffusion.preview import PreviewBuffer
+
+MODEL_NAME = 'CompVis/stable-diffusion-v1-4'
+MODEL_REVISION = f'{MODEL_NAME}@fp16'
+# bumped whenever the image a seed produces changes, so cached results from before are not served
+OUTPUT_VERSION = 3
+
+# the model methods a job may call; the method name can come from the network
+JOB_METHODS = ('dream', 'translation', 'inpaint', 'vae_test')
+
+
+def dream(prompt: str, ddim_steps: int, plms: bool, fixed_code: bool, ddim_eta: float, n_iter: int, n_samples: int, cfg_scale: float, seed: int, height: int, width: int, progress: bool, preview: PreviewBuffer = None, cancel: CancelToken = None, sampler: str = None, guidance_cutoff: float = 1.0, guidance_threshold: float = 0.0):
+    pass
+
+
+def translation(prompt: str, init_img, ddim_steps: int, ddim_eta: float, n_iter: int, n_samples: int, cfg_scale: float, denoising_strength: float, seed: int, height: int, width: int, cancel: CancelToken = None, sampler: str = None, guidance_cutoff: float = 1.0, guidance_threshold: float = 0.0):
+    pass
+
+
+def inpaint(prompt: str, init_img, mask_img, ddim_steps: int, ddim_eta: float, n_iter: int, n_samples: int, cfg_scale: float, denoising_strength: float, seed: int, height: int, width: int, cancel: CancelToken = None, sampler: str = None, guidance_cutoff: float = 1.0, guidance_threshold: float = 0.0, crop: Union[bool, tuple] = False):
+    pass
+
+
+def vae_test(image, height: int, width: int, cancel: CancelToken = None):
+    pass
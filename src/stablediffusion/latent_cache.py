@@ -0,0 +1,124 @@
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Optional
+
+import torch
+from PIL import Image
+
+
+class LatentCache:
+    """Content-addressed cache of VAE posterior moments for init images.
+
+    Entries are keyed by a hash of the image pixels plus the target size and resize mode and are
+    evicted least-recently-used once ``max_bytes`` is exceeded. With a ``spill_dir``, evicted
+    entries are written to disk and promoted back to memory on their next hit. With a
+    ``storage_device``, entries are kept there and copied to the requested device on a hit.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, spill_dir: Optional[str] = None, max_spill_bytes: int = 2 * 1024 * 1024 * 1024, storage_device: Optional[torch.device] = None):
+        self.max_bytes = max_bytes
+        self.storage_device = storage_device
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    @staticmethod
+    def key(image: Image.Image, width: int, height: int, resize_mode: int) -> str:
+        digest = hashlib.sha256()
+        digest.update(f'{image.mode}:{image.width}x{image.height}:'.encode())
+        digest.update(image.tobytes())
+        return f'{digest.hexdigest()}-{width}x{height}-{resize_mode}'
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'bytes': self.bytes}
+
+    def get(self, key: str, device: Optional[torch.device] = None) -> Optional[torch.FloatTensor]:
+        moments = self._entries.get(key)
+        if moments is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._to(moments, device)
+
+        path = self._spill_path(key)
+        if path is not None and os.path.exists(path):
+            # several worker processes can share the spill directory, so the file may vanish
+            # between the check and the load
+            try:
+                moments = torch.load(path, map_location=self.storage_device or device)
+                os.remove(path)
+            except (OSError, RuntimeError, EOFError):
+                moments = None
+            if moments is not None:
+                self.put(key, moments)
+                self.hits += 1
+                return self._to(moments, device)
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, moments: torch.FloatTensor):
+        size = self._size(moments)
+        if size > self.max_bytes:
+            return
+        if self.storage_device is not None:
+            moments = moments.to(self.storage_device)
+        if key in self._entries:
+            self.bytes -= self._size(self._entries.pop(key))
+        self._entries[key] = moments
+        self.bytes += size
+
+        while self.bytes > self.max_bytes:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            self.bytes -= self._size(evicted)
+            self._spill(evicted_key, evicted)
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    @staticmethod
+    def _to(moments: torch.FloatTensor, device: Optional[torch.device]) -> torch.FloatTensor:
+        return moments if device is None else moments.to(device)
+
+    @staticmethod
+    def _size(moments: torch.FloatTensor) -> int:
+        return moments.numel() * moments.element_size()
+
+    def _spill_path(self, key: str) -> Optional[str]:
+        if self.spill_dir is None:
+            return None
+        return os.path.join(self.spill_dir, f'{key}.pt')
+
+    def _spill(self, key: str, moments: torch.FloatTensor):
+        path = self._spill_path(key)
+        if path is None:
+            return
+        partial = f'{path}.{os.getpid()}.tmp'
+        torch.save(moments.cpu(), partial)
+        os.replace(partial, path)
+
+        files = []
+        for name in os.listdir(self.spill_dir):
+            if not name.endswith('.pt'):
+                continue
+            file = os.path.join(self.spill_dir, name)
+            try:
+                files.append((os.path.getmtime(file), os.path.getsize(file), file))
+            except OSError:
+                pass
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        while files and total > self.max_spill_bytes:
+            _, size, oldest = files.pop(0)
+            total -= size
+            try:
+                os.remove(oldest)
+            except OSError:
+                pass
@@ -0,0 +1,41 @@
+import numpy as np
+import torch
+from PIL import Image
+
+from src.stablediffusion.preview import PreviewBuffer
+from src.stablediffusion.tiling import vae_decode
+
+# least-squares fit from the four Stable Diffusion v1 latent channels to RGB, good enough to
+# show composition and colour without running the VAE decoder
+LATENT_RGB_FACTORS = [
+    [0.298, 0.207, 0.208],
+    [0.187, 0.286, 0.173],
+    [-0.158, 0.189, 0.264],
+    [-0.184, -0.271, -0.473],
+]
+
+
+@torch.no_grad()
+def latents_to_rgb(latents: torch.FloatTensor) -> list:
+    factors = torch.tensor(LATENT_RGB_FACTORS, dtype=latents.dtype, device=latents.device)
+    image = torch.einsum('bchw,cr->bhwr', latents, factors)
+    image = ((image + 1) / 2).clamp(0, 1)
+    image = (image * 255).round().to(torch.uint8).cpu().numpy()
+    return [Image.fromarray(sample) for sample in image]
+
+
+def render_preview(vae, latents: torch.FloatTensor, mode: str) -> Image.Image:
+    if mode == 'fast':
+        return latents_to_rgb(latents[:1])[0]
+
+    image = vae_decode(vae, 1 / 0.18215 * latents[:1])
+    image = (image / 2 + 0.5).clamp(0, 1)
+    image = (image * 255).round().to(torch.uint8).cpu().permute(0, 2, 3, 1).numpy()
+    return Image.fromarray(np.ascontiguousarray(image[0]))
+
+
+def preview_hook(vae, preview: PreviewBuffer):
+    def hook(step, timestep, latents):
+        if preview.due(step):
+            preview.push(step, render_preview(vae, latents, preview.mode))
+    return hook
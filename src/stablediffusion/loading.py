@@ -0,0 +1,151 @@
+import importlib
+import inspect
+import os
+import re
+import threading
+import time
+from itertools import chain
+from typing import Callable, Optional
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+from src.core.logging import get_logger
+from src.core.metrics import COMPONENT_STARTUP_SECONDS
+
+logger = get_logger(__name__)
+
+WEIGHTS_NAME = 'model.safetensors'
+# loading the converted weights builds modules on the meta device and assigns the memory-mapped
+# tensors to them, which needs PyTorch 2.1
+CAN_ASSIGN = 'assign' in inspect.signature(torch.nn.Module.load_state_dict).parameters
+
+
+class Component:
+    """How to obtain one model component. ``source`` identifies the weights (model, revision,
+    subfolder) and names the converted copy in the cache; ``load`` does the slow load."""
+
+    def __init__(self, source: str, load: Callable):
+        self.source = source
+        self.load = load
+
+
+def _cache_directory(cache_dir: str, source: str, dtype: torch.dtype) -> str:
+    name = re.sub(r'[^A-Za-z0-9_.-]+', '-', f'{source}-{str(dtype).replace("torch.", "")}')
+    return os.path.join(cache_dir, name)
+
+
+def save_converted(module: torch.nn.Module, directory: str):
+    os.makedirs(directory, exist_ok=True)
+    if hasattr(module, 'save_config'):
+        module.save_config(directory)
+    else:
+        module.config.save_pretrained(directory)
+
+    # non-persistent buffers are not in the state dict but would be left on the meta device by
+    # load_converted, so they are saved alongside it
+    tensors = dict(module.named_buffers())
+    tensors.update(module.state_dict())
+    state_dict = {name: tensor.detach().cpu().contiguous() for name, tensor in tensors.items()}
+    cls = type(module)
+    partial = os.path.join(directory, f'{WEIGHTS_NAME}.{os.getpid()}.tmp')
+    save_file(state_dict, partial, metadata={'class': f'{cls.__module__}:{cls.__qualname__}'})
+    # the weights file is written last and atomically, so its presence marks a complete entry
+    os.replace(partial, os.path.join(directory, WEIGHTS_NAME))
+
+
+def load_converted(directory: str, device: torch.device) -> Optional[torch.nn.Module]:
+    path = os.path.join(directory, WEIGHTS_NAME)
+    if not os.path.exists(path):
+        return None
+
+    with safe_open(path, framework='pt') as f:
+        module_name, class_name = f.metadata()['class'].split(':')
+    cls = getattr(importlib.import_module(module_name), class_name)
+
+    # build the module on the meta device so no memory is allocated or initialised for weights
+    # that are about to be replaced by the memory-mapped ones
+    with torch.device('meta'):
+        if hasattr(cls, 'from_config'):
+            module = cls.from_config(directory)
+        else:
+            module = cls(cls.config_class.from_pretrained(directory))
+    tensors = load_file(path, device=str(device))
+    persistent = module.state_dict().keys()
+    module.load_state_dict({name: tensor for name, tensor in tensors.items() if name in persistent}, assign=True)
+    for name, tensor in tensors.items():
+        owner, _, buffer = name.rpartition('.')
+        if name not in persistent and buffer in module.get_submodule(owner)._buffers:
+            module.get_submodule(owner)._buffers[buffer] = tensor
+
+    if any(tensor.is_meta for tensor in chain(module.parameters(), module.buffers())):
+        logger.warning(f'Converted weights in {directory} are incomplete')
+        return None
+    return module
+
+
+class LazyComponents:
+    """Model components that are loaded on first use, each behind its own lock so a request that
+    needs only the VAE never waits for the UNet.
+
+    Converted ``nn.Module`` weights are kept in ``cache_dir`` as safetensors files, which later
+    starts memory-map instead of running ``from_pretrained`` and the dtype conversion again.
+    """
+
+    def __init__(self, components: dict, device: torch.device, dtype: torch.dtype, cache_dir: Optional[str] = None, on_load: Optional[Callable] = None):
+        self.components = components
+        self.device = device
+        self.dtype = dtype
+        if cache_dir is not None and not CAN_ASSIGN:
+            logger.warning('This version of PyTorch cannot load converted weights, loading every component from source')
+            cache_dir = None
+        self.cache_dir = cache_dir
+        self.on_load = on_load
+        self.load_times = {}
+        self._loaded = {}
+        self._locks = {name: threading.Lock() for name in components}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._loaded
+
+    def get(self, name: str):
+        component = self._loaded.get(name)
+        if component is not None:
+            return component
+
+        with self._locks[name]:
+            if name not in self._loaded:
+                start = time.perf_counter()
+                component = self._load(name)
+                if self.on_load is not None:
+                    self.on_load(name, component)
+                self._loaded[name] = component
+                self.load_times[name] = time.perf_counter() - start
+                COMPONENT_STARTUP_SECONDS.set(self.load_times[name], component=name, phase='load')
+                logger.info(f'Loaded {name} in {self.load_times[name]:.2f}s')
+        return self._loaded[name]
+
+    def _load(self, name: str):
+        component = self.components[name]
+        directory = None
+        if self.cache_dir is not None and component.source:
+            directory = _cache_directory(self.cache_dir, component.source, self.dtype)
+            try:
+                module = load_converted(directory, self.device)
+                if module is not None:
+                    return module.eval()
+            except Exception as e:
+                logger.warning(f'Could not load cached {name} from {directory}, loading from source: {e}')
+
+        loaded = component.load()
+        if not isinstance(loaded, torch.nn.Module):
+            return loaded
+
+        loaded = loaded.to(self.dtype).eval()
+        if directory is not None:
+            try:
+                save_converted(loaded, directory)
+            except Exception as e:
+                logger.warning(f'Could not cache {name} in {directory}: {e}')
+        return loaded.to(self.device)
@@ -0,0 +1,209 @@
+import threading
+import time
+from typing import Optional
+
+import torch
+
+from src.core.logging import get_logger
+from src.core.metrics import OFFLOAD_BYTES, OFFLOAD_SECONDS
+
+logger = get_logger(__name__)
+
+# stage order of each request type, used to prefetch the next component while the current one runs
+STAGE_ORDERS = {
+    'txt2img': ('text_encoder', 'unet', 'vae'),
+    'img2img': ('vae', 'text_encoder', 'unet', 'vae'),
+    'inpaint': ('vae', 'text_encoder', 'unet', 'vae'),
+    'vae': ('vae',),
+}
+
+
+def estimate_activations(name: str, batch_size: int, height: int, width: int, element_size: int = 2) -> int:
+    """Rough peak activation bytes of one stage for Stable Diffusion v1 sized models."""
+    latent_pixels = (height // 8) * (width // 8)
+    if name == 'unet':
+        # guidance doubles the batch; the full-resolution self-attention maps dominate
+        batch = 2 * batch_size
+        return batch * element_size * (16 * latent_pixels * latent_pixels + 20000 * latent_pixels)
+    if name == 'vae':
+        # frames over the tiling threshold are decoded tile by tile (imported here because
+        # tiling itself depends on this module)
+        from src.stablediffusion.tiling import TILE_THRESHOLD_PIXELS
+        pixels = min(height * width, TILE_THRESHOLD_PIXELS)
+        return batch_size * element_size * (128 * 12 * pixels + (pixels // 64) ** 2)
+    if name == 'text_encoder':
+        return 2 * batch_size * element_size * 77 * 768 * 32
+    return 0
+
+
+def resident(module):
+    """Makes sure an offloaded module's weights are on its execution device before it runs."""
+    offloader = getattr(module, 'offloader', None)
+    if offloader is not None:
+        offloader.ensure(module.offload_name)
+    return module
+
+
+def execution_device(module) -> torch.device:
+    offloader = getattr(module, 'offloader', None)
+    if offloader is not None:
+        return offloader.device
+    return module.device
+
+
+class _Placement:
+    def __init__(self, module: torch.nn.Module, host: list, size: int):
+        self.module = module
+        self.host = host
+        self.size = size
+        self.on_device = True
+        self.ready = None
+        self.last_used = 0.0
+
+
+class ComponentOffloader:
+    """Keeps model components within a device memory budget.
+
+    Each attached module gets a pinned host copy of its weights. Before a stage runs, its module
+    is brought to the device, evicting the least recently used idle modules until the resident
+    weights plus the stage's estimated activations fit. Inference never changes the weights, so
+    evicting only repoints them at the host copy. ``plan`` is called per request with its
+    mode, batch size and resolution, which decides how much can stay resident; while one stage
+    runs the next one is copied in on a side stream if it fits next to it.
+    """
+
+    def __init__(self, device: torch.device, budget_bytes: int):
+        self.device = device
+        self.budget = budget_bytes
+        self.swap_seconds = 0.0
+        self.swapped_bytes = 0
+        self._placements = {}
+        self._activations = {}
+        self._order = ()
+        self._position = 0
+        self._current = None
+        self._lock = threading.RLock()
+        self._cuda = device.type == 'cuda'
+        self._copy_stream = torch.cuda.Stream(device) if self._cuda else None
+
+    def attach(self, name: str, module):
+        if not isinstance(module, torch.nn.Module):
+            return
+        with self._lock:
+            tensors = list(module.parameters()) + list(module.buffers())
+            host = []
+            for tensor in tensors:
+                # weights loaded on the CPU serve as their own host copy
+                copy = tensor.detach().to('cpu')
+                if self._cuda:
+                    copy = copy.pin_memory()
+                host.append((tensor, copy))
+            module.offloader = self
+            module.offload_name = name
+            placement = _Placement(module, host, sum(copy.numel() * copy.element_size() for _, copy in host))
+            placement.on_device = bool(tensors) and tensors[0].device.type == self.device.type
+            self._placements[name] = placement
+
+    def plan(self, mode: str, batch_size: int, height: int, width: int):
+        with self._lock:
+            element_size = 2 if self._cuda else 4
+            self._activations = {name: estimate_activations(name, batch_size, height, width, element_size) for name in ('text_encoder', 'unet', 'vae')}
+            self._order = STAGE_ORDERS[mode]
+            self._position = 0
+            self._current = None
+            weights = sum(placement.size for placement in self._placements.values())
+            policy = 'resident' if weights + max(self._activations.values()) <= self.budget else 'swap'
+            logger.info(f'Offload plan for {mode} {batch_size}x{width}x{height}: {policy} ({weights / 2**30:.2f} GiB weights, budget {self.budget / 2**30:.2f} GiB)')
+
+    def resident_bytes(self) -> int:
+        return sum(placement.size for placement in self._placements.values() if placement.on_device)
+
+    def ensure(self, name: str):
+        with self._lock:
+            placement = self._placements.get(name)
+            if placement is None:
+                return
+            placement.last_used = time.monotonic()
+            # the UNet asks on every step, so the common case has to stay cheap
+            if placement.on_device and placement.ready is None and name == self._current:
+                return
+
+            if not placement.on_device or placement.ready is not None:
+                start = time.perf_counter()
+                if not placement.on_device:
+                    self._make_room(name, self._activations.get(name, 0))
+                    self._move(name, to_device=True)
+                if placement.ready is not None:
+                    torch.cuda.current_stream(self.device).wait_event(placement.ready)
+                    placement.ready = None
+                elapsed = time.perf_counter() - start
+                self.swap_seconds += elapsed
+                OFFLOAD_SECONDS.observe(elapsed, component=name)
+
+            self._current = name
+            self._advance(name)
+            self._prefetch_next(name)
+
+    def _advance(self, name: str):
+        for index in range(self._position, len(self._order)):
+            if self._order[index] == name:
+                self._position = index
+                return
+
+    def _prefetch_next(self, current: str):
+        for name in self._order[self._position + 1:]:
+            if name == current:
+                continue
+            placement = self._placements.get(name)
+            if placement is None or placement.on_device:
+                return
+            if self.resident_bytes() + placement.size + self._activations.get(current, 0) <= self.budget:
+                self._move(name, to_device=True, asynchronous=True)
+            return
+
+    def _make_room(self, name: str, activations: int):
+        needed = self._placements[name].size + activations
+        idle = sorted(
+            (placement for other, placement in self._placements.items() if other != name and placement.on_device),
+            key=lambda placement: placement.last_used,
+        )
+        for placement in idle:
+            if self.resident_bytes() + needed <= self.budget:
+                break
+            self._move(placement.module.offload_name, to_device=False)
+        if self.resident_bytes() + needed > self.budget:
+            logger.warning(f'{name} needs {needed / 2**30:.2f} GiB with nothing else resident, over the {self.budget / 2**30:.2f} GiB budget')
+
+    def _move(self, name: str, to_device: bool, asynchronous: bool = False):
+        placement = self._placements[name]
+        if not to_device:
+            if placement.ready is not None:
+                torch.cuda.current_stream(self.device).wait_event(placement.ready)
+                placement.ready = None
+            for tensor, copy in placement.host:
+                tensor.data = copy
+            placement.on_device = False
+            return
+
+        if asynchronous and self._cuda:
+            main = torch.cuda.current_stream(self.device)
+            with torch.cuda.stream(self._copy_stream):
+                for tensor, copy in placement.host:
+                    tensor.data = copy.to(self.device, non_blocking=True)
+                    # the weights are used and later freed on the main stream
+                    tensor.data.record_stream(main)
+                placement.ready = torch.cuda.Event()
+                placement.ready.record(self._copy_stream)
+        else:
+            for tensor, copy in placement.host:
+                tensor.data = copy.to(self.device, non_blocking=self._cuda)
+        placement.on_device = True
+        self.swapped_bytes += placement.size
+        OFFLOAD_BYTES.inc(placement.size, component=name)
+
+
+def parse_memory_budget(value: Optional[str]) -> Optional[int]:
+    """Parses a budget in GiB (as given on the command line) into bytes."""
+    if not value:
+        return None
+    return int(float(value) * 2**30)
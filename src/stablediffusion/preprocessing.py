@@ -0,0 +1,88 @@
+from typing import Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+Images = Union[Image.Image, Sequence[Image.Image]]
+
+
+# 0 = resize
+# 1 = crop and resize
+# 2 = resize and fill
+def resize_image(resize_mode, im, width, height):
+    LANCZOS = (Image.Resampling.LANCZOS if hasattr(Image, 'Resampling') else Image.LANCZOS)
+    if resize_mode == 0:
+        res = im.resize((width, height), resample=LANCZOS)
+    elif resize_mode == 1:
+        ratio = width / height
+        src_ratio = im.width / im.height
+
+        src_w = width if ratio > src_ratio else im.width * height // im.height
+        src_h = height if ratio <= src_ratio else im.height * width // im.width
+
+        resized = im.resize((src_w, src_h), resample=LANCZOS)
+        res = Image.new("RGB", (width, height))
+        res.paste(resized, box=(width // 2 - src_w // 2, height // 2 - src_h // 2))
+    else:
+        ratio = width / height
+        src_ratio = im.width / im.height
+
+        src_w = width if ratio < src_ratio else im.width * height // im.height
+        src_h = height if ratio >= src_ratio else im.height * width // im.width
+
+        resized = im.resize((src_w, src_h), resample=LANCZOS)
+        res = Image.new("RGB", (width, height))
+        res.paste(resized, box=(width // 2 - src_w // 2, height // 2 - src_h // 2))
+
+        if ratio < src_ratio:
+            fill_height = height // 2 - src_h // 2
+            res.paste(resized.resize((width, fill_height), box=(0, 0, width, 0)), box=(0, 0))
+            res.paste(resized.resize((width, fill_height), box=(0, resized.height, width, resized.height)), box=(0, fill_height + src_h))
+        elif ratio > src_ratio:
+            fill_width = width // 2 - src_w // 2
+            res.paste(resized.resize((fill_width, height), box=(0, 0, 0, height)), box=(0, 0))
+            res.paste(resized.resize((fill_width, height), box=(resized.width, 0, resized.width, height)), box=(fill_width + src_w, 0))
+
+    return res
+
+
+def upload(images: Images, mode: str, device: torch.device) -> torch.Tensor:
+    """Stacks images of one size into a uint8 ``(batch, height, width[, channels])`` tensor on ``device``.
+
+    The pixels are copied once, straight into a pinned host buffer when the device is a GPU, and
+    from there asynchronously; conversion to float happens on the device.
+    """
+    if isinstance(images, Image.Image):
+        images = [images]
+    if any(image.size != images[0].size for image in images):
+        raise ValueError(f"Images in a batch have to be the same size, got {', '.join(f'{image.width}x{image.height}' for image in images)}.")
+    first = np.asarray(images[0].convert(mode))
+    device = torch.device(device)
+    buffer = torch.empty((len(images), *first.shape), dtype=torch.uint8, pin_memory=device.type == 'cuda')
+    view = buffer.numpy()
+    view[0] = first
+    for i, image in enumerate(images[1:], 1):
+        np.copyto(view[i], np.asarray(image.convert(mode)))
+    return buffer.to(device, non_blocking=True)
+
+
+def image_tensor(images: Images, device: torch.device) -> torch.FloatTensor:
+    # RGB images as a float (batch, 3, height, width) tensor in [-1, 1], the VAE's input
+    pixels = upload(images, "RGB", device).permute(0, 3, 1, 2)
+    return pixels.to(torch.float32, memory_format=torch.contiguous_format).div_(255).mul_(2).sub_(1)
+
+
+def mask_tensor(masks: Images, device: torch.device, size: Optional[Tuple[int, int]] = None) -> torch.FloatTensor:
+    """Masks as a float (batch, 1, height, width) tensor at latent resolution, 1 where the original is
+    kept and 0 where it is repainted; the one channel broadcasts over the four latent channels.
+
+    A latent pixel is only repainted if its whole 8x8 block in the mask is black. ``size`` is the
+    latent height and width, by default an eighth of the mask's.
+    """
+    masks = upload(masks, "L", device)[:, None].float()
+    if size is None:
+        size = (masks.shape[2] // 8, masks.shape[3] // 8)
+    return F.interpolate(masks, size=tuple(size), mode="area").gt_(0)
+
@@ -0,0 +1,42 @@
+import threading
+from typing import Optional
+
+from PIL import Image
+
+
+class PreviewBuffer:
+    """Per-job store of intermediate previews, written by the inference worker and read by the bot.
+
+    ``mode`` is ``'fast'`` for the linear latent projection or ``'decode'`` for a full VAE decode;
+    a preview is rendered every ``every`` steps. Only the most recent ``max_frames`` are kept.
+    """
+
+    def __init__(self, mode: str = 'fast', every: int = 1, max_frames: int = 8):
+        if mode not in ('fast', 'decode'):
+            raise ValueError(f'Unknown preview mode {mode}')
+        self.mode = mode
+        self.every = max(every, 1)
+        self.max_frames = max_frames
+        self.version = 0
+        self._frames = []
+        self._lock = threading.Lock()
+
+    def due(self, step: int) -> bool:
+        return step % self.every == 0
+
+    def push(self, step: int, image: Image.Image):
+        with self._lock:
+            self._frames.append((step, image))
+            if len(self._frames) > self.max_frames:
+                self._frames.pop(0)
+            self.version += 1
+
+    def latest(self) -> Optional[tuple]:
+        with self._lock:
+            if not self._frames:
+                return None
+            return self._frames[-1]
+
+    def frames(self) -> list:
+        with self._lock:
+            return list(self._frames)
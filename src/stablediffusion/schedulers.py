@@ -0,0 +1,196 @@
+import copy
+import inspect
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from diffusers import DDIMScheduler, LMSDiscreteScheduler, PNDMScheduler
+from diffusers.configuration_utils import ConfigMixin, register_to_config
+from diffusers.schedulers.scheduling_utils import SchedulerMixin
+
+# Stable Diffusion's training noise schedule, which every sampler runs on
+BETAS = dict(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", num_train_timesteps=1000)
+
+
+class LMSScheduler(LMSDiscreteScheduler):
+    # diffusers' LMS picks its order from the step index, which is wrong for img2img starting
+    # partway through the schedule; capping it at the derivatives seen so far changes nothing for txt2img
+    def step(self, model_output, timestep: int, sample, order: int = 4):
+        return super().step(model_output, timestep, sample, order=min(order, len(self.derivatives) + 1))
+
+
+class SigmaScheduler(SchedulerMixin, ConfigMixin):
+    """Base for samplers in k-diffusion's parameterisation, where a sample is ``x0 + sigma * noise``.
+
+    Like ``LMSDiscreteScheduler``, ``step`` takes the step index and the UNet input has to be
+    divided by ``sqrt(sigma**2 + 1)``. With ``karras_sigmas`` the steps are spaced as in Karras et
+    al. (2022), denser at low noise, and the timesteps are read back from the sigmas.
+    """
+
+    @register_to_config
+    def __init__(
+        self,
+        num_train_timesteps=1000,
+        beta_start=0.0001,
+        beta_end=0.02,
+        beta_schedule="linear",
+        karras_sigmas=False,
+        tensor_format="pt",
+    ):
+        if beta_schedule == "linear":
+            betas = np.linspace(beta_start, beta_end, num_train_timesteps, dtype=np.float64)
+        elif beta_schedule == "scaled_linear":
+            betas = np.linspace(beta_start**0.5, beta_end**0.5, num_train_timesteps, dtype=np.float64) ** 2
+        else:
+            raise NotImplementedError(f"{beta_schedule} is not implemented for {self.__class__}")
+        alphas_cumprod = np.cumprod(1.0 - betas)
+        # kept as a list so set_format leaves it alone
+        self.train_sigmas = list(((1 - alphas_cumprod) / alphas_cumprod) ** 0.5)
+
+        self.num_inference_steps = None
+        self.timesteps = np.arange(0, num_train_timesteps)[::-1].copy()
+        self.sigmas = np.array(self.train_sigmas[::-1] + [0.0])
+        self.reset()
+
+        self.tensor_format = tensor_format
+        self.set_format(tensor_format=tensor_format)
+
+    def reset(self):
+        pass
+
+    def set_timesteps(self, num_inference_steps):
+        self.num_inference_steps = num_inference_steps
+        train_sigmas = np.array(self.train_sigmas)
+        if self.config.karras_sigmas:
+            rho = 7.0
+            ramp = np.linspace(0, 1, num_inference_steps)
+            max_inv_rho, min_inv_rho = train_sigmas[-1] ** (1 / rho), train_sigmas[0] ** (1 / rho)
+            sigmas = (max_inv_rho + ramp * (min_inv_rho - max_inv_rho)) ** rho
+            timesteps = np.interp(np.log(sigmas), np.log(train_sigmas), np.arange(len(train_sigmas)))
+        else:
+            timesteps = np.linspace(self.config.num_train_timesteps - 1, 0, num_inference_steps, dtype=float)
+            sigmas = np.interp(timesteps, np.arange(len(train_sigmas)), train_sigmas)
+        self.timesteps = timesteps
+        self.sigmas = np.concatenate([sigmas, [0.0]])
+        self.reset()
+        self.set_format(tensor_format=self.tensor_format)
+
+    def add_noise(self, original_samples, noise, timesteps):
+        timesteps = torch.as_tensor(timesteps).cpu().double().numpy()
+        sigmas = np.interp(timesteps, np.arange(len(self.train_sigmas)), self.train_sigmas)
+        sigmas = self.match_shape(torch.as_tensor(sigmas, dtype=original_samples.dtype), original_samples)
+        return original_samples + noise * sigmas
+
+    def __len__(self):
+        return self.config.num_train_timesteps
+
+
+class EulerScheduler(SigmaScheduler):
+    """First order: one UNet evaluation per step, a straight step along the probability flow ODE."""
+
+    def step(self, model_output, timestep: int, sample):
+        sigma, sigma_next = float(self.sigmas[timestep]), float(self.sigmas[timestep + 1])
+        # with eps prediction the ODE derivative (x - x0) / sigma is the predicted noise itself
+        return {"prev_sample": sample + model_output * (sigma_next - sigma)}
+
+
+class DPMSolverMultistepScheduler(SigmaScheduler):
+    """DPM-Solver++(2M) (Lu et al., 2022): second order from the previous step's denoised
+    estimate, so still one UNet evaluation per step."""
+
+    def reset(self):
+        self.previous = None
+
+    def step(self, model_output, timestep: int, sample):
+        sigma, sigma_next = float(self.sigmas[timestep]), float(self.sigmas[timestep + 1])
+        denoised = sample - sigma * model_output
+        if sigma_next == 0:
+            prev_sample = denoised
+        else:
+            h = math.log(sigma / sigma_next)
+            estimate = denoised
+            if self.previous is not None:
+                sigma_previous, previous_denoised = self.previous
+                r = math.log(sigma_previous / sigma) / h
+                estimate = (1 + 1 / (2 * r)) * denoised - (1 / (2 * r)) * previous_denoised
+            prev_sample = (sigma_next / sigma) * sample - math.expm1(-h) * estimate
+        self.previous = (sigma, denoised)
+        return {"prev_sample": prev_sample}
+
+
+SAMPLERS = {
+    'lms': lambda: LMSScheduler(**BETAS),
+    'pndm': lambda: PNDMScheduler(**BETAS, skip_prk_steps=True),
+    'ddim': lambda: DDIMScheduler(**BETAS, clip_sample=False, set_alpha_to_one=False),
+    'euler': lambda: EulerScheduler(**BETAS),
+    'dpm2m': lambda: DPMSolverMultistepScheduler(**BETAS, karras_sigmas=True),
+}
+
+
+def make_scheduler(sampler: str):
+    if sampler not in SAMPLERS:
+        raise ValueError(f'Unknown sampler {sampler}, expected one of {", ".join(SAMPLERS)}')
+    return SAMPLERS[sampler]()
+
+
+def uses_sigmas(scheduler) -> bool:
+    # samplers whose samples are x0 + sigma * noise rather than DDPM's scaled mix
+    return isinstance(scheduler, (LMSDiscreteScheduler, SigmaScheduler))
+
+
+class TimestepTableCache:
+    """Hands every job its own scheduler with timesteps already set.
+
+    Pipelines share one scheduler per type as a template that is never mutated. The first
+    request for a (scheduler type, config, steps, offset) combination runs ``set_timesteps`` on
+    a copy, and later jobs get a deep copy of that prepared scheduler, so the timestep and sigma
+    tables are built once while the per-step state (PNDM's ``ets``, LMS derivatives) stays
+    private to each job.
+    """
+
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def offset_for(scheduler) -> int:
+        accepts_offset = "offset" in set(inspect.signature(scheduler.set_timesteps).parameters.keys())
+        return 1 if accepts_offset else 0
+
+    def key(self, scheduler, num_inference_steps: int, offset: int):
+        config = tuple(sorted((name, repr(value)) for name, value in scheduler.config.items()))
+        return (type(scheduler).__name__, config, num_inference_steps, offset)
+
+    def get(self, template, num_inference_steps: int):
+        offset = self.offset_for(template)
+        key = self.key(template, num_inference_steps, offset)
+
+        with self._lock:
+            prepared = self._tables.get(key)
+            if prepared is not None:
+                self._tables.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+                prepared = copy.deepcopy(template)
+                if offset:
+                    prepared.set_timesteps(num_inference_steps, offset=offset)
+                else:
+                    prepared.set_timesteps(num_inference_steps)
+                self._tables[key] = prepared
+                if len(self._tables) > self.max_entries:
+                    self._tables.popitem(last=False)
+
+        return copy.deepcopy(prepared), offset
+
+
+timestep_tables = TimestepTableCache()
+
+
+def job_scheduler(template, num_inference_steps: int):
+    return timestep_tables.get(template, num_inference_steps)
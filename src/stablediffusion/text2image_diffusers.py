@@ -1,160 +1,309 @@
 import os
+import random
+import threading
+import time
 import torch
-import numpy as np
-from PIL import Image
-from pytorch_lightning import seed_everything
+from typing import Union
+from PIL import Image, ImageOps
 from torch import autocast
 
 from transformers import CLIPTextModel, CLIPTokenizer
-from diffusers import AutoencoderKL, UNet2DConditionModel, LMSDiscreteScheduler, StableDiffusionPipeline, DDIMScheduler, PNDMScheduler
+from diffusers import AutoencoderKL, UNet2DConditionModel
+from diffusers.models.vae import DiagonalGaussianDistribution
 
-from src.stablediffusion.inpaint import StableDiffusionInpaintingPipeline, preprocess, preprocess_mask
+from src.core.logging import get_logger
+from src.core.metrics import COMPONENT_STARTUP_SECONDS, observe_stage
+from src.stablediffusion.attention import AttentionSettings, install_attention
+from src.stablediffusion.cancellation import CancelToken, JobCancelled
+from src.stablediffusion.embeddings import TextEmbeddingCache
+from src.stablediffusion.latent_cache import LatentCache
+from src.stablediffusion.loading import Component, LazyComponents
+from src.stablediffusion.offload import ComponentOffloader, parse_memory_budget
+from src.stablediffusion.preview import PreviewBuffer
+from src.stablediffusion.schedulers import make_scheduler
+from src.stablediffusion.crop import crop_region, feather_paste, repaint_mask
+from src.stablediffusion.inpaint import StableDiffusionInpaintingPipeline
+from src.stablediffusion.jobs import MODEL_NAME
+from src.stablediffusion.preprocessing import image_tensor, resize_image
+from src.stablediffusion.tiling import vae_decode, vae_encode
 from src.stablediffusion.translation import StableDiffusionImg2ImgPipeline
 from src.stablediffusion.dream import StableDiffusionPipeline
 
-# 0 = resize
-# 1 = crop and resize
-# 2 = resize and fill
-def resize_image(resize_mode, im, width, height):
-    LANCZOS = (Image.Resampling.LANCZOS if hasattr(Image, 'Resampling') else Image.LANCZOS)
-    if resize_mode == 0:
-        res = im.resize((width, height), resample=LANCZOS)
-    elif resize_mode == 1:
-        ratio = width / height
-        src_ratio = im.width / im.height
-
-        src_w = width if ratio > src_ratio else im.width * height // im.height
-        src_h = height if ratio <= src_ratio else im.height * width // im.width
-
-        resized = im.resize((src_w, src_h), resample=LANCZOS)
-        res = Image.new("RGB", (width, height))
-        res.paste(resized, box=(width // 2 - src_w // 2, height // 2 - src_h // 2))
-    else:
-        ratio = width / height
-        src_ratio = im.width / im.height
-
-        src_w = width if ratio < src_ratio else im.width * height // im.height
-        src_h = height if ratio >= src_ratio else im.height * width // im.width
-
-        resized = im.resize((src_w, src_h), resample=LANCZOS)
-        res = Image.new("RGB", (width, height))
-        res.paste(resized, box=(width // 2 - src_w // 2, height // 2 - src_h // 2))
-
-        if ratio < src_ratio:
-            fill_height = height // 2 - src_h // 2
-            res.paste(resized.resize((width, fill_height), box=(0, 0, width, 0)), box=(0, 0))
-            res.paste(resized.resize((width, fill_height), box=(0, resized.height, width, resized.height)), box=(0, fill_height + src_h))
-        elif ratio > src_ratio:
-            fill_width = width // 2 - src_w // 2
-            res.paste(resized.resize((fill_width, height), box=(0, 0, 0, height)), box=(0, 0))
-            res.paste(resized.resize((fill_width, height), box=(resized.width, 0, resized.width, height)), box=(fill_width + src_w, 0))
-
-    return res
+logger = get_logger(__name__)
+
+COMPONENT_NAMES = ('tokenizer', 'text_encoder', 'vae', 'unet')
+# the sampler each job method uses unless the request names one
+DEFAULT_SAMPLERS = {'dream': 'lms', 'translation': 'pndm', 'inpaint': 'pndm'}
+PIPELINES = {'dream': StableDiffusionPipeline, 'translation': StableDiffusionImg2ImgPipeline, 'inpaint': StableDiffusionInpaintingPipeline}
+DEFAULT_MODEL_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'shanghai', 'models')
+
+def resolve_seed(seed: int) -> int:
+    if seed is None or seed < 0:
+        return random.randint(0, 2**32 - 1)
+    return seed
+
+def sample_seeds(seed: int, n_iter: int, n_samples: int) -> list:
+    # consecutive seeds, so image i of a request can be reproduced on its own with seed + i
+    if n_iter < 1 or n_samples < 1:
+        raise ValueError(f'n_iter and n_samples have to be at least 1 but are {n_iter} and {n_samples}')
+    seed = resolve_seed(seed)
+    return [seed + i for i in range(n_iter * n_samples)]
+
+def batched(items: list, size: int) -> list:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def generators(seeds: list) -> list:
+    return [torch.Generator('cpu').manual_seed(seed) for seed in seeds]
+
+def run_batches(seeds: list, n_samples: int, run) -> list:
+    # runs run(batch_seeds) per batch of n_samples seeds; a cancelled job counts its steps over all of them
+    batches = batched(seeds, n_samples)
+    images = []
+    for index, batch_seeds in enumerate(batches):
+        try:
+            images.extend(run(batch_seeds))
+        except JobCancelled as e:
+            raise JobCancelled(index * e.steps_total + e.steps_done, len(batches) * e.steps_total, e.reason) from None
+    return images
 
 class Text2Image:
-    def __init__(self, use_gpu=True):
-        self.device = torch.device('cuda' if use_gpu else 'cpu')
-        self.dtype = torch.float16 if use_gpu else torch.float32
-        model_name = 'CompVis/stable-diffusion-v1-4'
-        token = os.environ['HF_TOKEN']
-        
-        self.vae = AutoencoderKL.from_pretrained(model_name, subfolder='vae', revision="fp16", use_auth_token=token)
-        self.unet = UNet2DConditionModel.from_pretrained(model_name, subfolder="unet", revision="fp16", use_auth_token=token)
-        self.tokenizer = CLIPTokenizer.from_pretrained("openai/clip-vit-large-patch14")
-        self.text_encoder = CLIPTextModel.from_pretrained("openai/clip-vit-large-patch14")
-
-        self.scheduler = LMSDiscreteScheduler(
-            beta_start=0.00085, 
-            beta_end=0.012, 
-            beta_schedule="scaled_linear", 
-            num_train_timesteps=1000
-        )
-
-        self.img2img_scheduler = PNDMScheduler(
-            beta_start=0.00085,
-            beta_end=0.012, 
-            beta_schedule="scaled_linear",
-            num_train_timesteps=1000,
-            skip_prk_steps=True
-        )
-
-        self.vae = self.vae.to(self.dtype).eval().to(self.device)
-        self.text_encoder = self.text_encoder.to(self.dtype).eval().to(self.device)
-        self.unet = self.unet.to(self.dtype).eval().to(self.device)
-
-        self.inpaint_pipe = StableDiffusionInpaintingPipeline(
-            self.vae,
-            self.text_encoder,
-            self.tokenizer,
-            self.unet,
-            self.img2img_scheduler
-        )
-        
-        self.dream_pipe = StableDiffusionPipeline(
-            self.vae,
-            self.text_encoder,
-            self.tokenizer,
-            self.unet,
-            self.scheduler
-        )
-
-        self.translation_pipe = StableDiffusionImg2ImgPipeline(
-            self.vae,
-            self.text_encoder,
-            self.tokenizer,
-            self.unet,
-            self.img2img_scheduler
-        )
-        
-    def dream(self, prompt: str, ddim_steps: int, plms: bool, fixed_code: bool, ddim_eta: float, n_iter: int, n_samples: int, cfg_scale: float, seed: int, height: int, width: int, progress: bool):
-        rng_seed = seed_everything(seed)
+    def __init__(self, use_gpu=True, components: dict = None, device: str = None, warmup: bool = False, memory_budget: int = None, attention: str = None):
+        # an explicit device (e.g. 'cuda:1' for one replica of a worker pool) overrides use_gpu
+        self.device = torch.device(device if device is not None else 'cuda' if use_gpu else 'cpu')
+        self.dtype = torch.float16 if self.device.type == 'cuda' else torch.float32
 
-        with autocast('cuda'):
-            image = self.dream_pipe(prompt, height=height, width=width, guidance_scale=cfg_scale, eta=ddim_eta, num_inference_steps=ddim_steps, progress=progress)['sample']
-
-        return image, rng_seed
-    
-    def translation(self, prompt: str, init_img, ddim_steps: int, ddim_eta: float, n_iter: int, n_samples: int, cfg_scale: float, denoising_strength: float, seed: int, height: int, width: int):
-        rng_seed = seed_everything(seed)
-    
-        image = init_img.convert("RGB")
-        image = resize_image(1, image, width, height)
-        image = np.array(image).astype(np.float32) / 255.0
-        image = image[None].transpose(0, 3, 1, 2)
-        image = torch.from_numpy(image)
-        image = 2.0 * image - 1.0
+        # under a memory budget components load to the CPU and only move to the device per stage
+        if memory_budget is None:
+            memory_budget = parse_memory_budget(os.environ.get('MEMORY_BUDGET'))
+        self.offloader = ComponentOffloader(self.device, memory_budget) if memory_budget else None
+        placement = self.device if self.offloader is None else torch.device('cpu')
+        self.attention = AttentionSettings(attention or os.environ.get('ATTENTION_BACKEND', 'auto'))
+
+        # components can be handed in directly (e.g. small random-weight models for benchmarks);
+        # otherwise each one is loaded the first time it is needed
+        if components is None:
+            self.text_encoder_name = "openai/clip-vit-large-patch14"
+            self.components = LazyComponents(self.component_sources(), placement, self.dtype, cache_dir=os.environ.get('MODEL_CACHE_DIR', DEFAULT_MODEL_CACHE_DIR), on_load=self._on_load)
+        else:
+            self.text_encoder_name = components.get('text_encoder_name', '')
+            given = {name: Component('', lambda component=components[name]: component) for name in COMPONENT_NAMES}
+            self.components = LazyComponents(given, placement, self.dtype, on_load=self._on_load)
+
+        # one template scheduler per sampler, shared by the pipelines that use it
+        self.schedulers = {}
+
+        # the cache's moments are not counted in the memory budget, so under one they stay on the host
+        self.latent_cache = LatentCache(spill_dir=os.environ.get('LATENT_CACHE_DIR'), storage_device=None if self.offloader is None else torch.device('cpu'))
+        self._embedding_cache = None
+        self._pipes = {}
+
+        self.warmup_thread = None
+        if warmup:
+            self.warmup_thread = threading.Thread(target=self.warm_up, name='model-warmup', daemon=True)
+            self.warmup_thread.start()
+
+    @staticmethod
+    def component_sources() -> dict:
+        model_name = MODEL_NAME
+        clip_name = "openai/clip-vit-large-patch14"
+
+        return {
+            'tokenizer': Component('', lambda: CLIPTokenizer.from_pretrained(clip_name)),
+            'text_encoder': Component(clip_name, lambda: CLIPTextModel.from_pretrained(clip_name)),
+            'vae': Component(f'{model_name}@fp16/vae', lambda: AutoencoderKL.from_pretrained(model_name, subfolder='vae', revision="fp16", use_auth_token=os.environ['HF_TOKEN'])),
+            'unet': Component(f'{model_name}@fp16/unet', lambda: UNet2DConditionModel.from_pretrained(model_name, subfolder="unet", revision="fp16", use_auth_token=os.environ['HF_TOKEN'])),
+        }
+
+    def _on_load(self, name: str, component):
+        if name == 'unet':
+            install_attention(component, self.attention)
+        if self.offloader is not None:
+            self.offloader.attach(name, component)
+
+    @property
+    def vae(self):
+        return self.components.get('vae')
+
+    @property
+    def unet(self):
+        return self.components.get('unet')
+
+    @property
+    def tokenizer(self):
+        return self.components.get('tokenizer')
+
+    @property
+    def text_encoder(self):
+        return self.components.get('text_encoder')
+
+    @property
+    def embedding_cache(self) -> TextEmbeddingCache:
+        if self._embedding_cache is None:
+            self._embedding_cache = TextEmbeddingCache(self.tokenizer, self.text_encoder, self.text_encoder_name)
+        return self._embedding_cache
+
+    def scheduler_for(self, sampler: str):
+        if sampler not in self.schedulers:
+            self.schedulers[sampler] = make_scheduler(sampler)
+        return self.schedulers[sampler]
+
+    def pipe(self, method: str, sampler: str = None):
+        sampler = sampler or DEFAULT_SAMPLERS[method]
+        key = (method, sampler)
+        if key not in self._pipes:
+            self._pipes[key] = PIPELINES[method](
+                self.vae,
+                self.text_encoder,
+                self.tokenizer,
+                self.unet,
+                self.scheduler_for(sampler),
+                self.embedding_cache
+            )
+        return self._pipes[key]
+
+    @property
+    def dream_pipe(self) -> StableDiffusionPipeline:
+        return self.pipe('dream')
+
+    @property
+    def translation_pipe(self) -> StableDiffusionImg2ImgPipeline:
+        return self.pipe('translation')
+
+    @property
+    def inpaint_pipe(self) -> StableDiffusionInpaintingPipeline:
+        return self.pipe('inpaint')
+
+    @torch.no_grad()
+    def warm_up(self, height: int = 512, width: int = 512):
+        # loads every component, cheapest first, and runs each once at a typical shape so the
+        # first real request doesn't pay for CUDA context setup, kernel loading and allocator growth
+        start = time.perf_counter()
+        steps = [
+            ('tokenizer', lambda: self.tokenizer('', padding='max_length', max_length=self.tokenizer.model_max_length, return_tensors='pt')),
+            ('vae', lambda: vae_decode(self.vae, torch.zeros((1, 4, height // 8, width // 8), device=self.device, dtype=self.dtype))),
+            ('text_encoder', lambda: self.text_encoder(torch.zeros((1, self.tokenizer.model_max_length), dtype=torch.long, device=self.device))),
+            ('unet', lambda: self.unet(
+                torch.zeros((2, self.unet.in_channels, height // 8, width // 8), device=self.device, dtype=self.dtype),
+                999,
+                encoder_hidden_states=torch.zeros((2, self.tokenizer.model_max_length, self.unet.config.cross_attention_dim), device=self.device, dtype=self.dtype),
+            )),
+        ]
+        for name, run in steps:
+            try:
+                self.components.get(name)
+                # running a stage here would fight the jobs for the budget, so only load
+                if self.offloader is not None:
+                    continue
+                warm_start = time.perf_counter()
+                with autocast('cuda'):
+                    run()
+                if self.device.type == 'cuda':
+                    torch.cuda.synchronize(self.device)
+                elapsed = time.perf_counter() - warm_start
+                COMPONENT_STARTUP_SECONDS.set(elapsed, component=name, phase='warmup')
+                logger.info(f'Warmed up {name} in {elapsed:.2f}s')
+            except Exception as e:
+                logger.error(f'Warmup of {name} failed: {e}')
+                return
+        loads = ', '.join(f'{name} {seconds:.2f}s' for name, seconds in self.components.load_times.items())
+        logger.info(f'Model ready on {self.device} in {time.perf_counter() - start:.2f}s (loading: {loads})')
+
+    def dream(self, prompt: str, ddim_steps: int, plms: bool, fixed_code: bool, ddim_eta: float, n_iter: int, n_samples: int, cfg_scale: float, seed: int, height: int, width: int, progress: bool, preview: PreviewBuffer = None, cancel: CancelToken = None, sampler: str = None, guidance_cutoff: float = 1.0, guidance_threshold: float = 0.0):
+        # n_iter batches of n_samples images each, every image with its own seed
+        seeds = sample_seeds(seed, n_iter, n_samples)
+
+        def run(batch_seeds):
+            results = self.dream_batch([prompt] * len(batch_seeds), ddim_steps, ddim_eta, [cfg_scale] * len(batch_seeds), batch_seeds, height, width, preview if progress else None, cancel, sampler, guidance_cutoff, guidance_threshold)
+            return [image for image, _ in results]
+
+        return run_batches(seeds, n_samples, run), seeds
+
+    def dream_batch(self, prompts: list, ddim_steps: int, ddim_eta: float, cfg_scales: list, seeds: list, height: int, width: int, preview: PreviewBuffer = None, cancel: CancelToken = None, sampler: str = None, guidance_cutoff: float = 1.0, guidance_threshold: float = 0.0):
+        seeds = [resolve_seed(seed) for seed in seeds]
+        self.plan('txt2img', len(prompts), height, width)
 
         with autocast('cuda'):
-            image = self.translation_pipe(prompt, image, denoising_strength, ddim_steps, cfg_scale, ddim_eta, None, 'pil')['sample']
+            images = self.pipe('dream', sampler)(prompts, height=height, width=width, guidance_scale=cfg_scales, eta=ddim_eta, num_inference_steps=ddim_steps, generator=generators(seeds), preview=preview, cancel=cancel, guidance_cutoff=guidance_cutoff, guidance_threshold=guidance_threshold)['sample']
 
-        return image, rng_seed
+        return list(zip(images, seeds))
 
-    def inpaint(self, prompt: str, init_img, mask_img, ddim_steps: int, ddim_eta: float, n_iter: int, n_samples: int, cfg_scale: float, denoising_strength: float, seed: int, height: int, width: int):
-        rng_seed = seed_everything(seed)
+    def plan(self, mode: str, batch_size: int, height: int, width: int):
+        # per-request choices that depend on the mode, batch size and resolution
+        backend = self.attention.select(height, width, self.device)
+        logger.debug(f'Using {backend} attention for {width}x{height}')
+        if self.offloader is not None:
+            self.offloader.plan(mode, batch_size, height, width)
 
-        init_img = resize_image(1, init_img, width, height)
+    def translation(self, prompt: str, init_img, ddim_steps: int, ddim_eta: float, n_iter: int, n_samples: int, cfg_scale: float, denoising_strength: float, seed: int, height: int, width: int, cancel: CancelToken = None, sampler: str = None, guidance_cutoff: float = 1.0, guidance_threshold: float = 0.0):
+        seeds = sample_seeds(seed, n_iter, n_samples)
+        self.plan('img2img', n_samples, height, width)
+
+        init_latent_dist = self.encode_init_image(init_img, width, height)
+
+        def run(batch_seeds):
+            with autocast('cuda'):
+                return self.pipe('translation', sampler)([prompt] * len(batch_seeds), init_latent_dist, denoising_strength, ddim_steps, cfg_scale, ddim_eta, generators(batch_seeds), 'pil', cancel=cancel, guidance_cutoff=guidance_cutoff, guidance_threshold=guidance_threshold)['sample']
+
+        return run_batches(seeds, n_samples, run), seeds
+
+    def inpaint(self, prompt: str, init_img, mask_img, ddim_steps: int, ddim_eta: float, n_iter: int, n_samples: int, cfg_scale: float, denoising_strength: float, seed: int, height: int, width: int, cancel: CancelToken = None, sampler: str = None, guidance_cutoff: float = 1.0, guidance_threshold: float = 0.0, crop: Union[bool, tuple] = False):
+        """With ``crop`` only a padded box around the masked area is denoised, at its own size
+        when it fits within ``width`` x ``height``, and blended back into the init image at its
+        full resolution; otherwise the whole frame is denoised at ``width`` x ``height``. ``crop``
+        may also be the region ``crop_region`` found for these images beforehand."""
+        seeds = sample_seeds(seed, n_iter, n_samples)
+        original = init_img
+        if crop:
+            repaint = repaint_mask(mask_img, init_img.size)
+            region = crop if isinstance(crop, (tuple, list)) else crop_region(repaint, (width, height))
+            if region is None:
+                # nothing to repaint
+                return [original.convert('RGB') for _ in seeds], seeds
+            box, (width, height) = tuple(region[0]), tuple(region[1])
+            init_img = init_img.crop(box)
+            # the pipeline's mask is white where the original is kept
+            mask_img = ImageOps.invert(repaint.crop(box)).resize((width, height), resample=Image.NEAREST)
+        self.plan('inpaint', n_samples, height, width)
 
 #        mask = np.array(init_img.convert('RGBA').split()[-1])
 #        mask = Image.fromarray(mask)
 
-        init_img_tensor = preprocess(init_img.convert('RGB'))
+        # a crop has the aspect ratio it is denoised at, and is stretched like its mask and result
+        init_latent_dist = self.encode_init_image(init_img, width, height, resize_mode=0 if crop else 1)
 
-        with autocast('cuda'):
-            image = self.inpaint_pipe(prompt, init_img_tensor, mask_img, denoising_strength, ddim_steps, cfg_scale, ddim_eta, None, 'pil')['sample']
+        def run(batch_seeds):
+            with autocast('cuda'):
+                images = self.pipe('inpaint', sampler)([prompt] * len(batch_seeds), init_latent_dist, mask_img, denoising_strength, ddim_steps, cfg_scale, ddim_eta, generators(batch_seeds), 'pil', cancel=cancel, guidance_cutoff=guidance_cutoff, guidance_threshold=guidance_threshold)['sample']
+            if crop:
+                images = [feather_paste(original, image, repaint, box) for image in images]
+            return images
+
+        return run_batches(seeds, n_samples, run), seeds
+
+    @torch.no_grad()
+    def encode_init_image(self, init_img, width: int, height: int, resize_mode: int = 1):
+        key = self.latent_cache.key(init_img, width, height, resize_mode)
+        moments = self.latent_cache.get(key, self.device)
+        if moments is None:
+            with observe_stage('preprocess'):
+                image = image_tensor(resize_image(resize_mode, init_img.convert("RGB"), width, height), self.device)
+
+            with autocast('cuda'), observe_stage('vae_encode'):
+                moments = vae_encode(self.vae, image).parameters
+            self.latent_cache.put(key, moments)
 
-        return image, rng_seed
+        return DiagonalGaussianDistribution(moments)
 
     @torch.no_grad()
-    def vae_test(self, image, height: int, width: int):
-        image = image.convert("RGB")
-        image = resize_image(1, image, width, height)
-        image = np.array(image).astype(np.float32) / 255.0
-        image = image[None].transpose(0, 3, 1, 2)
-        image = torch.from_numpy(image)
-        image = 2.0 * image - 1.0
+    def vae_test(self, image, height: int, width: int, cancel: CancelToken = None):
+        # no denoising loop to stop, but a job cancelled while queued still shouldn't run
+        if cancel is not None:
+            cancel.check(0, None)
+        self.plan('vae', 1, height, width)
+        image = image_tensor(resize_image(1, image.convert("RGB"), width, height), self.device)
 
         with autocast('cuda'):
-            latent_image = self.vae.decode(self.vae.encode(image.to(self.device)).sample())
+            latent_image = vae_decode(self.vae, vae_encode(self.vae, image).sample())
             latent_image = (latent_image / 2 + 0.5).clamp(0, 1)
             latent_image = latent_image.cpu().permute(0, 2, 3, 1).numpy()
 
@@ -0,0 +1,82 @@
+import torch
+from diffusers.models.vae import DiagonalGaussianDistribution
+
+from src.stablediffusion.offload import resident
+
+# frames above this many pixels go through the tiled path; activation memory of the VAE grows
+# with the square of the resolution, tiles keep it at the cost of one tile
+TILE_THRESHOLD_PIXELS = 768 * 768
+
+
+def _tile_starts(length: int, tile: int, overlap: int) -> list:
+    if length <= tile:
+        return [0]
+    stride = tile - overlap
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)
+    return starts
+
+
+def _ramp(length: int, overlap: int, fade_start: bool, fade_end: bool, device, dtype) -> torch.Tensor:
+    ramp = torch.ones(length, device=device, dtype=dtype)
+    overlap = min(overlap, length // 2)
+    if overlap > 0:
+        fade = torch.linspace(1 / (overlap + 1), 1 - 1 / (overlap + 1), overlap, device=device, dtype=dtype)
+        if fade_start:
+            ramp[:overlap] = fade
+        if fade_end:
+            ramp[-overlap:] = fade.flip(0)
+    return ramp
+
+
+def _blend_weights(y: int, x: int, tile_h: int, tile_w: int, height: int, width: int, overlap: int, device, dtype) -> torch.Tensor:
+    # edges that border another tile fade linearly across the overlap, edges on the frame border don't
+    ramp_y = _ramp(tile_h, overlap, y > 0, y + tile_h < height, device, dtype)
+    ramp_x = _ramp(tile_w, overlap, x > 0, x + tile_w < width, device, dtype)
+    return ramp_y[:, None] * ramp_x[None, :]
+
+
+def _tiled(function, inputs: torch.Tensor, tile: int, overlap: int, scale: float, out_channels: int) -> torch.Tensor:
+    batch_size, _, height, width = inputs.shape
+    out_h, out_w = int(height * scale), int(width * scale)
+    output = None
+    weights = None
+
+    for y in _tile_starts(height, tile, overlap):
+        for x in _tile_starts(width, tile, overlap):
+            tile_h, tile_w = min(tile, height), min(tile, width)
+            result = function(inputs[:, :, y:y + tile_h, x:x + tile_w])
+            if output is None:
+                output = torch.zeros((batch_size, out_channels, out_h, out_w), device=result.device, dtype=result.dtype)
+                weights = torch.zeros((1, 1, out_h, out_w), device=result.device, dtype=result.dtype)
+
+            oy, ox = int(y * scale), int(x * scale)
+            rh, rw = result.shape[-2:]
+            blend = _blend_weights(oy, ox, rh, rw, out_h, out_w, int(overlap * scale), result.device, result.dtype)
+            output[:, :, oy:oy + rh, ox:ox + rw] += result * blend
+            weights[:, :, oy:oy + rh, ox:ox + rw] += blend
+            del result
+
+    return output / weights
+
+
+def vae_decode(vae, latents: torch.FloatTensor, tile_size: int = 64, overlap: int = 8, threshold: int = TILE_THRESHOLD_PIXELS) -> torch.FloatTensor:
+    """Decodes (already 1 / 0.18215 scaled) latents, in overlapping blended tiles when the output
+    is larger than ``threshold`` pixels. ``tile_size`` and ``overlap`` are in latent pixels."""
+    resident(vae)
+    height, width = latents.shape[-2:]
+    if height * width * 64 <= threshold:
+        return vae.decode(latents)
+    return _tiled(vae.decode, latents, tile_size, overlap, 8, 3)
+
+
+def vae_encode(vae, image: torch.FloatTensor, tile_size: int = 512, overlap: int = 64, threshold: int = TILE_THRESHOLD_PIXELS) -> DiagonalGaussianDistribution:
+    """Encodes an image into the VAE posterior, blending the posterior moments of overlapping tiles
+    when the image is larger than ``threshold`` pixels. ``tile_size`` and ``overlap`` are in image
+    pixels and should be multiples of 8."""
+    resident(vae)
+    height, width = image.shape[-2:]
+    if height * width <= threshold:
+        return vae.encode(image)
+    moments = _tiled(lambda tile: vae.encode(tile).parameters, image, tile_size, overlap, 1 / 8, 8)
+    return DiagonalGaussianDistribution(moments)
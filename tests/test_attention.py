@@ -0,0 +1,27 @@
+import pytest
+import torch
+
+from src.stablediffusion.attention import HAS_SDPA, AttentionSettings, install_attention
+from src.stablediffusion.benchmark import tiny_components
+
+
+@pytest.fixture(scope='module')
+def unet():
+    unet = tiny_components()['unet'].eval()
+    # small enough that sliced and chunked attention split every layer into several pieces
+    assert install_attention(unet, AttentionSettings('default', max_score_bytes=4096)) > 0
+    return unet
+
+
+def predict(unet, backend):
+    generator = torch.Generator().manual_seed(0)
+    latents = torch.randn((2, 4, 16, 16), generator=generator)
+    context = torch.randn((2, 8, 32), generator=generator)
+    unet.attention_settings.backend = backend
+    with torch.no_grad():
+        return unet(latents, 500, encoder_hidden_states=context)['sample']
+
+
+@pytest.mark.parametrize('backend', ['sliced', 'chunked', pytest.param('sdpa', marks=pytest.mark.skipif(not HAS_SDPA, reason='needs scaled_dot_product_attention'))])
+def test_backend_matches_default_attention(unet, backend):
+    torch.testing.assert_close(predict(unet, backend), predict(unet, 'default'), rtol=1e-4, atol=1e-5)
@@ -0,0 +1,40 @@
+import asyncio
+import inspect
+
+import pytest
+
+from src.core.jobqueue import JobQueue
+from src.stablediffusion.batching import DreamBatcher
+from src.stablediffusion.text2image_diffusers import Text2Image
+
+DREAM_ARGS = ('a cat', 2, False, False, 0.0, 1, 1, 7.0, 1, 64, 64, False)
+
+
+class FakeModel:
+    # checks arguments like Text2Image.dream without running any model
+    def dream(self, *args, **kwargs):
+        bound = inspect.signature(Text2Image.dream).bind(self, *args, **kwargs)
+        return [bound.arguments['prompt']], [bound.arguments['seed']]
+
+    def dream_batch(self, prompts, ddim_steps, ddim_eta, cfg_scales, seeds, height, width, **kwargs):
+        return list(zip(prompts, seeds))
+
+
+def test_key_is_none_for_arguments_that_do_not_bind():
+    job = type('Job', (), {'method': 'dream', 'args': ('a cat', 4), 'kwargs': {}})()
+    assert DreamBatcher().key(job) is None
+
+
+def test_bad_dream_call_fails_only_its_own_job():
+    async def scenario():
+        job_queue = JobQueue(FakeModel, batcher=DreamBatcher())
+        job_queue.start()
+        try:
+            with pytest.raises(TypeError):
+                await asyncio.wait_for(job_queue.run('dream', 'a cat', 4), timeout=10)
+            assert job_queue._thread.is_alive()
+            return await asyncio.wait_for(job_queue.run('dream', *DREAM_ARGS), timeout=10)
+        finally:
+            job_queue.stop()
+
+    assert asyncio.run(scenario()) == (['a cat'], [1])
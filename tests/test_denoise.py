@@ -0,0 +1,72 @@
+import os
+
+import numpy as np
+import PIL.Image
+import pytest
+import torch
+
+from src.stablediffusion.benchmark import tiny_components
+from src.stablediffusion.dream import StableDiffusionPipeline
+from src.stablediffusion.inpaint import StableDiffusionInpaintingPipeline
+from src.stablediffusion.schedulers import make_scheduler
+from src.stablediffusion.translation import StableDiffusionImg2ImgPipeline
+
+# images from the pipelines as they were before they shared denoise(), run with the components
+# and seeds below; they have to be recorded again if tiny_components() changes
+BASELINE = os.path.join(os.path.dirname(__file__), 'data', 'baseline_pipelines.npz')
+SIZE = 32
+
+
+@pytest.fixture(scope='module')
+def components():
+    components = tiny_components()
+    return components['vae'].eval(), components['text_encoder'].eval(), components['tokenizer'], components['unet'].eval()
+
+
+@pytest.fixture(scope='module')
+def baseline():
+    with np.load(BASELINE) as images:
+        return dict(images)
+
+
+def init_image():
+    return torch.rand((1, 3, SIZE, SIZE), generator=torch.Generator().manual_seed(5)) * 2 - 1
+
+
+def mask_image():
+    # keeps the left half; the old pipeline's LANCZOS mask resize was replaced on purpose, so
+    # its baseline was recorded with the mask the current one derives from this image
+    mask = np.zeros((SIZE, SIZE), dtype=np.uint8)
+    mask[:, :SIZE // 2] = 255
+    return PIL.Image.fromarray(mask)
+
+
+def generator(seed):
+    return torch.Generator().manual_seed(seed)
+
+
+def test_dream_matches_the_baseline(components, baseline):
+    pipe = StableDiffusionPipeline(*components, make_scheduler('lms'))
+    image = pipe(['a cat', 'a dog'], SIZE, SIZE, 6, [7.0, 3.0], generator=generator(3), output_type='np')['sample']
+    np.testing.assert_allclose(image, baseline['dream_lms'], atol=1e-4)
+
+
+def test_dream_ddim_matches_the_baseline(components, baseline):
+    pipe = StableDiffusionPipeline(*components, make_scheduler('ddim'))
+    image = pipe('a cat', SIZE, SIZE, 6, 7.5, generator=generator(4), output_type='np')['sample']
+    np.testing.assert_allclose(image, baseline['dream_ddim'], atol=1e-4)
+
+
+def test_translation_matches_the_baseline(components, baseline):
+    pipe = StableDiffusionImg2ImgPipeline(*components, make_scheduler('pndm'))
+    # the VAE posterior is sampled from the global generator
+    torch.manual_seed(7)
+    image = pipe('a cat', init_image(), 0.6, 10, 7.5, generator=generator(6), output_type='np')['sample']
+    np.testing.assert_allclose(image, baseline['translation_pndm'], atol=1e-4)
+
+
+def test_inpaint_matches_the_baseline(components, baseline):
+    pipe = StableDiffusionInpaintingPipeline(*components, make_scheduler('pndm'))
+    torch.manual_seed(8)
+    image = pipe(['a cat', 'a dog'], init_image(), mask_image(), 0.6, 10, 7.5, generator=generator(9), output_type='np')['sample']
+    np.testing.assert_allclose(image, baseline['inpaint_pndm'], atol=1e-4)
@@ -0,0 +1,85 @@
+import asyncio
+from io import BytesIO
+
+import pytest
+from aiohttp import test_utils, web
+from PIL import Image
+
+from src.core.fetch import ImageFetcher, ImageFetchError
+
+
+def encode(size, format):
+    buffer = BytesIO()
+    Image.new('RGB', size, 'red').save(buffer, format=format)
+    return buffer.getvalue()
+
+
+SMALL_PNG = encode((32, 32), 'PNG')
+LARGE_PNG = encode((200, 200), 'PNG')
+LARGE_JPEG = encode((200, 200), 'JPEG')
+
+
+def app():
+    async def image(request):
+        return web.Response(body={'small.png': SMALL_PNG, 'large.png': LARGE_PNG, 'large.jpg': LARGE_JPEG}[request.match_info['name']])
+
+    async def stream(request):
+        # no Content-Length, so only the running total can catch it
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for _ in range(8):
+            await response.write(b'\0' * 1024)
+        return response
+
+    async def slow(request):
+        await asyncio.sleep(5)
+        return web.Response(body=SMALL_PNG)
+
+    application = web.Application()
+    application.router.add_get('/stream', stream)
+    application.router.add_get('/slow', slow)
+    application.router.add_get('/{name}', image)
+    return application
+
+
+def fetch(path, mode='RGB', **limits):
+    async def scenario():
+        async with test_utils.TestServer(app()) as server:
+            fetcher = ImageFetcher(**limits)
+            try:
+                return await fetcher.fetch_image(str(server.make_url(path)), mode)
+            finally:
+                await fetcher.close()
+
+    return asyncio.run(scenario())
+
+
+def test_fetches_and_converts():
+    image = fetch('/small.png', 'RGBA')
+    assert image.size == (32, 32) and image.mode == 'RGBA'
+
+
+def test_declared_size_over_the_byte_cap():
+    with pytest.raises(ImageFetchError, match='too large'):
+        fetch('/large.png', max_bytes=len(LARGE_PNG) - 1)
+
+
+def test_streamed_size_over_the_byte_cap():
+    with pytest.raises(ImageFetchError, match='too large'):
+        fetch('/stream', max_bytes=4096)
+
+
+def test_timeout():
+    with pytest.raises(ImageFetchError, match='Timed out'):
+        fetch('/slow', timeout=0.2)
+
+
+def test_png_over_the_pixel_limit():
+    with pytest.raises(ImageFetchError, match='too large'):
+        fetch('/large.png', max_pixels=100 * 100)
+
+
+def test_jpeg_over_the_pixel_limit_is_draft_decoded():
+    image = fetch('/large.jpg', max_pixels=100 * 100)
+    assert image.width * image.height <= 100 * 100
+    assert image.size == (50, 50)
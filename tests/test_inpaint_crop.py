@@ -0,0 +1,35 @@
+from PIL import Image
+
+from src.core.scheduler import job_cost
+from src.stablediffusion.crop import crop_region, repaint_mask
+
+
+def mask(size, hole):
+    image = Image.new('L', size, 255)
+    image.paste(0, hole)
+    return repaint_mask(image, size)
+
+
+def test_box_has_the_aspect_ratio_it_is_denoised_at():
+    # rounding 704x384 down to 64s gives 512x256, so the box grows to 768x384
+    box, size = crop_region(mask((1000, 1000), (100, 100, 740, 420)), (512, 512))
+    left, top, right, bottom = box
+    assert size == (512, 256)
+    assert (right - left) * size[1] == (bottom - top) * size[0]
+
+
+def test_region_fits_the_model_resolution_and_covers_the_mask():
+    box, size = crop_region(mask((2000, 1500), (100, 100, 1900, 1000)), (512, 512))
+    left, top, right, bottom = box
+    assert size[0] <= 512 and size[1] <= 512 and size[0] % 64 == 0 and size[1] % 64 == 0
+    assert left <= 100 and top <= 100 and right >= 1900 and bottom >= 1000
+
+
+def test_nothing_to_repaint():
+    assert crop_region(mask((400, 300), (0, 0, 0, 0)), (512, 512)) is None
+
+
+def test_cost_of_a_crop_is_its_region():
+    args = ('a cat', Image.new('RGB', (400, 300)), Image.new('L', (400, 300)), 50, 0.0, 1, 1, 7.0, 1.0, -1, 512, 512)
+    full = job_cost('inpaint', args, {})
+    assert job_cost('inpaint', args, {'crop': ((0, 0, 256, 256), (256, 256))}) == full / 4
@@ -0,0 +1,35 @@
+import inspect
+import subprocess
+import sys
+
+import pytest
+
+from src.stablediffusion import jobs
+from src.stablediffusion.presets import SAMPLER_NAMES
+from src.stablediffusion.schedulers import SAMPLERS
+from src.stablediffusion.text2image_diffusers import Text2Image
+
+BLOCK_ML = '''
+import sys
+class Block:
+    def find_spec(self, name, path=None, target=None):
+        if name.split('.')[0] in ('torch', 'diffusers', 'transformers'):
+            raise ImportError(name)
+sys.meta_path.insert(0, Block())
+'''
+
+
+@pytest.mark.parametrize('method', jobs.JOB_METHODS)
+def test_job_signatures_match_the_model(method):
+    model = inspect.signature(getattr(Text2Image, method))
+    model = model.replace(parameters=list(model.parameters.values())[1:])
+    assert inspect.signature(getattr(jobs, method)) == model
+
+
+def test_sampler_names_match_the_samplers():
+    assert set(SAMPLER_NAMES) == set(SAMPLERS)
+
+
+def test_frontend_imports_without_torch():
+    code = BLOCK_ML + 'import src.bot.stablecog, src.core.scheduler, src.core.remote'
+    subprocess.run([sys.executable, '-c', code], check=True)
@@ -0,0 +1,44 @@
+import torch
+from safetensors.torch import save_file
+from transformers import CLIPTextModel
+
+from src.stablediffusion.benchmark import tiny_components
+from src.stablediffusion.loading import WEIGHTS_NAME, load_converted, save_converted
+
+
+class TextEncoder(CLIPTextModel):
+    # position_ids as newer transformers register it, outside the state dict
+    def __init__(self, config):
+        super().__init__(config)
+        embeddings = self.text_model.embeddings
+        embeddings.register_buffer('position_ids', embeddings.position_ids.clone(), persistent=False)
+
+
+def text_encoder():
+    components = tiny_components()
+    return TextEncoder(components['text_encoder'].config).eval(), components['tokenizer']
+
+
+def encode(model, tokenizer):
+    tokens = tokenizer(['a cat'], padding='max_length', return_tensors='pt').input_ids
+    with torch.no_grad():
+        return model(tokens)[0]
+
+
+def test_round_trip_restores_non_persistent_buffers(tmp_path):
+    model, tokenizer = text_encoder()
+    assert 'text_model.embeddings.position_ids' not in model.state_dict()
+    save_converted(model, str(tmp_path))
+
+    loaded = load_converted(str(tmp_path), torch.device('cpu'))
+    assert not any(tensor.is_meta for tensor in loaded.buffers())
+    torch.testing.assert_close(encode(loaded.eval(), tokenizer), encode(model, tokenizer))
+
+
+def test_entry_without_the_buffers_is_not_used(tmp_path):
+    model, _ = text_encoder()
+    save_converted(model, str(tmp_path))
+    # as written before non-persistent buffers were saved
+    save_file({name: tensor.contiguous() for name, tensor in model.state_dict().items()}, str(tmp_path / WEIGHTS_NAME), metadata={'class': f'{__name__}:TextEncoder'})
+
+    assert load_converted(str(tmp_path), torch.device('cpu')) is None
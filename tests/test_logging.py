@@ -0,0 +1,36 @@
+import logging
+import multiprocessing
+import time
+
+from src.core.logging import get_logger, log_queue, log_to_queue
+
+
+def child(queue):
+    # a child never opens log.txt itself
+    handlers = [type(handler).__name__ for handler in logging.getLogger().handlers]
+    log_to_queue(queue)
+    get_logger('child').info('hello from a child with handlers %s', handlers)
+
+
+class Capture(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append((record.name, record.getMessage()))
+
+
+def test_child_processes_log_through_the_parent():
+    capture = Capture()
+    logging.getLogger().addHandler(capture)
+    try:
+        process = multiprocessing.get_context('spawn').Process(target=child, args=(log_queue(),))
+        process.start()
+        process.join(30)
+        deadline = time.monotonic() + 5
+        while not capture.messages and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        logging.getLogger().removeHandler(capture)
+    assert ('child', 'hello from a child with handlers []') in capture.messages
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+from src.core.jobqueue import JobQueue, UnknownMethodError
+from src.core.protocol import LocalConnection
+from src.core.remote import InferenceClient, InferenceNode, RemoteJobError
+
+
+class FakeModel:
+    calls = []
+
+    def dream(self, prompt, *args, **kwargs):
+        return [prompt], [0]
+
+    def warm_up(self, *args, **kwargs):
+        FakeModel.calls.append('warm_up')
+
+
+def serve(scenario):
+    async def run():
+        job_queue = JobQueue(FakeModel)
+        job_queue.start()
+        client_end, node_end = LocalConnection.pair()
+        served = asyncio.create_task(InferenceNode(job_queue).serve(node_end))
+        try:
+            return await asyncio.wait_for(scenario(client_end, job_queue), timeout=10)
+        finally:
+            await client_end.close()
+            await served
+            job_queue.stop()
+
+    FakeModel.calls.clear()
+    return asyncio.run(run())
+
+
+def test_node_refuses_unknown_methods():
+    async def scenario(connection, job_queue):
+        await connection.send({'type': 'job', 'id': 7, 'method': 'warm_up', 'args': [], 'kwargs': {}})
+        reply, _ = await connection.receive()
+        return reply
+
+    reply = serve(scenario)
+    assert reply['type'] == 'error' and reply['id'] == 7 and reply['kind'] == 'UnknownMethodError'
+    assert FakeModel.calls == []
+
+
+def test_client_sees_the_refusal_and_can_keep_going():
+    async def scenario(connection, job_queue):
+        async def connect():
+            return connection
+
+        client = InferenceClient(connect)
+        with pytest.raises(RemoteJobError, match='UnknownMethodError'):
+            await client.run('__init__')
+        return await client.run('dream', 'a cat')
+
+    assert serve(scenario) == (['a cat'], [0])
+    assert FakeModel.calls == []
+
+
+def test_job_queue_refuses_unknown_methods():
+    async def scenario(connection, job_queue):
+        with pytest.raises(UnknownMethodError):
+            await job_queue.run('warm_up')
+
+    serve(scenario)
+    assert FakeModel.calls == []
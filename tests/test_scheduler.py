@@ -0,0 +1,25 @@
+import asyncio
+
+from src.core.metrics import SCHEDULER_DEPTH
+from src.core.scheduler import FairScheduler, JobRequest
+
+DREAM_ARGS = ('a cat', 50, False, False, 0.0, 1, 1, 7.0, 1, 512, 512, False)
+
+
+class StalledQueue:
+    # never finishes a job, so everything past the slots stays in the scheduler
+    async def run(self, method, *args, **kwargs):
+        await asyncio.Event().wait()
+
+
+def test_jobs_waiting_in_the_scheduler_are_exported():
+    async def scenario():
+        scheduler = FairScheduler(StalledQueue(), slots=1, user_rate=0, guild_rate=0)
+        for user in range(3):
+            scheduler.submit(JobRequest(user), 'dream', *DREAM_ARGS)
+        await asyncio.sleep(0)
+        return scheduler.depth, SCHEDULER_DEPTH.samples()
+
+    depth, samples = asyncio.run(scenario())
+    assert depth == 2
+    assert samples == ['shanghai_scheduler_depth 2.0']
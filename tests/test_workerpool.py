@@ -0,0 +1,123 @@
+import asyncio
+import os
+import signal
+import time
+
+import pytest
+
+from src.core.workerpool import WorkerCrashedError, WorkerPool, _Tokens
+from src.stablediffusion.cancellation import CancelToken, JobCancelled
+
+
+def tiny_model(device):
+    import torch
+    from src.stablediffusion.benchmark import tiny_components
+    from src.stablediffusion.text2image_diffusers import Text2Image
+
+    torch.set_num_threads(1)
+    return Text2Image(device=device, components=tiny_components())
+
+
+def dream(steps, seed=1):
+    return ('a cat', steps, False, False, 0.0, 1, 1, 7.0, seed, 64, 64, False)
+
+
+@pytest.fixture(scope='module')
+def pool():
+    pool = WorkerPool(tiny_model, ['cpu', 'cpu'])
+    pool.start()
+    yield pool
+    pool.stop()
+
+
+def run(scenario):
+    return asyncio.run(asyncio.wait_for(scenario(), timeout=120))
+
+
+def wait_until(condition, timeout=60):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+def test_jobs_go_to_the_least_loaded_worker(pool):
+    async def scenario():
+        completed = [worker.completed for worker in pool.workers]
+        long = asyncio.create_task(pool.run('dream', *dream(200)))
+        while not any(worker.pending for worker in pool.workers):
+            await asyncio.sleep(0.01)
+        busy = next(worker for worker in pool.workers if worker.pending)
+        for seed in range(2):
+            await pool.run('dream', *dream(2, seed))
+        assert not long.done()
+        await long
+        return busy, [worker.completed - before for worker, before in zip(pool.workers, completed)]
+
+    busy, completed = run(scenario)
+    assert completed[busy.id] == 1
+    assert completed[1 - busy.id] == 2
+
+
+def test_cancel_while_queued(pool):
+    async def scenario():
+        cancel = CancelToken()
+        job = asyncio.create_task(pool.run('dream', *dream(200), cancel=cancel))
+        cancel.cancel()
+        with pytest.raises(JobCancelled) as cancelled:
+            await job
+        return cancelled.value
+
+    assert run(scenario).steps_done == 0
+
+
+def test_cancel_while_running(pool):
+    async def scenario():
+        cancel = CancelToken()
+        start = time.monotonic()
+        job = asyncio.create_task(pool.run('dream', *dream(2000), cancel=cancel))
+        while not any(worker.pending for worker in pool.workers):
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.5)
+        cancel.cancel()
+        with pytest.raises(JobCancelled) as cancelled:
+            await job
+        return cancelled.value, time.monotonic() - start
+
+    cancelled, elapsed = run(scenario)
+    assert 0 < cancelled.steps_done < 2000
+    assert elapsed < 30
+
+
+def test_cancel_that_arrives_before_its_job():
+    tokens = _Tokens()
+    tokens.cancel((3, 0))
+    assert tokens.create((3, 0), None).cancelled
+    assert not tokens.create((3, 1), None).cancelled
+
+    # cancels for jobs that already finished are not kept around
+    tokens.release(3, 2)
+    tokens.cancel((3, 0))
+    assert not tokens.create((3, 0), None).cancelled
+
+
+def test_crashed_worker_is_restarted(pool):
+    async def scenario():
+        job = asyncio.create_task(pool.run('dream', *dream(2000)))
+        while not any(worker.pending for worker in pool.workers):
+            await asyncio.sleep(0.01)
+        worker = next(worker for worker in pool.workers if worker.pending)
+        pid = worker.process.pid
+        os.kill(pid, signal.SIGKILL)
+        with pytest.raises(WorkerCrashedError):
+            await job
+        return worker, pid
+
+    worker, pid = run(scenario)
+    wait_until(lambda: worker.ready and worker.process.pid != pid)
+
+    async def again():
+        return await asyncio.gather(*[pool.run('dream', *dream(2, seed)) for seed in range(4)])
+
+    assert [seeds for _, seeds in run(again)] == [[0], [1], [2], [3]]
+    assert worker.load_error is None